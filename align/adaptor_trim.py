@@ -14,10 +14,17 @@ Usage:
 
 This can filter the trimmed product by minimum and maximum size with --min_size
 and --max_size options.
+
+With --fast, adaptors are found with k-mer seeds and a bit-parallel edit
+distance search instead of local alignments, and --cores trims batches of
+reads in multiple processes. --histogram writes counts of trimmed read
+lengths to a tab delimited file.
 """
 from __future__ import with_statement
 import sys
 import os
+import itertools
+import collections
 from optparse import OptionParser
 
 from Bio import pairwise2
@@ -25,24 +32,75 @@ from Bio.Seq import Seq
 from Bio import SeqIO
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
-def main(in_file, out_file, adaptor_seq, num_errors, min_size=1, max_size=None):
+def main(in_file, out_file, adaptor_seq, num_errors, min_size=1, max_size=None,
+         fast=False, cores=1, hist_file=None):
     num_errors = int(num_errors)
     min_size = int(min_size)
     max_size = int(max_size) if max_size else None
+    cores = int(cores)
 
+    trim_args = (adaptor_seq, num_errors, min_size, max_size, fast)
+    lengths = collections.defaultdict(int)
     with open(in_file) as in_handle:
         with open(out_file, "w") as out_handle:
-            for title, seq, qual in FastqGeneralIterator(in_handle):
-                cur_adaptor = (adaptor_seq[:(len(rec) - max_size)] if max_size
-                        else adaptor_seq)
-                trim = trim_adaptor(seq, cur_adaptor, num_errors)
-                cur_max = max_size if max_size else len(seq) - 1
-                if len(trim) >= min_size and len(trim) <= cur_max:
-                    pos = seq.find(trim)
-                    assert pos >= 0
-                    trim_qual = qual[pos:pos+len(trim)]
-                    out_handle.write("@%s\n%s\n+\n%s\n" % (title, trim,
-                        trim_qual))
+            for text, cur_lengths in _trim_batches(
+                    FastqGeneralIterator(in_handle), trim_args, cores):
+                out_handle.write(text)
+                for size, count in cur_lengths.iteritems():
+                    lengths[size] += count
+    if hist_file:
+        with open(hist_file, "w") as out_handle:
+            for size in sorted(lengths.keys()):
+                out_handle.write("%s\t%s\n" % (size, lengths[size]))
+    return dict(lengths)
+
+def _trim_batches(recs, trim_args, cores=1, batch_size=50000):
+    """Trim batches of fastq records, in multiple processes if specified.
+
+    Yields output fastq text and counts of trimmed lengths in input order.
+    """
+    batches = iter(lambda: list(itertools.islice(recs, batch_size)), [])
+    if cores <= 1:
+        for batch in batches:
+            yield _trim_batch(batch, *trim_args)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(cores)
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                pending.append(pool.apply_async(_trim_batch,
+                                                (batch,) + trim_args))
+                while len(pending) >= 2 * cores:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+def _trim_batch(recs, adaptor_seq, num_errors, min_size, max_size, fast):
+    """Trim adaptors from a batch of (title, seq, qual) fastq records.
+    """
+    out = []
+    lengths = collections.defaultdict(int)
+    for title, seq, qual in recs:
+        cur_adaptor = adaptor_seq
+        if max_size and len(seq) > max_size:
+            cur_adaptor = adaptor_seq[:(len(seq) - max_size)]
+        if fast:
+            start, end = _trim_region_fast(seq, cur_adaptor, num_errors)
+            trim = seq[start:end]
+            trim_qual = qual[start:end]
+        else:
+            trim = trim_adaptor(seq, cur_adaptor, num_errors)
+            pos = seq.find(trim)
+            assert pos >= 0
+            trim_qual = qual[pos:pos+len(trim)]
+        lengths[len(trim)] += 1
+        cur_max = max_size if max_size else len(seq) - 1
+        if len(trim) >= min_size and len(trim) <= cur_max:
+            out.append("@%s\n%s\n+\n%s\n" % (title, trim, trim_qual))
+    return "".join(out), dict(lengths)
 
 def _remove_adaptor(seq, region, right_side=True):
     """Remove an adaptor region and all sequence to the right or left.
@@ -106,6 +164,90 @@ def trim_adaptor(seq, adaptor, num_errors, right_side=True):
         return _remove_adaptor(seq, seq_region.replace(gap_char, ""),
                 right_side)
 
+def trim_adaptor_fast(seq, adaptor, num_errors, right_side=True):
+    """Trim an adaptor using k-mer seeds and a bit-parallel edit distance search.
+
+    Works like trim_adaptor with num_errors as the maximum edit distance
+    between the adaptor and the read, including adaptor bases running off
+    the end of the read. If the adaptor is split into num_errors + 1 pieces,
+    any match has at least one of them exactly, so reads without any piece
+    are passed through without searching. Matches are then found with
+    Myers' bit-vector algorithm.
+    """
+    if right_side:
+        start, end = _trim_region_fast(str(seq), adaptor, num_errors)
+    else:
+        rstart, rend = _trim_region_fast(str(seq)[::-1], adaptor[::-1],
+                                         num_errors)
+        start, end = len(seq) - rend, len(seq) - rstart
+    return seq[start:end]
+
+def _trim_region_fast(seq, adaptor, num_errors):
+    """Retrieve the start and end of sequence remaining on adaptor removal.
+    """
+    exact_pos = seq.find(adaptor)
+    if exact_pos >= 0:
+        return 0, exact_pos
+    if num_errors >= len(adaptor):
+        return 0, 0
+    piece_size = len(adaptor) // (num_errors + 1)
+    if not any(adaptor[i * piece_size:(i + 1) * piece_size] in seq
+               for i in range(num_errors + 1)):
+        return 0, len(seq)
+    score, end = _myers_best_end(seq, adaptor, num_errors)
+    if end is None:
+        return 0, len(seq)
+    return 0, _match_start(seq, adaptor, end, score)
+
+def _myers_best_end(seq, pattern, max_errors):
+    """Find the leftmost end of the lowest edit distance match of a pattern.
+
+    Returns the edit distance and end position, or a None position if there
+    are no matches within max_errors.
+    """
+    size = len(pattern)
+    full = (1 << size) - 1
+    last = 1 << (size - 1)
+    peq = {}
+    for i, base in enumerate(pattern):
+        peq[base] = peq.get(base, 0) | (1 << i)
+    pv, mv, score = full, 0, size
+    best_score, best_end = max_errors + 1, None
+    for j, base in enumerate(seq):
+        eq = peq.get(base, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = (ph << 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+        if score < best_score:
+            best_score, best_end = score, j
+    return best_score, best_end
+
+def _match_start(seq, pattern, end, score):
+    """Find the closest start of a pattern match ending at a sequence position.
+    """
+    window = seq[max(0, end + 1 - len(pattern) - score):end + 1][::-1]
+    rpattern = pattern[::-1]
+    prev = range(len(window) + 1)
+    for i, pbase in enumerate(rpattern):
+        cur = [i + 1]
+        for j, sbase in enumerate(window):
+            cur.append(min(prev[j] + (pbase != sbase), prev[j + 1] + 1,
+                           cur[j] + 1))
+        prev = cur
+    for j, dist in enumerate(prev):
+        if dist <= score:
+            return end + 1 - j
+    return end + 1 - len(window)
+
 def trim_adaptor_w_qual(seq, qual, adaptor, num_errors, right_side=True):
     """Trim an adaptor with an associated quality string.
 
@@ -211,6 +353,28 @@ class AdaptorAlignTrimTest(unittest.TestCase):
         tseq = trim_adaptor(to_trim, adaptor, 2)
         assert tseq == to_trim
 
+    def t_7_fast_trim(self):
+        """Trim adaptors with the k-mer seeded bit-parallel search.
+        """
+        adaptor = "GATCGATCGATC"
+        for region, expected in [(adaptor, "GGG"), ("GATCGTTCGATC", "GGG"),
+                                 ("GATCGTTCGAAC", "GGG"),
+                                 ("GATCGATCGTC", "GGG"),
+                                 ("GACGATCGTC", "GGG"),
+                                 ("CATCGGACGTAT", "GGGCATCGGACGTATCCC")]:
+            tseq = trim_adaptor_fast("GGG" + region + "CCC", adaptor, 2)
+            assert tseq == expected, (region, tseq)
+        tseq = trim_adaptor_fast("GGG" + "GATCGTTCGATC" + "CCC", adaptor, 2,
+                                 False)
+        assert tseq == "CCC", tseq
+        tseq = trim_adaptor_fast("GGGGATCGATCGATCCCC", "GATCGATC", 2)
+        assert tseq == "GGG", tseq
+        # adaptor running off the end of the read
+        tseq = trim_adaptor_fast("TTTTTTTTGATCGATCGA", adaptor, 2)
+        assert tseq == "TTTTTTTT", tseq
+        tseq = trim_adaptor_fast("TTTTTTTTTTTTTTTTT", "AAAAAAAAAAAAAA", 2)
+        assert tseq == "TTTTTTTTTTTTTTTTT"
+
 def run_tests(argv):
     test_suite = testing_suite()
     runner = unittest.TextTestRunner(sys.stdout, verbosity = 2)
@@ -232,10 +396,17 @@ if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-m", "--min_size", dest="min_size", default=1)
     parser.add_option("-x", "--max_size", dest="max_size")
+    parser.add_option("-f", "--fast", dest="fast", action="store_true",
+                      default=False)
+    parser.add_option("-c", "--cores", dest="cores", default=1)
+    parser.add_option("-g", "--histogram", dest="hist_file", default=None)
     options, args = parser.parse_args()
     if len(args) == 0:
         sys.exit(run_tests(sys.argv))
     else:
         kwd = dict(min_size = options.min_size,
-                   max_size = options.max_size)
+                   max_size = options.max_size,
+                   fast = options.fast,
+                   cores = options.cores,
+                   hist_file = options.hist_file)
         main(*args, **kwd)
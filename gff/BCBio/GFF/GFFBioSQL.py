@@ -0,0 +1,237 @@
+"""Bulk loading of GFF annotated SeqRecords into a BioSQL database.
+
+Biopython's BioSQL loader inserts records a row at a time. For full genome
+annotations this class instead batches rows for each table and writes them
+with executemany inside a single transaction:
+
+- Primary keys are assigned here, continuing from the current maximum, so
+  rows can reference each other without a query per insert. This assumes
+  no other process writes to the database during the load.
+- Features are stored as Biopython's BioSQL Loader stores them: each top
+  level feature is a seqfeature, and its sub features become its locations.
+  Records read back through BioSeqDatabase match those loaded with db.load.
+- With SQLite, secondary indexes on the feature tables are dropped during
+  the load and recreated at the end. SQLite DDL is transactional, so the
+  loader begins the transaction itself to keep the drops inside it; Python's
+  sqlite3 module would otherwise commit before each DROP INDEX.
+
+It works on any DB-API connection to a BioSQL schema; for a Biopython
+BioSQL server object use server.adaptor.conn and server.module.paramstyle.
+
+http://biosql.org
+"""
+from Bio.Seq import UnknownSeq
+
+_feature_tables = ["seqfeature", "location", "seqfeature_qualifier_value"]
+
+class BioSQLBulkLoader:
+    """Load SeqRecords into BioSQL with batched multi-row inserts.
+    """
+    def __init__(self, conn, paramstyle="qmark", batch_size=10000):
+        """Initialize loader.
+
+        conn - A DB-API connection to a database with the BioSQL schema.
+        paramstyle - The DB-API paramstyle of the driver module.
+        batch_size - Number of rows held for each table before writing.
+        """
+        self._conn = conn
+        self._cursor = conn.cursor()
+        self._placeholder = "?" if paramstyle == "qmark" else "%s"
+        self._batch_size = batch_size
+        self._term_ids = dict()
+        self._ontology_ids = dict()
+        self._rows = dict()
+        self._insert_sql = dict()
+        self.row_counts = dict()
+
+    def load(self, biodb_name, recs):
+        """Load records into the named sub-database, creating it if needed.
+
+        Everything is written in one transaction, which is rolled back on
+        errors. Returns the number of records loaded.
+        """
+        deferred = []
+        is_sqlite = self._is_sqlite()
+        if is_sqlite:
+            isolation_level = self._conn.isolation_level
+            self._conn.isolation_level = None
+            self._cursor.execute("BEGIN")
+        try:
+            biodb_id = self._get_biodb_id(biodb_name)
+            self._next_ids = dict()
+            for table, id_col in [("bioentry", "bioentry_id"),
+                    ("seqfeature", "seqfeature_id"),
+                    ("location", "location_id")]:
+                self._next_ids[table] = self._max_id(table, id_col) + 1
+            deferred = self._drop_indexes()
+            num_recs = 0
+            for rec in recs:
+                self._add_rec(biodb_id, rec)
+                num_recs += 1
+            self._flush_all()
+            for create_sql in deferred:
+                self._cursor.execute(create_sql)
+            if is_sqlite:
+                self._cursor.execute("COMMIT")
+            else:
+                self._conn.commit()
+        except:
+            if is_sqlite:
+                self._cursor.execute("ROLLBACK")
+            else:
+                self._conn.rollback()
+            for table in self._rows:
+                self._rows[table] = []
+            raise
+        finally:
+            if is_sqlite:
+                self._conn.isolation_level = isolation_level
+        return num_recs
+
+    def _is_sqlite(self):
+        return self._conn.__class__.__module__.startswith("sqlite3")
+
+    def _sql(self, sql):
+        return sql.replace("?", self._placeholder)
+
+    def _max_id(self, table, id_col):
+        self._cursor.execute("SELECT MAX(%s) FROM %s" % (id_col, table))
+        max_id = self._cursor.fetchone()[0]
+        return int(max_id or 0)
+
+    def _next_id(self, table):
+        cur_id = self._next_ids[table]
+        self._next_ids[table] += 1
+        return cur_id
+
+    def _drop_indexes(self):
+        """Drop SQLite indexes on feature tables, returning SQL to recreate.
+        """
+        if not self._is_sqlite():
+            return []
+        self._cursor.execute("SELECT name, sql FROM sqlite_master WHERE "
+                "type = 'index' AND sql IS NOT NULL AND tbl_name IN (%s)" %
+                ", ".join(["'%s'" % t for t in _feature_tables]))
+        indexes = self._cursor.fetchall()
+        for name, _ in indexes:
+            self._cursor.execute("DROP INDEX %s" % name)
+        return [create_sql for _, create_sql in indexes]
+
+    def _get_biodb_id(self, biodb_name):
+        self._cursor.execute(self._sql("SELECT biodatabase_id FROM "
+            "biodatabase WHERE name = ?"), (biodb_name,))
+        row = self._cursor.fetchone()
+        if row is None:
+            self._cursor.execute(self._sql("INSERT INTO biodatabase (name) "
+                "VALUES (?)"), (biodb_name,))
+            return self._get_biodb_id(biodb_name)
+        return row[0]
+
+    def _get_ontology_id(self, name):
+        try:
+            return self._ontology_ids[name]
+        except KeyError:
+            pass
+        select_sql = self._sql("SELECT ontology_id FROM ontology "
+                "WHERE name = ?")
+        self._cursor.execute(select_sql, (name,))
+        row = self._cursor.fetchone()
+        if row is None:
+            self._cursor.execute(self._sql("INSERT INTO ontology (name) "
+                "VALUES (?)"), (name,))
+            self._cursor.execute(select_sql, (name,))
+            row = self._cursor.fetchone()
+        self._ontology_ids[name] = row[0]
+        return row[0]
+
+    def _get_term_id(self, name, ontology):
+        key = (name, ontology)
+        try:
+            return self._term_ids[key]
+        except KeyError:
+            pass
+        ontology_id = self._get_ontology_id(ontology)
+        select_sql = self._sql("SELECT term_id FROM term WHERE name = ? "
+                "AND ontology_id = ?")
+        self._cursor.execute(select_sql, (name, ontology_id))
+        row = self._cursor.fetchone()
+        if row is None:
+            self._cursor.execute(self._sql("INSERT INTO term (name, "
+                "ontology_id) VALUES (?, ?)"), (name, ontology_id))
+            self._cursor.execute(select_sql, (name, ontology_id))
+            row = self._cursor.fetchone()
+        self._term_ids[key] = row[0]
+        return row[0]
+
+    def _add_row(self, table, columns, values):
+        if not self._insert_sql.has_key(table):
+            self._insert_sql[table] = self._sql("INSERT INTO %s (%s) "
+                    "VALUES (%s)" % (table, ", ".join(columns),
+                        ", ".join(["?"] * len(columns))))
+            self._rows[table] = []
+        self._rows[table].append(values)
+        if len(self._rows[table]) >= self._batch_size:
+            self._flush_all()
+
+    def _flush(self, table):
+        rows = self._rows.get(table, [])
+        if rows:
+            self._cursor.executemany(self._insert_sql[table], rows)
+            self.row_counts[table] = self.row_counts.get(table, 0) + len(rows)
+            self._rows[table] = []
+
+    def _flush_all(self):
+        # parent tables first to satisfy foreign key constraints
+        for table in ["bioentry", "biosequence", "bioentry_qualifier_value",
+                "seqfeature", "location", "seqfeature_qualifier_value"]:
+            self._flush(table)
+
+    def _add_rec(self, biodb_id, rec):
+        bioentry_id = self._next_id("bioentry")
+        self._add_row("bioentry", ["bioentry_id", "biodatabase_id", "name",
+            "accession", "identifier", "division", "description", "version"],
+            (bioentry_id, biodb_id, rec.name or rec.id, rec.id, None, "UNK",
+             rec.description, 0))
+        if not isinstance(rec.seq, UnknownSeq) and len(rec.seq) > 0:
+            self._add_row("biosequence", ["bioentry_id", "version", "length",
+                "alphabet", "seq"], (bioentry_id, 0, len(rec.seq), "dna",
+                    str(rec.seq)))
+        for key, vals in rec.annotations.items():
+            if not isinstance(vals, (list, tuple)):
+                vals = [vals]
+            term_id = self._get_term_id(key, "Annotation Tags")
+            for rank, val in enumerate(vals):
+                if isinstance(val, (str, int, float)):
+                    self._add_row("bioentry_qualifier_value",
+                            ["bioentry_id", "term_id", "value", "rank"],
+                            (bioentry_id, term_id, str(val), rank + 1))
+        for rank, feature in enumerate(rec.features):
+            self._add_feature(bioentry_id, feature, rank + 1)
+
+    def _add_feature(self, bioentry_id, feature, rank):
+        seqfeature_id = self._next_id("seqfeature")
+        source = feature.qualifiers.get("source", ["GFF"])
+        if isinstance(source, (list, tuple)):
+            source = source[0]
+        self._add_row("seqfeature", ["seqfeature_id", "bioentry_id",
+            "type_term_id", "source_term_id", "rank"],
+            (seqfeature_id, bioentry_id,
+             self._get_term_id(feature.type, "SeqFeature Keys"),
+             self._get_term_id(source, "SeqFeature Sources"), rank))
+        # sub features are stored as the locations of their parent
+        for loc_rank, loc_feature in enumerate(feature.sub_features or
+                [feature]):
+            self._add_row("location", ["location_id", "seqfeature_id",
+                "strand", "start_pos", "end_pos", "rank"],
+                (self._next_id("location"), seqfeature_id,
+                 loc_feature.strand or 0,
+                 loc_feature.location.nofuzzy_start + 1,
+                 loc_feature.location.nofuzzy_end, loc_rank + 1))
+        for key, vals in feature.qualifiers.items():
+            if not isinstance(vals, (list, tuple)):
+                vals = [vals]
+            term_id = self._get_term_id(key, "Annotation Tags")
+            for val_rank, val in enumerate(vals):
+                self._add_row("seqfeature_qualifier_value", ["seqfeature_id",
+                    "term_id", "rank", "value"],
+                    (seqfeature_id, term_id, val_rank + 1, str(val)))
@@ -0,0 +1,281 @@
+"""Indexed random access to features in GFF files.
+
+A GFF file is indexed once, writing sidecar files next to it:
+
+- an interval index (bx-python interval_index_file) of the regions covered
+  by each parent/child feature tree.
+- a SQLite database mapping feature IDs to trees and trees to the byte
+  offsets of their lines in the GFF file.
+
+Queries then read only the lines of the trees they need and parse them with
+the standard GFFParser, so returned features have their full nesting.
+
+Requires:
+    bx-python: http://bitbucket.org/james_taylor/bx-python/wiki/Home
+"""
+import os
+import sqlite3
+
+from GFFParser import GFFParser, GFFExaminer, _gff_line_map, _file_signature
+
+def _index_files(gff_file):
+    return gff_file + ".gffidx", gff_file + ".gffidx.intervals"
+
+class _FeatureTrees:
+    """Group GFF lines into connected parent/child trees while indexing.
+
+    Lines are joined through a union-find on (seqid, ID) keys, with each tree
+    tracking its region and the offsets of its lines.
+    """
+    def __init__(self):
+        self._parents = dict()
+        self._trees = dict()
+
+    def _find(self, key):
+        root = key
+        while self._parents[root] != root:
+            root = self._parents[root]
+        while self._parents[key] != root:
+            self._parents[key], key = root, self._parents[key]
+        return root
+
+    def _union(self, key1, key2):
+        root1, root2 = self._find(key1), self._find(key2)
+        if root1 == root2:
+            return root1
+        tree1, tree2 = self._trees[root1], self._trees[root2]
+        if len(tree1[2]) < len(tree2[2]):
+            root1, root2 = root2, root1
+            tree1, tree2 = tree2, tree1
+        self._parents[root2] = root1
+        tree1[0] = min(tree1[0], tree2[0])
+        tree1[1] = max(tree1[1], tree2[1])
+        tree1[2].extend(tree2[2])
+        del self._trees[root2]
+        return root1
+
+    def _add_key(self, key, start, end):
+        if not self._parents.has_key(key):
+            self._parents[key] = key
+            self._trees[key] = [start, end, []]
+
+    def add(self, offset, line_info):
+        seqid = line_info['rec_id']
+        start, end = line_info['location']
+        keys = [(seqid, p) for p in line_info['quals'].get('Parent', [])]
+        if line_info['id']:
+            keys.insert(0, (seqid, line_info['id']))
+        if not keys:
+            keys = [(seqid, offset)]
+        for key in keys:
+            self._add_key(key, start, end)
+        root = keys[0]
+        for key in keys[1:]:
+            root = self._union(root, key)
+        tree = self._trees[self._find(root)]
+        tree[0] = min(tree[0], start)
+        tree[1] = max(tree[1], end)
+        tree[2].append(offset)
+
+    def trees(self):
+        """Retrieve (key, seqid, start, end, offsets) for all trees.
+        """
+        for key, (start, end, offsets) in self._trees.iteritems():
+            offsets.sort()
+            yield key, key[0], start, end, offsets
+
+    def tree_key(self, seqid, feature_id):
+        return self._find((seqid, feature_id))
+
+def index_gff(gff_file):
+    """Build the sidecar index files for a GFF file.
+
+    Returns the names of the SQLite and interval index files.
+    """
+    from bx import interval_index_file
+    db_file, interval_file = _index_files(gff_file)
+    params = GFFExaminer()._get_local_params()
+    trees = _FeatureTrees()
+    id_seqids = []
+    in_handle = open(gff_file)
+    try:
+        while 1:
+            offset = in_handle.tell()
+            line = in_handle.readline()
+            if not line or line.startswith("##FASTA"):
+                break
+            results = _gff_line_map(line, params)
+            if results and results[0][0] in ['parent', 'child', 'feature']:
+                line_info = results[0][1]
+                trees.add(offset, line_info)
+                if line_info['id']:
+                    id_seqids.append((line_info['id'], line_info['rec_id']))
+    finally:
+        in_handle.close()
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE tree (tree_id INTEGER PRIMARY KEY, "
+                     "seqid TEXT, start INTEGER, end INTEGER, offsets TEXT)")
+        conn.execute("CREATE TABLE feature_id (id TEXT, tree_id INTEGER)")
+        intervals = interval_index_file.Indexes()
+        tree_ids = dict()
+        for tree_id, (key, seqid, start, end, offsets) in \
+                enumerate(trees.trees()):
+            tree_ids[key] = tree_id
+            conn.execute("INSERT INTO tree VALUES (?, ?, ?, ?, ?)",
+                    (tree_id, seqid, start, end,
+                     ",".join([str(o) for o in offsets])))
+            intervals.add(seqid, start, end, tree_id)
+        seen = set()
+        for feature_id, seqid in id_seqids:
+            tree_id = tree_ids[trees.tree_key(seqid, feature_id)]
+            if (feature_id, tree_id) not in seen:
+                seen.add((feature_id, tree_id))
+                conn.execute("INSERT INTO feature_id VALUES (?, ?)",
+                        (feature_id, tree_id))
+        conn.execute("CREATE INDEX feature_id_idx ON feature_id (id)")
+        conn.execute("INSERT INTO meta VALUES (?, ?)",
+                ("signature", _file_signature(gff_file)))
+        conn.commit()
+    finally:
+        conn.close()
+    out_handle = open(interval_file, "w")
+    try:
+        intervals.write(out_handle)
+    finally:
+        out_handle.close()
+    return db_file, interval_file
+
+def _index_is_current(gff_file):
+    db_file, interval_file = _index_files(gff_file)
+    if not (os.path.exists(db_file) and os.path.exists(interval_file)):
+        return False
+    conn = sqlite3.connect(db_file)
+    try:
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?",
+                    ("signature",)).fetchone()
+        except sqlite3.DatabaseError:
+            return False
+    finally:
+        conn.close()
+    return row is not None and row[0] == _file_signature(gff_file)
+
+def seqid_offsets(gff_file, seqids):
+    """Retrieve sorted offsets of feature lines on the given sequences.
+
+    Returns None if the file does not have an up to date index.
+    """
+    if not _index_is_current(gff_file):
+        return None
+    db_file, _ = _index_files(gff_file)
+    conn = sqlite3.connect(db_file)
+    offsets = []
+    try:
+        for seqid in seqids:
+            for (tree_offsets,) in conn.execute(
+                    "SELECT offsets FROM tree WHERE seqid = ?", (seqid,)):
+                offsets.extend([int(o) for o in tree_offsets.split(",")])
+    finally:
+        conn.close()
+    offsets.sort()
+    return offsets
+
+class GFFIndexedReader:
+    """Answer region and ID queries on a GFF file without a full parse.
+
+    The sidecar index is built on first use, and rebuilt if the GFF file
+    changes size or modification time.
+    """
+    def __init__(self, gff_file, rebuild=False):
+        from bx import interval_index_file
+        self._gff_file = gff_file
+        if rebuild or not _index_is_current(gff_file):
+            index_gff(gff_file)
+        db_file, interval_file = _index_files(gff_file)
+        self._db = sqlite3.connect(db_file)
+        self._intervals = interval_index_file.Indexes(interval_file)
+        self._handle = open(gff_file)
+        self._parser = GFFParser()
+
+    def close(self):
+        self._handle.close()
+        self._db.close()
+
+    @property
+    def seqids(self):
+        return [r[0] for r in
+                self._db.execute("SELECT DISTINCT seqid FROM tree")]
+
+    def features_in_region(self, seqid, start, end, limit_info=None):
+        """Retrieve nested features overlapping a region.
+
+        start and end are zero based, half open coordinates as in
+        SeqFeature locations.
+        """
+        if seqid not in self._intervals.indexes:
+            return []
+        tree_ids = set([val for (_, _, val) in
+                self._intervals.find(seqid, int(start), int(end))])
+        features = self._tree_features(tree_ids, limit_info).get(seqid, [])
+        return [f for f in features if f.location.nofuzzy_end > start and
+                f.location.nofuzzy_start < end]
+
+    def features_on_seqids(self, seqids, limit_info=None):
+        """Retrieve nested features on a set of sequence IDs.
+
+        Only the lines of trees on the requested sequences are read, so
+        a parse limited to a single chromosome skips the rest of the file.
+        """
+        tree_ids = []
+        for seqid in seqids:
+            tree_ids.extend([r[0] for r in self._db.execute(
+                "SELECT tree_id FROM tree WHERE seqid = ?", (seqid,))])
+        return self._tree_features(tree_ids, limit_info)
+
+    def feature_by_id(self, feature_id):
+        """Retrieve the feature with the given ID, including sub features.
+        """
+        tree_ids = [r[0] for r in self._db.execute(
+                "SELECT tree_id FROM feature_id WHERE id = ?", (feature_id,))]
+        for features in self._tree_features(tree_ids).values():
+            found = self._find_feature(features, feature_id)
+            if found is not None:
+                return found
+        raise KeyError(feature_id)
+
+    def _find_feature(self, features, feature_id):
+        for feature in features:
+            if feature.id == feature_id:
+                return feature
+            found = self._find_feature(feature.sub_features, feature_id)
+            if found is not None:
+                return found
+        return None
+
+    def _tree_features(self, tree_ids, limit_info=None):
+        """Parse the lines of a set of trees, returning features by seqid.
+        """
+        offsets = []
+        for tree_id in tree_ids:
+            row = self._db.execute("SELECT offsets FROM tree WHERE "
+                    "tree_id = ?", (tree_id,)).fetchone()
+            offsets.extend([int(o) for o in row[0].split(",")])
+        offsets.sort()
+        limit_info = self._parser._normalize_limit_info(limit_info)
+        recs = dict()
+        for results in self._parser._lines_to_out_info(
+                self._read_lines(offsets), limit_info):
+            recs = self._parser._results_to_features(recs, results)
+        out = dict()
+        for rec_id, rec in recs.items():
+            out[rec_id] = rec.features
+        return out
+
+    def _read_lines(self, offsets):
+        for offset in offsets:
+            self._handle.seek(offset)
+            yield self._handle.readline()
@@ -2,18 +2,29 @@
 
 The target format is GFF3, the current GFF standard:
     http://www.sequenceontology.org/gff3.shtml
+
+Records are written as they are retrieved, so an iterator of records can be
+converted without holding all of them in memory. Sequences for the trailing
+##FASTA section are spooled to a temporary file in the meantime.
 """
+import re
+import shutil
+import tempfile
 import urllib
+import cStringIO
 
 from Bio import SeqIO
 
+# characters left unchanged by urllib.quote
+_needs_quote_pat = re.compile("[^A-Za-z0-9_.\-/]")
+
 class _IdHandler:
     """Generate IDs for GFF3 Parent/Child relationships where they don't exist.
     """
     def __init__(self):
         self._prefix = "biopygen"
         self._counter = 1
-        self._seen_ids = []
+        self._seen_ids = set()
 
     def _generate_id(self, quals):
         """Generate a unique ID not present in our existing IDs.
@@ -52,11 +63,11 @@ class _IdHandler:
             if not isinstance(cur_id, list) and not isinstance(cur_id, tuple):
                 cur_id = [cur_id]
             for add_id in cur_id:
-                self._seen_ids.append(add_id)
+                self._seen_ids.add(add_id)
         # if we need one and don't have it, create a new one
         elif has_children:
             new_id = self._generate_id(quals)
-            self._seen_ids.append(new_id)
+            self._seen_ids.add(new_id)
             quals["ID"] = [new_id]
         return quals
 
@@ -68,25 +79,36 @@ class GFF3Writer:
 
     def write(self, recs, out_handle, include_fasta=False):
         """Write the provided records to the given handle in GFF3 format.
+
+        recs can be a single SeqRecord, a list or any iterator of records.
         """
         id_handler = _IdHandler()
         self._write_header(out_handle)
-        fasta_recs = []
+        fasta_spool = None
         try:
             recs = iter(recs)
         except TypeError:
             recs = [recs]
-        for rec in recs:
-            self._write_rec(rec, out_handle)
-            self._write_annotations(rec.annotations, rec.id, len(rec.seq), out_handle)
-            for sf in rec.features:
-                sf = self._clean_feature(sf)
-                id_handler = self._write_feature(sf, rec.id, out_handle,
-                        id_handler)
-            if include_fasta and len(rec.seq) > 0:
-                fasta_recs.append(rec)
-        if len(fasta_recs) > 0:
-            self._write_fasta(fasta_recs, out_handle)
+        try:
+            for rec in recs:
+                rec_handle = cStringIO.StringIO()
+                self._write_rec(rec, rec_handle)
+                self._write_annotations(rec.annotations, rec.id,
+                        len(rec.seq), rec_handle)
+                for sf in rec.features:
+                    sf = self._clean_feature(sf)
+                    id_handler = self._write_feature(sf, rec.id, rec_handle,
+                            id_handler)
+                out_handle.write(rec_handle.getvalue())
+                if include_fasta and len(rec.seq) > 0:
+                    if fasta_spool is None:
+                        fasta_spool = tempfile.TemporaryFile()
+                    SeqIO.write([rec], fasta_spool, "fasta")
+            if fasta_spool is not None:
+                self._write_fasta(fasta_spool, out_handle)
+        finally:
+            if fasta_spool is not None:
+                fasta_spool.close()
 
     def _clean_feature(self, feature):
         quals = {}
@@ -162,7 +184,10 @@ class GFF3Writer:
             if not isinstance(values, list) or isinstance(values, tuple):
                 values = [values]
             for val in values:
-                val = urllib.quote(str(val).strip())
+                val = str(val).strip()
+                # only escape values with characters that need it
+                if _needs_quote_pat.search(val):
+                    val = urllib.quote(val)
                 if ((key and val) and val not in format_vals):
                     format_vals.append(val)
             format_kvs.append("%s=%s" % (key, ",".join(format_vals)))
@@ -182,11 +207,12 @@ class GFF3Writer:
         """
         out_handle.write("##gff-version 3\n")
 
-    def _write_fasta(self, recs, out_handle):
-        """Write sequence records using the ##FASTA directive.
+    def _write_fasta(self, fasta_handle, out_handle):
+        """Write spooled sequence records using the ##FASTA directive.
         """
         out_handle.write("##FASTA\n")
-        SeqIO.write(recs, out_handle, "fasta")
+        fasta_handle.seek(0)
+        shutil.copyfileobj(fasta_handle, out_handle)
 
 def write(recs, out_handle, include_fasta=False):
     """High level interface to write GFF3 files from SeqRecords and SeqFeatures.
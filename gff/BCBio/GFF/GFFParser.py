@@ -13,7 +13,8 @@ http://mblab.wustl.edu/GTF22.html
 The implementation utilizes map/reduce parsing of GFF using Disco. Disco
 (http://discoproject.org) is a Map-Reduce framework for Python utilizing
 Erlang for parallelization. The code works on a single processor without
-Disco using the same architecture.
+Disco using the same architecture. Local multi-processor machines can use
+the same map and reduce functions through the multiprocessing module.
 """
 import os
 import copy
@@ -21,6 +22,9 @@ import re
 import collections
 import urllib
 import itertools
+import mmap
+import array
+import cPickle
 
 # Make defaultdict compatible with versions of python older than 2.4
 try:
@@ -34,6 +38,182 @@ from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import SeqFeature, FeatureLocation
 from Bio import SeqIO
 
+_gff3_kw_pat = re.compile("\w+=")
+_strand_map = {'+' : 1, '-' : -1, '?' : None, None: None}
+
+def _split_keyvals(keyval_str):
+    """Split key-value pairs in a GFF2, GTF and GFF3 compatible way.
+
+    GFF3 has key value pairs like:
+      count=9;gene=amx-2;sequence=SAGE:aacggagccg
+    GFF2 and GTF have:
+      Sequence "Y74C9A" ; Note "Clone Y74C9A; Genbank AC024206"
+      name "fgenesh1_pg.C_chr_1000003"; transcriptId 869
+
+    The common GFF3 and Ensembl GTF layouts are handled by a fast
+    tokenizer; anything it does not recognize goes through the tolerant
+    splitting code.
+    """
+    if keyval_str is None:
+        return collections.defaultdict(list), False
+    out = _fast_split_keyvals(keyval_str)
+    if out is None:
+        out = _tolerant_split_keyvals(keyval_str)
+    return out
+
+def _fast_split_keyvals(keyval_str):
+    """Tokenize well-formed GFF3 or GTF attributes, or return None.
+
+    Handles GFF3 'key=val;key=val' and GTF 'key "val"; key "val";' with
+    single separators and no stray semi-colons. Returns the same output
+    as _tolerant_split_keyvals for these inputs.
+    """
+    if keyval_str[-1:] == ';':
+        keyval_str = keyval_str[:-1]
+    if not keyval_str or " ; " in keyval_str:
+        return None
+    if "; " in keyval_str:
+        parts = keyval_str.split("; ")
+        if _gff3_kw_pat.match(parts[0]):
+            return None
+        is_gff2 = True
+    else:
+        parts = keyval_str.split(";")
+        if not _gff3_kw_pat.match(parts[0]):
+            return None
+        is_gff2 = False
+    quals = collections.defaultdict(list)
+    for p in parts:
+        if is_gff2:
+            if p[:1] == ';':
+                return None
+            key, _, val = p.strip().partition(" ")
+        else:
+            if p.count("=") != 1:
+                return None
+            key, _, val = p.partition("=")
+        if (len(val) > 0 and val[0] == '"' and val[-1] == '"'):
+            val = val[1:-1]
+        if val:
+            if "," in val:
+                vals = [v for v in val.split(',') if v]
+            else:
+                vals = [val]
+            if "%" in val:
+                vals = [urllib.unquote(v) for v in vals]
+            quals[key].extend(vals)
+        else:
+            quals[key].append('true')
+    return quals, is_gff2
+
+def _tolerant_split_keyvals(keyval_str):
+    """Split key-value pairs, coping with the many out-of-spec layouts.
+    """
+    quals = collections.defaultdict(list)
+    # ensembl GTF has a stray semi-colon at the end
+    if keyval_str[-1] == ';':
+        keyval_str = keyval_str[:-1]
+    # GFF2/GTF has a semi-colon with at least one space after it.
+    # It can have spaces on both sides; wormbase does this.
+    # GFF3 works with no spaces.
+    # Split at the first one we can recognize as working
+    parts = keyval_str.split(" ; ")
+    if len(parts) == 1:
+        parts = keyval_str.split("; ")
+        if len(parts) == 1:
+            parts = keyval_str.split(";")
+    # check if we have GFF3 style key-vals (with =)
+    is_gff2 = True
+    if _gff3_kw_pat.match(parts[0]):
+        is_gff2 = False
+        key_vals = [p.split('=') for p in parts]
+    # otherwise, we are separated by a space with a key as the first item
+    else:
+        pieces = []
+        for p in parts:
+            # fix misplaced semi-colons in keys in some GFF2 files
+            if p and p[0] == ';':
+                p = p[1:]
+            pieces.append(p.strip().split(" "))
+        key_vals = [(p[0], " ".join(p[1:])) for p in pieces]
+    for item in key_vals:
+        # standard in-spec items are key=value
+        if len(item) == 2:
+            key, val = item
+        # out-of-spec files can have just key values. We set an empty value
+        # which will be changed to true later to standardize.
+        else:
+            assert len(item) == 1, item
+            key = item[0]
+            val = ''
+        # remove quotes in GFF2 files
+        if (len(val) > 0 and val[0] == '"' and val[-1] == '"'):
+            val = val[1:-1]
+        if val:
+            quals[key].extend([v for v in val.split(',') if v])
+        # if we don't have a value, make this a key=True/False style
+        # attribute
+        else:
+            quals[key].append('true')
+    for key, vals in quals.items():
+        quals[key] = [urllib.unquote(v) for v in vals]
+    return quals, is_gff2
+
+class _LimitFilter:
+    """Compiled form of limit_info for cheap rejection of GFF lines.
+
+    Limit values are held in sets, and lines are only split as far as the
+    last column used by a limit, so rejected lines never have their
+    remaining columns or attributes split.
+    """
+    def __init__(self, limit_info, filter_info):
+        self._checks = []
+        max_index = 0
+        for limit_name, limit_values in limit_info.items():
+            indexes = tuple(filter_info[limit_name])
+            if len(indexes) == 1:
+                values = set([v[0] for v in limit_values])
+            else:
+                values = set([tuple(v) for v in limit_values])
+            self._checks.append((indexes, values))
+            max_index = max([max_index] + list(indexes))
+        self._max_splits = max_index + 1
+
+    def passes(self, line):
+        return self.passes_parts(line.split('\t', self._max_splits))
+
+    def passes_parts(self, parts):
+        for indexes, values in self._checks:
+            if len(indexes) == 1:
+                cur_id = parts[indexes[0]]
+            else:
+                cur_id = tuple([parts[i] for i in indexes])
+            if cur_id not in values:
+                return False
+        return True
+
+def _passes_limits(parts, params):
+    """Check if the tab split parts of a line pass the supplied limits.
+    """
+    line_filter = getattr(params, "line_filter", None)
+    if line_filter is not None:
+        return line_filter.passes_parts(parts)
+    if params.limit_info:
+        for limit_name, limit_values in params.limit_info.items():
+            cur_id = tuple([parts[i] for i in
+                params.filter_info[limit_name]])
+            if cur_id not in limit_values:
+                return False
+    return True
+
+def _line_passes_limits(line, params):
+    """Check a raw GFF line against limits before splitting all columns.
+    """
+    line_filter = getattr(params, "line_filter", None)
+    if line_filter is not None:
+        return line_filter.passes(line)
+    return _passes_limits(line.split('\t'), params)
+
 def _gff_line_map(line, params):
     """Map part of Map-Reduce; parses a line of GFF into a dictionary.
 
@@ -44,68 +224,6 @@ def _gff_line_map(line, params):
         - determines the type of attribute (flat, parent, child or annotation)
         - generates a dictionary of GFF info which can be serialized as JSON
     """
-    gff3_kw_pat = re.compile("\w+=")
-    def _split_keyvals(keyval_str):
-        """Split key-value pairs in a GFF2, GTF and GFF3 compatible way.
-
-        GFF3 has key value pairs like:
-          count=9;gene=amx-2;sequence=SAGE:aacggagccg
-        GFF2 and GTF have:           
-          Sequence "Y74C9A" ; Note "Clone Y74C9A; Genbank AC024206"
-          name "fgenesh1_pg.C_chr_1000003"; transcriptId 869
-        """
-        quals = collections.defaultdict(list)
-        if keyval_str is None:
-            return quals
-        # ensembl GTF has a stray semi-colon at the end
-        if keyval_str[-1] == ';':
-            keyval_str = keyval_str[:-1]
-        # GFF2/GTF has a semi-colon with at least one space after it.
-        # It can have spaces on both sides; wormbase does this.
-        # GFF3 works with no spaces.
-        # Split at the first one we can recognize as working
-        parts = keyval_str.split(" ; ")
-        if len(parts) == 1:
-            parts = keyval_str.split("; ")
-            if len(parts) == 1:
-                parts = keyval_str.split(";")
-        # check if we have GFF3 style key-vals (with =)
-        is_gff2 = True
-        if gff3_kw_pat.match(parts[0]):
-            is_gff2 = False
-            key_vals = [p.split('=') for p in parts]
-        # otherwise, we are separated by a space with a key as the first item
-        else:
-            pieces = []
-            for p in parts:
-                # fix misplaced semi-colons in keys in some GFF2 files
-                if p and p[0] == ';':
-                    p = p[1:]
-                pieces.append(p.strip().split(" "))
-            key_vals = [(p[0], " ".join(p[1:])) for p in pieces]
-        for item in key_vals:
-            # standard in-spec items are key=value
-            if len(item) == 2:
-                key, val = item
-            # out-of-spec files can have just key values. We set an empty value
-            # which will be changed to true later to standardize.
-            else:
-                assert len(item) == 1, item
-                key = item[0]
-                val = ''
-            # remove quotes in GFF2 files
-            if (len(val) > 0 and val[0] == '"' and val[-1] == '"'):
-                val = val[1:-1] 
-            if val:
-                quals[key].extend([v for v in val.split(',') if v])
-            # if we don't have a value, make this a key=True/False style
-            # attribute
-            else:
-                quals[key].append('true')
-        for key, vals in quals.items():
-            quals[key] = [urllib.unquote(v) for v in vals]
-        return quals, is_gff2
-
     def _nest_gff2_features(gff_parts):
         """Provide nesting of GFF2 transcript parts with transcript IDs.
 
@@ -139,77 +257,67 @@ def _gff_line_map(line, params):
 
         return gff_parts
 
-    strand_map = {'+' : 1, '-' : -1, '?' : None, None: None}
     line = line.strip()
     if line[:2] == "##":
         return [('directive', line[2:])]
-    elif line and line[0] != "#":
+    elif line and line[0] != "#" and _line_passes_limits(line, params):
         parts = line.split('\t')
-        should_do = True
-        if params.limit_info:
-            for limit_name, limit_values in params.limit_info.items():
-                cur_id = tuple([parts[i] for i in 
-                    params.filter_info[limit_name]])
-                if cur_id not in limit_values:
-                    should_do = False
-                    break
-        if should_do:
-            assert len(parts) >= 8, line
-            # not python2.4 compatible but easier to understand
-            #gff_parts = [(None if p == '.' else p) for p in parts]
-            gff_parts = []
-            for p in parts:
-                if p == ".":
-                    gff_parts.append(None)
-                else:
-                    gff_parts.append(p)
-            gff_info = dict()
-            # collect all of the base qualifiers for this item
-            if len(parts) > 8:
-                quals, is_gff2 = _split_keyvals(gff_parts[8])
+        assert len(parts) >= 8, line
+        # not python2.4 compatible but easier to understand
+        #gff_parts = [(None if p == '.' else p) for p in parts]
+        gff_parts = []
+        for p in parts:
+            if p == ".":
+                gff_parts.append(None)
             else:
-                quals, is_gff2 = collections.defaultdict(list), False
-            gff_info["is_gff2"] = is_gff2
-            if gff_parts[1]:
-                quals["source"].append(gff_parts[1])
-            if gff_parts[5]:
-                quals["score"].append(gff_parts[5])
-            if gff_parts[7]:
-                quals["phase"].append(gff_parts[7])
-            gff_info['quals'] = dict(quals)
-            gff_info['rec_id'] = gff_parts[0]
-            # if we are describing a location, then we are a feature
-            if gff_parts[3] and gff_parts[4]:
-                gff_info['location'] = [int(gff_parts[3]) - 1,
-                        int(gff_parts[4])]
-                gff_info['type'] = gff_parts[2]
-                gff_info['id'] = quals.get('ID', [''])[0]
-                gff_info['strand'] = strand_map.get(gff_parts[6], None)
-                if is_gff2:
-                    gff_info = _nest_gff2_features(gff_info)
-                # features that have parents need to link so we can pick up
-                # the relationship
-                if gff_info['quals'].has_key('Parent'):
-                    # check for self referential parent/child relationships
-                    # remove the ID, which is not useful
-                    for p in gff_info['quals']['Parent']:
-                        if p == gff_info['id']:
-                            gff_info['id'] = ''
-                            del gff_info['quals']['ID']
-                            break
-                    final_key = 'child'
-                elif gff_info['id']:
-                    final_key = 'parent'
-                # Handle flat features
-                else:
-                    final_key = 'feature'
-            # otherwise, associate these annotations with the full record
-            else:
-                final_key = 'annotation'
-            if params.jsonify:
-                return [(final_key, simplejson.dumps(gff_info))]
+                gff_parts.append(p)
+        gff_info = dict()
+        # collect all of the base qualifiers for this item
+        if len(parts) > 8:
+            quals, is_gff2 = _split_keyvals(gff_parts[8])
+        else:
+            quals, is_gff2 = collections.defaultdict(list), False
+        gff_info["is_gff2"] = is_gff2
+        if gff_parts[1]:
+            quals["source"].append(gff_parts[1])
+        if gff_parts[5]:
+            quals["score"].append(gff_parts[5])
+        if gff_parts[7]:
+            quals["phase"].append(gff_parts[7])
+        gff_info['quals'] = dict(quals)
+        gff_info['rec_id'] = gff_parts[0]
+        # if we are describing a location, then we are a feature
+        if gff_parts[3] and gff_parts[4]:
+            gff_info['location'] = [int(gff_parts[3]) - 1,
+                    int(gff_parts[4])]
+            gff_info['type'] = gff_parts[2]
+            gff_info['id'] = quals.get('ID', [''])[0]
+            gff_info['strand'] = _strand_map.get(gff_parts[6], None)
+            if is_gff2:
+                gff_info = _nest_gff2_features(gff_info)
+            # features that have parents need to link so we can pick up
+            # the relationship
+            if gff_info['quals'].has_key('Parent'):
+                # check for self referential parent/child relationships
+                # remove the ID, which is not useful
+                for p in gff_info['quals']['Parent']:
+                    if p == gff_info['id']:
+                        gff_info['id'] = ''
+                        del gff_info['quals']['ID']
+                        break
+                final_key = 'child'
+            elif gff_info['id']:
+                final_key = 'parent'
+            # Handle flat features
             else:
-                return [(final_key, gff_info)]
+                final_key = 'feature'
+        # otherwise, associate these annotations with the full record
+        else:
+            final_key = 'annotation'
+        if params.jsonify:
+            return [(final_key, simplejson.dumps(gff_info))]
+        else:
+            return [(final_key, gff_info)]
     return []
 
 def _gff_line_reduce(map_results, out, params):
@@ -228,26 +336,77 @@ def _gff_line_reduce(map_results, out, params):
             vals = simplejson.dumps(vals)
         out.add(key, vals)
 
+class _IntervalTree:
+    """Centered interval tree for finding intervals which contain a point.
+
+    Built from (start, end, value) items, with queries of closed intervals
+    running in O(log n + k) for k matching intervals.
+    """
+    def __init__(self, intervals):
+        points = [i[0] for i in intervals] + [i[1] for i in intervals]
+        points.sort()
+        self._center = points[len(points) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < self._center:
+                left.append(interval)
+            elif interval[0] > self._center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        self._by_start = sorted(here, key=lambda i: i[0])
+        self._by_end = sorted(here, key=lambda i: i[1], reverse=True)
+        self._left = _IntervalTree(left) if left else None
+        self._right = _IntervalTree(right) if right else None
+
+    def find_point(self, pos):
+        """Retrieve all intervals with start <= pos <= end.
+        """
+        found = []
+        node = self
+        while node is not None:
+            if pos < node._center:
+                for interval in node._by_start:
+                    if interval[0] > pos:
+                        break
+                    found.append(interval)
+                node = node._left
+            elif pos > node._center:
+                for interval in node._by_end:
+                    if interval[1] < pos:
+                        break
+                    found.append(interval)
+                node = node._right
+            else:
+                found.extend(node._by_start)
+                node = None
+        return found
+
 class _MultiIDRemapper:
     """Provide an ID remapping for cases where a parent has a non-unique ID.
 
     Real life GFF3 cases have non-unique ID attributes, which we fix here
     by using the unique sequence region to assign children to the right
-    parent.
+    parent. Parent regions are held in an interval tree so files with many
+    duplicates do not need a scan of every parent for each child.
     """
     def __init__(self, base_id, all_parents):
         self._base_id = base_id
         self._parents = all_parents
+        self._tree = _IntervalTree([(p['location'][0], p['location'][1],
+            index) for index, p in enumerate(all_parents)])
 
     def remap_id(self, feature_dict):
         rstart, rend = feature_dict['location']
-        for index, parent in enumerate(self._parents):
-            pstart, pend = parent['location']
-            if rstart >= pstart and rend <= pend:
-                if index > 0:
-                    return ("%s_%s" % (self._base_id, index + 1))
-                else:
-                    return self._base_id
+        # the first parent in the file containing the feature wins
+        containing = [index for (pstart, pend, index) in
+                self._tree.find_point(rstart) if rend <= pend]
+        if containing:
+            index = min(containing)
+            if index > 0:
+                return ("%s_%s" % (self._base_id, index + 1))
+            else:
+                return self._base_id
         raise ValueError("Did not find remapped ID location: %s, %s, %s" % (
                 self._base_id, [p['location'] for p in self._parents],
                 feature_dict['location']))
@@ -300,13 +459,33 @@ class _AbstractMapReduceGFF:
             if base_dict is None:
                 cur_dict = dict()
             else:
-                cur_dict = copy.deepcopy(base_dict)
+                cur_dict = self._copy_base_dict(base_dict)
             cur_dict = self._results_to_features(cur_dict, results)
             all_ids = cur_dict.keys()
             all_ids.sort()
             for cur_id in all_ids:
                 yield cur_dict[cur_id]
 
+    def _copy_base_dict(self, base_dict):
+        """Copy base records so each parsed part can add its own features.
+
+        Sequences are shared by reference instead of copied, so parsing in
+        parts against genome sized records does not duplicate the sequence
+        for every part. Generated UnknownSeq objects are copied since we
+        update their lengths as features are added.
+        """
+        new_dict = dict()
+        for rec_id, rec in base_dict.items():
+            seq = rec.seq
+            if isinstance(seq, UnknownSeq):
+                seq = copy.copy(seq)
+            new_dict[rec_id] = SeqRecord(seq, rec.id, rec.name,
+                    rec.description, list(rec.dbxrefs),
+                    copy.deepcopy(rec.features),
+                    copy.deepcopy(rec.annotations),
+                    dict(rec.letter_annotations))
+        return new_dict
+
     def parse_simple(self, gff_files, limit_info=None, target_lines=1):
         """Simple parse which does not build or nest features.
 
@@ -585,12 +764,107 @@ class _GFFParserLocalOut:
         self._last_parent = None
         return self._items
 
+class GFFRecord(object):
+    """Compact representation of a single GFF line.
+
+    Uses __slots__ to avoid a per-record dictionary. Coordinates are zero
+    based and half open like SeqFeature locations, and are None for lines
+    without a location. Attributes are available as a dictionary of lists
+    in quals.
+    """
+    __slots__ = ["rec_id", "source", "type", "start", "end", "score",
+            "strand", "phase", "quals"]
+
+    def __init__(self, rec_id, source, type, start, end, score, strand,
+            phase, quals):
+        self.rec_id = rec_id
+        self.source = source
+        self.type = type
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.phase = phase
+        self.quals = quals
+
+    def __repr__(self):
+        return "GFFRecord(%s, %s, %s, %s, %s, %s)" % (self.rec_id, self.type,
+                self.start, self.end, self.strand, self.quals)
+
+def _gff_line_parts(line, params):
+    """Split a GFF feature line into parts, or None for skipped lines.
+
+    Missing '.' values are returned as None.
+    """
+    if line[:1] == "#" or not line.strip():
+        return None
+    parts = line.rstrip("\r\n").split("\t")
+    if not _passes_limits(parts, params):
+        return None
+    assert len(parts) >= 8, line
+    return [(None if p == "." else p) for p in parts]
+
+def _gff_line_to_record(line, params):
+    """Parse a GFF line into a GFFRecord, or None for non-feature lines.
+    """
+    gff_parts = _gff_line_parts(line, params)
+    if gff_parts is None:
+        return None
+    if len(gff_parts) > 8:
+        quals = dict(_split_keyvals(gff_parts[8])[0])
+    else:
+        quals = dict()
+    if gff_parts[3] and gff_parts[4]:
+        start, end = int(gff_parts[3]) - 1, int(gff_parts[4])
+    else:
+        start, end = None, None
+    return GFFRecord(gff_parts[0], gff_parts[1], gff_parts[2], start, end,
+            gff_parts[5], _strand_map.get(gff_parts[6], None), gff_parts[7],
+            quals)
+
+class GFFColumns:
+    """Column oriented batch of GFF lines.
+
+    Numeric columns are typed arrays: starts and ends (zero based, -1 when
+    missing) and strands (1, -1 or 0 for unknown). Sequence IDs and types are
+    stored as integer codes into the seqid_names and type_names lists, which
+    are shared across all batches from a parse so codes stay stable.
+    Attributes are kept as the unparsed strings in the attributes side
+    table, and split on request with quals(index).
+    """
+    def __init__(self, seqid_names, type_names):
+        self.seqid_names = seqid_names
+        self.type_names = type_names
+        self.seqids = array.array("i")
+        self.types = array.array("i")
+        self.starts = array.array("l")
+        self.ends = array.array("l")
+        self.strands = array.array("b")
+        self.attributes = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def quals(self, index):
+        """Retrieve the attributes of a line as a dictionary of lists.
+        """
+        return dict(_split_keyvals(self.attributes[index])[0])
+
 class GFFParser(_AbstractMapReduceGFF):
     """Local GFF parser providing standardized parsing of GFF3 and GFF2 files.
     """
-    def __init__(self, line_adjust_fn=None, create_missing=True):
+    def __init__(self, line_adjust_fn=None, create_missing=True,
+            use_index=False):
+        """Initialize parser.
+
+        use_index - If True, parses limited by gff_id read only the feature
+        lines for those sequences from an up to date GFFIndex sidecar index,
+        when one exists. Annotation and directive lines are not indexed so
+        are skipped in this case.
+        """
         _AbstractMapReduceGFF.__init__(self, create_missing=create_missing)
         self._line_adjust_fn = line_adjust_fn
+        self._use_index = use_index
     
     def _gff_process(self, gff_files, limit_info, target_lines):
         """Process GFF addition without any parallelization.
@@ -599,14 +873,96 @@ class GFFParser(_AbstractMapReduceGFF):
         which provides a number of lines to parse before returning results.
         This allows partial parsing of a file to prevent memory issues.
         """
-        line_gen = self._file_line_generator(gff_files)
+        seqids = None
+        if self._use_index and limit_info and limit_info.has_key("gff_id"):
+            seqids = [v[0] for v in limit_info["gff_id"]]
+        line_gen = self._file_line_generator(gff_files, seqids)
         for out in self._lines_to_out_info(line_gen, limit_info, target_lines):
             yield out
 
-    def _file_line_generator(self, gff_files):
+    def parse_records(self, gff_files, limit_info=None):
+        """Parse GFF files into a stream of compact GFFRecord objects.
+
+        This is a lower memory alternative to parse_simple which does not do
+        any GFF2 nesting or build intermediate dictionaries.
+        """
+        if not isinstance(gff_files, (list, tuple)):
+            gff_files = [gff_files]
+        params = self._examiner._get_local_params(
+                self._normalize_limit_info(limit_info))
+        for line in self._file_line_generator(gff_files):
+            if line.startswith("##FASTA"):
+                break
+            rec = _gff_line_to_record(line, params)
+            if rec is not None:
+                yield rec
+
+    def parse_columns(self, gff_files, limit_info=None, batch_size=100000):
+        """Parse GFF files into batches of GFFColumns.
+
+        batch_size -- The maximum number of lines in each batch, which bounds
+        the memory used regardless of the size of the input file.
+        """
+        if not isinstance(gff_files, (list, tuple)):
+            gff_files = [gff_files]
+        params = self._examiner._get_local_params(
+                self._normalize_limit_info(limit_info))
+        seqid_names, type_names = [], []
+        seqid_codes, type_codes = dict(), dict()
+        cur_batch = GFFColumns(seqid_names, type_names)
+        for line in self._file_line_generator(gff_files):
+            if line.startswith("##FASTA"):
+                break
+            gff_parts = _gff_line_parts(line, params)
+            if gff_parts is None:
+                continue
+            rec_id, ftype = gff_parts[0], gff_parts[2]
+            try:
+                seqid_code = seqid_codes[rec_id]
+            except KeyError:
+                seqid_code = seqid_codes[rec_id] = len(seqid_names)
+                seqid_names.append(rec_id)
+            try:
+                type_code = type_codes[ftype]
+            except KeyError:
+                type_code = type_codes[ftype] = len(type_names)
+                type_names.append(ftype)
+            cur_batch.seqids.append(seqid_code)
+            cur_batch.types.append(type_code)
+            if gff_parts[3] and gff_parts[4]:
+                cur_batch.starts.append(int(gff_parts[3]) - 1)
+                cur_batch.ends.append(int(gff_parts[4]))
+            else:
+                cur_batch.starts.append(-1)
+                cur_batch.ends.append(-1)
+            cur_batch.strands.append(_strand_map.get(gff_parts[6], None) or 0)
+            if len(gff_parts) > 8:
+                cur_batch.attributes.append(gff_parts[8])
+            else:
+                cur_batch.attributes.append(None)
+            if len(cur_batch) >= batch_size:
+                yield cur_batch
+                cur_batch = GFFColumns(seqid_names, type_names)
+        if len(cur_batch) > 0:
+            yield cur_batch
+
+    def _file_line_generator(self, gff_files, seqids=None):
         """Generate single lines from a set of GFF files.
+
+        seqids -- Sequence IDs to restrict to, using the file index if
+        available.
         """
         for gff_file in gff_files:
+            if seqids is not None and not hasattr(gff_file, "read"):
+                import GFFIndex
+                offsets = GFFIndex.seqid_offsets(gff_file, seqids)
+                if offsets is not None:
+                    in_handle = open(gff_file)
+                    for offset in offsets:
+                        in_handle.seek(offset)
+                        yield in_handle.readline()
+                    in_handle.close()
+                    continue
             if hasattr(gff_file, "read"):
                 need_close = False
                 in_handle = gff_file
@@ -701,6 +1057,137 @@ class DiscoGFFParser(_AbstractMapReduceGFF):
             processed[out_key] = simplejson.loads(out_val)
         yield processed
 
+def _file_byte_ranges(gff_file, num_parts):
+    """Split the annotation portion of a file into ranges of whole lines.
+
+    Returns the list of (start, end) byte ranges along with the byte
+    offset of a trailing ##FASTA section, or None if there is none.
+    """
+    in_handle = open(gff_file)
+    file_size = os.fstat(in_handle.fileno()).st_size
+    fasta_start = None
+    if file_size > 0:
+        fasta_start = _find_fasta_start(in_handle, file_size)
+    end = file_size if fasta_start is None else fasta_start
+    bounds = [0]
+    for i in range(1, num_parts):
+        in_handle.seek(max(end * i // num_parts - 1, bounds[-1]))
+        # move to the start of the next full line
+        in_handle.readline()
+        bounds.append(min(in_handle.tell(), end))
+    bounds.append(end)
+    in_handle.close()
+    ranges = [(s, e) for (s, e) in zip(bounds[:-1], bounds[1:]) if e > s]
+    return ranges, fasta_start
+
+def _find_fasta_start(in_handle, file_size):
+    """Locate the byte offset of a ##FASTA directive line, if present.
+    """
+    fasta_map = mmap.mmap(in_handle.fileno(), file_size,
+            access=mmap.ACCESS_READ)
+    try:
+        if fasta_map[:7] == "##FASTA":
+            return 0
+        pos = fasta_map.find("\n##FASTA")
+    finally:
+        fasta_map.close()
+    if pos >= 0:
+        return pos + 1
+    return None
+
+def _file_signature(gff_file):
+    """Identify a version of a file by its size and modification time.
+    """
+    stat = os.stat(gff_file)
+    return "%s:%s" % (stat.st_size, int(stat.st_mtime))
+
+def _gff_range_map_reduce(args):
+    """Run map and reduce over a byte range of a GFF file in a worker process.
+
+    The range starts at the beginning of a line and ends either at the end
+    of a line or at the file end, so every line is handled by exactly one
+    worker. Returns the collected dictionary of results for the range.
+    """
+    gff_file, start, end, limit_info, line_adjust_fn = args
+    params = GFFExaminer()._get_local_params(limit_info)
+    out_info = _GFFParserLocalOut()
+    in_handle = open(gff_file)
+    in_handle.seek(start)
+    while in_handle.tell() < end:
+        line = in_handle.readline()
+        if not line:
+            break
+        results = _gff_line_map(line, params)
+        if line_adjust_fn and results:
+            if results[0][0] not in ['directive']:
+                results = [(results[0][0], line_adjust_fn(results[0][1]))]
+        _gff_line_reduce(results, out_info, params)
+    in_handle.close()
+    return out_info.get_results()
+
+class MultiProcessGFFParser(_AbstractMapReduceGFF):
+    """GFF Parser with parallelization over local processors.
+
+    Files are split into byte ranges on line boundaries and each range is
+    parsed in a separate process. The partial results are combined before
+    features are nested, so parent/child relationships spanning range
+    boundaries are resolved identically to the single processor parser.
+    """
+    def __init__(self, cores=None, line_adjust_fn=None, create_missing=True):
+        """Initialize parser.
+
+        cores - Number of processes to use; defaults to all available CPUs.
+        line_adjust_fn - Function to adjust parsed lines, as in GFFParser.
+        This is passed to the worker processes so needs to be picklable,
+        a module level function.
+        """
+        _AbstractMapReduceGFF.__init__(self, create_missing=create_missing)
+        if cores is None:
+            import multiprocessing
+            cores = multiprocessing.cpu_count()
+        self._cores = cores
+        self._line_adjust_fn = line_adjust_fn
+
+    def _gff_process(self, gff_files, limit_info, target_lines=None):
+        """Process GFF addition, using multiple local processes.
+        """
+        assert target_lines is None, "Cannot split parallelized jobs"
+        import multiprocessing
+        work = []
+        fasta_starts = []
+        for gff_file in gff_files:
+            assert not hasattr(gff_file, "read"), \
+                    "Parallel parsing requires file names, not handles"
+            ranges, fasta_start = _file_byte_ranges(gff_file,
+                    self._cores)
+            work.extend([(gff_file, start, end, limit_info,
+                self._line_adjust_fn) for (start, end) in ranges])
+            if fasta_start is not None:
+                fasta_starts.append((gff_file, fasta_start))
+        pool = multiprocessing.Pool(self._cores)
+        try:
+            range_results = pool.map(_gff_range_map_reduce, work)
+        finally:
+            pool.close()
+            pool.join()
+        processed = dict()
+        for results in range_results:
+            for key, vals in results.items():
+                try:
+                    processed[key].extend(vals)
+                except KeyError:
+                    processed[key] = vals
+        for gff_file, fasta_start in fasta_starts:
+            in_handle = open(gff_file)
+            in_handle.seek(fasta_start)
+            # skip past the ##FASTA directive itself
+            in_handle.readline()
+            processed.setdefault('directive', []).append('FASTA')
+            processed.setdefault('fasta', []).extend(
+                    self._parse_fasta(in_handle))
+            in_handle.close()
+        yield processed
+
 def parse(gff_files, base_dict=None, limit_info=None, target_lines=None):
     """High level interface to parse GFF files into SeqRecords and SeqFeatures.
     """
@@ -716,6 +1203,21 @@ def parse_simple(gff_files, limit_info=None):
     for rec in parser.parse_simple(gff_files, limit_info=limit_info):
         yield rec["child"][0]
 
+def parse_records(gff_files, limit_info=None):
+    """Parse GFF files as a stream of compact GFFRecord objects.
+    """
+    parser = GFFParser()
+    for rec in parser.parse_records(gff_files, limit_info=limit_info):
+        yield rec
+
+def parse_columns(gff_files, limit_info=None, batch_size=100000):
+    """Parse GFF files as column oriented GFFColumns batches.
+    """
+    parser = GFFParser()
+    for batch in parser.parse_columns(gff_files, limit_info=limit_info,
+            batch_size=batch_size):
+        yield batch
+
 def _file_or_handle(fn):
     """Decorator to handle either an input handle or a file.
     """
@@ -734,6 +1236,112 @@ def _file_or_handle(fn):
         return out
     return _file_or_handle_inside
 
+class _GFFSummary:
+    """Collect all GFFExaminer statistics in a single pass over lines.
+
+    Partial summaries from separate parts of a file can be combined
+    with merge.
+    """
+    def __init__(self, filter_info):
+        self._filter_info = filter_info
+        self.limits = dict()
+        for filter_key in filter_info.keys():
+            self.limits[filter_key] = collections.defaultdict(int)
+        self.parent_sts = dict()
+        self.child_sts = collections.defaultdict(list)
+        self.seqid_lengths = dict()
+        self.attribute_keys = collections.defaultdict(int)
+
+    def add_line(self, line, params):
+        if line.startswith("##sequence-region"):
+            parts = line.split()
+            if len(parts) >= 4:
+                self._update_length(parts[1], int(parts[3]))
+            return
+        if not line.strip() or line.strip()[0] == "#":
+            return
+        parts = [p.strip() for p in line.split('\t')]
+        assert len(parts) >= 8, line
+        parts = parts[:9]
+        for filter_key, cur_indexes in self._filter_info.items():
+            cur_id = tuple([parts[i] for i in cur_indexes])
+            self.limits[filter_key][cur_id] += 1
+        if parts[4] != ".":
+            self._update_length(parts[0], int(parts[4]))
+        if len(parts) > 8 and parts[8] not in ["", "."]:
+            quals, is_gff2 = _split_keyvals(parts[8])
+            for key in quals.keys():
+                self.attribute_keys[key] += 1
+        else:
+            quals, is_gff2 = dict(), False
+        # only located features take part in parent/child relationships
+        if parts[3] == "." or parts[4] == ".":
+            return
+        if is_gff2:
+            # GFF2 parents are inferred, so use the full line parser
+            _, line_info = _gff_line_map(line, params)[0]
+            feature_id = line_info['id']
+            quals = line_info['quals']
+        else:
+            feature_id = quals.get('ID', [''])[0]
+            if parts[1] != ".":
+                quals['source'] = quals.get('source', []) + [parts[1]]
+            if feature_id in quals.get('Parent', []):
+                feature_id = ''
+        source_type = (quals.get('source', [""])[0], parts[2])
+        if feature_id:
+            self.parent_sts[feature_id] = source_type
+        for parent_id in quals.get('Parent', []):
+            self.child_sts[parent_id].append(source_type)
+
+    def _update_length(self, seqid, end):
+        self.seqid_lengths[seqid] = max(self.seqid_lengths.get(seqid, 0), end)
+
+    def merge(self, other):
+        for filter_key, counts in other.limits.items():
+            for cur_id, count in counts.items():
+                self.limits[filter_key][cur_id] += count
+        self.parent_sts.update(other.parent_sts)
+        for parent_id, child_types in other.child_sts.items():
+            self.child_sts[parent_id].extend(child_types)
+        for seqid, end in other.seqid_lengths.items():
+            self._update_length(seqid, end)
+        for key, count in other.attribute_keys.items():
+            self.attribute_keys[key] += count
+
+    def results(self):
+        final_limits = dict()
+        for key, value_dict in self.limits.items():
+            final_limits[key] = dict(value_dict)
+        pc_map = collections.defaultdict(list)
+        for parent_id, parent_type in self.parent_sts.items():
+            for child_type in self.child_sts.get(parent_id, []):
+                pc_map[parent_type].append(child_type)
+        pc_final_map = dict()
+        for ptype, ctypes in pc_map.items():
+            unique_ctypes = list(set(ctypes))
+            unique_ctypes.sort()
+            pc_final_map[ptype] = unique_ctypes
+        return dict(limits=final_limits, parent_child=pc_final_map,
+                seqid_lengths=dict(self.seqid_lengths),
+                attribute_keys=dict(self.attribute_keys))
+
+def _summarize_range(args):
+    """Summarize a byte range of a GFF file, for use in worker processes.
+    """
+    gff_file, start, end, filter_info = args
+    params = GFFExaminer()._get_local_params()
+    summary = _GFFSummary(filter_info)
+    in_handle = open(gff_file)
+    in_handle.seek(start)
+    while in_handle.tell() < end:
+        line = in_handle.readline()
+        if not line:
+            break
+        summary.add_line(line, params)
+    in_handle.close()
+    return summary
+
 class GFFExaminer:
     """Provide high level details about a GFF file to refine parsing.
 
@@ -754,6 +1362,10 @@ class GFFExaminer:
         params = _LocalParams()
         params.limit_info = limit_info
         params.filter_info = self._filter_info
+        if limit_info:
+            params.line_filter = _LimitFilter(limit_info, self._filter_info)
+        else:
+            params.line_filter = None
         return params
     
     @_file_or_handle
@@ -834,3 +1446,79 @@ class GFFExaminer:
             unique_ctypes.sort()
             pc_final_map[ptype] = unique_ctypes
         return pc_final_map
+
+    def summarize(self, gff_file, cores=1, use_cache=True):
+        """Summarize a GFF file in one pass, optionally over multiple processes.
+
+        Returns a dictionary with:
+
+        limits -- possible limits for the file, as from available_limits
+        parent_child -- parent/child type map, as from parent_child_map
+        seqid_lengths -- maximum end coordinate seen for each sequence ID,
+                         including ##sequence-region directives
+        attribute_keys -- counts of lines containing each attribute key
+
+        cores -- Number of processes to split the file across.
+        use_cache -- Store the summary next to the file, keyed by the file
+        size and modification time, and reuse it when unchanged.
+        """
+        if hasattr(gff_file, "read"):
+            params = self._get_local_params()
+            summary = _GFFSummary(self._filter_info)
+            for line in gff_file:
+                if line.startswith("##FASTA"):
+                    break
+                summary.add_line(line, params)
+            return summary.results()
+        cache_file = gff_file + ".summary"
+        if use_cache:
+            cached = self._read_summary_cache(gff_file, cache_file)
+            if cached is not None:
+                return cached
+        ranges, _ = _file_byte_ranges(gff_file, cores)
+        work = [(gff_file, start, end, self._filter_info)
+                for (start, end) in ranges]
+        if cores > 1 and len(work) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(cores)
+            try:
+                range_summaries = pool.map(_summarize_range, work)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            range_summaries = [_summarize_range(w) for w in work]
+        summary = _GFFSummary(self._filter_info)
+        for range_summary in range_summaries:
+            summary.merge(range_summary)
+        final = summary.results()
+        if use_cache:
+            self._write_summary_cache(gff_file, cache_file, final)
+        return final
+
+    def _read_summary_cache(self, gff_file, cache_file):
+        if not os.path.exists(cache_file):
+            return None
+        in_handle = open(cache_file, "rb")
+        try:
+            try:
+                signature, summary = cPickle.load(in_handle)
+            except (cPickle.UnpicklingError, EOFError, ValueError):
+                return None
+        finally:
+            in_handle.close()
+        if signature == _file_signature(gff_file):
+            return summary
+        return None
+
+    def _write_summary_cache(self, gff_file, cache_file, summary):
+        # the cache is optional, so skip it for read only directories
+        try:
+            out_handle = open(cache_file, "wb")
+        except IOError:
+            return
+        try:
+            cPickle.dump((_file_signature(gff_file), summary), out_handle,
+                    cPickle.HIGHEST_PROTOCOL)
+        finally:
+            out_handle.close()
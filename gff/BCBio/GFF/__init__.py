@@ -1,4 +1,6 @@
 """Top level of GFF parsing providing shortcuts for useful classes.
 """
-from GFFParser import GFFParser, DiscoGFFParser, GFFExaminer, parse, parse_simple
+from GFFParser import (GFFParser, DiscoGFFParser, MultiProcessGFFParser,
+        GFFExaminer, parse, parse_simple, parse_records, parse_columns)
 from GFFOutput import GFF3Writer, write
+from GFFIndex import GFFIndexedReader, index_gff
@@ -12,18 +12,24 @@ loading very large chromosome sequences. Updating these options can help:
     set global max_allowed_packet=1000000000;
     set global net_buffer_length=1000000;
 
+The --bulk option loads with batched inserts inside a single transaction,
+which is much faster for full genome annotations. Features are stored the
+same way as with the default Biopython loader.
+
 Usage:
-    gff_to_biosql.py <fasta file> <gff file>
+    gff_to_biosql.py <fasta file> <gff file> [--bulk]
 """
 from __future__ import with_statement
 import sys
+from optparse import OptionParser
 
 from BioSQL import BioSeqDatabase
 from Bio import SeqIO
 
 from BCBio.GFF import GFFParser
+from BCBio.GFF.GFFBioSQL import BioSQLBulkLoader
 
-def main(seq_file, gff_file):
+def main(seq_file, gff_file, bulk=False):
     # -- To be customized
     # You need to update these parameters to point to your local database
     # XXX demo example could be swapped to use SQLite when that is integrated
@@ -62,15 +68,25 @@ def main(seq_file, gff_file):
             server.remove_database(biodb_name)
             server.adaptor.commit()
             server.new_database(biodb_name)
-        db = server[biodb_name]
-        db.load(recs)
         server.adaptor.commit()
+        if bulk:
+            loader = BioSQLBulkLoader(server.adaptor.conn,
+                    server.module.paramstyle)
+            loader.load(biodb_name, recs)
+        else:
+            db = server[biodb_name]
+            db.load(recs)
+            server.adaptor.commit()
     except:
         server.adaptor.rollback()
         raise
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    parser = OptionParser()
+    parser.add_option("-b", "--bulk", dest="bulk", action="store_true",
+            default=False)
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
         print __doc__
         sys.exit()
-    main(sys.argv[1], sys.argv[2])
+    main(args[0], args[1], options.bulk)
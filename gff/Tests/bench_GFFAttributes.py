@@ -0,0 +1,64 @@
+"""Benchmark GFF attribute splitting and line parsing speed.
+
+Reports lines per second for GFF3, Ensembl GTF and WormBase GFF2 samples,
+comparing the tolerant attribute splitter used before the fast tokenizer
+with the current fast path.
+
+Usage:
+    bench_GFFAttributes.py [<number of passes>]
+"""
+import os
+import sys
+import time
+
+from BCBio.GFF import GFFExaminer
+from BCBio.GFF import GFFParser as parser_module
+
+def main(passes=200):
+    test_dir = os.path.join(os.path.dirname(__file__), "GFF")
+    samples = [("GFF3", "c_elegans_WS199_shortened_gff.txt"),
+               ("GTF", "ensembl_gtf.txt"),
+               ("WormBase GFF2", "wormbase_gff2.txt")]
+    for name, fname in samples:
+        lines = _read_feature_lines(os.path.join(test_dir, fname))
+        before = _lines_per_second(lines, passes,
+                parser_module._tolerant_split_keyvals)
+        after = _lines_per_second(lines, passes,
+                parser_module._split_keyvals)
+        print "%s (%s lines x %s passes)" % (name, len(lines), passes)
+        print "  before: %10.0f lines/sec" % before
+        print "  after:  %10.0f lines/sec" % after
+        print "  speedup: %.2fx" % (after / before)
+
+def _lines_per_second(lines, passes, split_fn):
+    """Time full line parsing with the given attribute splitting function.
+    """
+    orig_split = parser_module._split_keyvals
+    parser_module._split_keyvals = split_fn
+    params = GFFExaminer()._get_local_params()
+    try:
+        start = time.time()
+        for _ in range(passes):
+            for line in lines:
+                parser_module._gff_line_map(line, params)
+        elapsed = time.time() - start
+    finally:
+        parser_module._split_keyvals = orig_split
+    return float(len(lines) * passes) / elapsed
+
+def _read_feature_lines(in_file):
+    lines = []
+    in_handle = open(in_file)
+    for line in in_handle:
+        if line.startswith("##FASTA"):
+            break
+        if line.strip() and not line.startswith("#"):
+            lines.append(line)
+    in_handle.close()
+    return lines
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,64 @@
+"""Benchmark loading GFF annotations into a SQLite BioSQL database.
+
+Compares rows per second for Biopython's row by row BioSQL loader with the
+batched BioSQLBulkLoader.
+
+Usage:
+    bench_GFFBioSQL.py <BioSQL SQLite schema> <GFF file>
+
+The schema is biosqldb-sqlite.sql from the BioSQL distribution.
+"""
+import os
+import sys
+import time
+import tempfile
+
+from BioSQL import BioSeqDatabase
+
+from BCBio import GFF
+from BCBio.GFF.GFFBioSQL import BioSQLBulkLoader
+
+_count_tables = ["bioentry", "biosequence", "seqfeature", "location",
+        "seqfeature_qualifier_value", "seqfeature_relationship"]
+
+def main(schema_file, gff_file):
+    for name, load_fn in [("Biopython BioSQL", _biopython_load),
+                          ("Bulk loader", _bulk_load)]:
+        db_handle, db_file = tempfile.mkstemp(suffix=".db")
+        os.close(db_handle)
+        try:
+            server = BioSeqDatabase.open_database(driver="sqlite3",
+                    db=db_file)
+            server.load_database_sql(schema_file)
+            server.new_database("bench")
+            server.adaptor.commit()
+            start = time.time()
+            load_fn(server, GFF.parse(gff_file))
+            elapsed = time.time() - start
+            num_rows = _count_rows(server)
+            server.close()
+        finally:
+            os.remove(db_file)
+        print "%s: %s rows in %.1f seconds, %.0f rows/sec" % (name, num_rows,
+                elapsed, num_rows / elapsed)
+
+def _biopython_load(server, recs):
+    server["bench"].load(recs)
+    server.adaptor.commit()
+
+def _bulk_load(server, recs):
+    loader = BioSQLBulkLoader(server.adaptor.conn, server.module.paramstyle)
+    loader.load("bench", recs)
+
+def _count_rows(server):
+    num_rows = 0
+    for table in _count_tables:
+        server.adaptor.execute("SELECT COUNT(*) FROM %s" % table)
+        num_rows += server.adaptor.cursor.fetchone()[0]
+    return num_rows
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print __doc__
+        sys.exit()
+    main(*sys.argv[1:])
@@ -0,0 +1,50 @@
+"""Stress benchmark for GFF3 files which reuse IDs across many parents.
+
+Generates a GFF3 file where every parent gene shares the same ID, each with
+a child mRNA, and times a full parse. Children are assigned to the right
+parent by location in _MultiIDRemapper.
+
+Usage:
+    bench_GFFDuplicateIDs.py [<number of parents>]
+"""
+import os
+import sys
+import time
+import tempfile
+
+from BCBio import GFF
+
+def main(num_parents=100000):
+    gff_file = _write_dup_gff(num_parents)
+    try:
+        start = time.time()
+        num_features = 0
+        for rec in GFF.parse(gff_file):
+            for feature in rec.features:
+                assert len(feature.sub_features) == 1, feature
+                num_features += 1
+        elapsed = time.time() - start
+    finally:
+        os.remove(gff_file)
+    assert num_features == num_parents, num_features
+    print "%s duplicate ID parents parsed in %.1f seconds" % (num_parents,
+            elapsed)
+
+def _write_dup_gff(num_parents):
+    out_handle, out_file = tempfile.mkstemp(suffix=".gff3")
+    out_handle = os.fdopen(out_handle, "w")
+    out_handle.write("##gff-version 3\n")
+    for i in range(num_parents):
+        start = i * 1000 + 1
+        out_handle.write("chr1\tbench\tgene\t%s\t%s\t.\t+\t.\tID=dup_gene\n"
+                % (start, start + 500))
+        out_handle.write("chr1\tbench\tmRNA\t%s\t%s\t.\t+\t.\t"
+                "ID=tx%s;Parent=dup_gene\n" % (start + 10, start + 400, i))
+    out_handle.close()
+    return out_file
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
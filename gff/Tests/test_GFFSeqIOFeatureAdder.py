@@ -4,6 +4,8 @@ import sys
 import os
 import unittest
 import pprint
+import shutil
+import tempfile
 import StringIO
 
 from Bio import SeqIO
@@ -11,7 +13,8 @@ from BCBio import GFF
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import SeqFeature, FeatureLocation
-from BCBio.GFF import (GFF3Writer, GFFExaminer, GFFParser, DiscoGFFParser)
+from BCBio.GFF import (GFF3Writer, GFFExaminer, GFFParser, DiscoGFFParser,
+        MultiProcessGFFParser)
 
 class MapReduceGFFTest(unittest.TestCase):
     """Tests GFF parsing using a map-reduce framework for parallelization.
@@ -34,6 +37,24 @@ class MapReduceGFFTest(unittest.TestCase):
         test_rec = rec_dict['I']
         assert len(test_rec.features) == 32
 
+    def t_multiprocess_map_reduce(self):
+        """Map reduce framework parallelized over local processes.
+        """
+        cds_limit_info = dict(
+                gff_type = ["gene", "mRNA", "CDS"],
+                gff_id = ['I']
+                )
+        parser = MultiProcessGFFParser(cores=3)
+        rec_dict = SeqIO.to_dict(parser.parse(self._test_gff_file,
+            limit_info=cds_limit_info))
+        test_rec = rec_dict['I']
+        assert len(test_rec.features) == 32
+        local_recs = list(GFF.parse(self._test_gff_file))
+        parallel_recs = list(parser.parse(self._test_gff_file))
+        assert [r.id for r in local_recs] == [r.id for r in parallel_recs]
+        for local_rec, parallel_rec in zip(local_recs, parallel_recs):
+            assert len(local_rec.features) == len(parallel_rec.features)
+
     def t_disco_map_reduce(self):
         """Map reduce framework parallelized using disco.
         """
@@ -133,6 +154,19 @@ class GFF3Test(unittest.TestCase):
         print
         pprint.pprint(pc_map)
 
+    def t_summarize(self):
+        """Single pass summary matches the individual examiner results.
+        """
+        gff_examiner = GFFExaminer()
+        summary = gff_examiner.summarize(self._test_gff_file, cores=2,
+                use_cache=False)
+        assert summary["limits"] == \
+                gff_examiner.available_limits(self._test_gff_file)
+        assert summary["parent_child"] == \
+                gff_examiner.parent_child_map(self._test_gff_file)
+        assert summary["seqid_lengths"]["I"] == 12766937
+        assert summary["attribute_keys"]["Parent"] > 0
+
     def t_flat_features(self):
         """Check addition of flat non-nested features to multiple records.
         """
@@ -230,6 +264,19 @@ class GFF3Test(unittest.TestCase):
         assert len(recs) == 6
         assert len(recs[0].features) == 59
     
+    def t_gff3_iterator_shared_seqs(self):
+        """Iterated parsing shares base sequences instead of copying them.
+        """
+        seq_dict = self._get_seq_dict()
+        parser = GFFParser()
+        recs = [r for r in parser.parse_in_parts(self._test_gff_file,
+            seq_dict, target_lines=70)]
+        assert len(recs) > 0
+        for rec in recs:
+            assert rec.seq is seq_dict[rec.id].seq
+        for rec in seq_dict.values():
+            assert len(rec.features) == 0
+
     def t_gff3_iterator_limit(self):
         """Iterated interface using a limit query on GFF3 files.
         """
@@ -268,6 +315,55 @@ class GFF3Test(unittest.TestCase):
         for f in t_features:
             assert len(f.sub_features) == 3
 
+    def t_gff3_duplicate_id_parents(self):
+        """Assign children to overlapping and nested parents sharing an ID.
+        """
+        gff_lines = [("gene", 1, 1000), ("gene", 500, 1500),
+                     ("gene", 100, 200), ("gene", 2000, 3000)]
+        child_lines = [(10, 50), (1200, 1400), (600, 900), (150, 160),
+                       (2100, 2200)]
+        out = ["##gff-version 3"]
+        for ftype, start, end in gff_lines:
+            out.append("chr1\ttest\t%s\t%s\t%s\t.\t+\t.\tID=dup" %
+                    (ftype, start, end))
+        for i, (start, end) in enumerate(child_lines):
+            out.append("chr1\ttest\tmRNA\t%s\t%s\t.\t+\t.\t"
+                    "ID=tx%s;Parent=dup" % (start, end, i))
+        rec = GFF.parse(StringIO.StringIO("\n".join(out) + "\n")).next()
+        children = dict((f.location.nofuzzy_start + 1,
+            sorted(s.qualifiers["ID"][0] for s in f.sub_features))
+            for f in rec.features)
+        # the first parent in the file containing a child wins
+        assert children == {1: ["tx0", "tx2", "tx3"], 500: ["tx1"],
+                100: [], 2000: ["tx4"]}, children
+
+    def t_duplicate_id_remapper(self):
+        """Interval tree parent lookup matches a scan through all parents.
+        """
+        import random
+        from BCBio.GFF.GFFParser import _MultiIDRemapper
+        def linear_remap(parents, location):
+            for index, parent in enumerate(parents):
+                if (location[0] >= parent['location'][0] and
+                        location[1] <= parent['location'][1]):
+                    return "dup_%s" % (index + 1) if index > 0 else "dup"
+        random.seed(42)
+        parents = []
+        for _ in range(200):
+            start = random.randint(0, 10000)
+            parents.append({'location': (start,
+                start + random.choice([5, 50, 500, 5000]))})
+        remapper = _MultiIDRemapper("dup", parents)
+        for _ in range(2000):
+            start = random.randint(0, 15000)
+            location = (start, start + random.randint(0, 100))
+            expected = linear_remap(parents, location)
+            if expected is None:
+                self.assertRaises(ValueError, remapper.remap_id,
+                        {'location': location})
+            else:
+                assert remapper.remap_id({'location': location}) == expected
+
     def t_simple_parsing(self):
         """Parse GFF into a simple line by line dictionary without nesting.
         """
@@ -281,6 +377,21 @@ class GFF3Test(unittest.TestCase):
                 ['yk1055g06.5', 'OSTF085G5_1']
         assert line_info['location'] == [4582718, 4583189]
 
+    def t_record_parsing(self):
+        """Parse GFF into compact records and column batches.
+        """
+        recs = list(GFF.parse_records(self._test_gff_file))
+        assert len(recs) == 177, len(recs)
+        assert recs[-1].quals['confirmed_est'] == \
+                ['yk1055g06.5', 'OSTF085G5_1']
+        batches = list(GFF.parse_columns(self._test_gff_file, batch_size=50))
+        assert [len(b) for b in batches] == [50, 50, 50, 27]
+        last_batch = batches[-1]
+        assert last_batch.starts[-1] == recs[-1].start
+        assert last_batch.ends[-1] == recs[-1].end
+        assert last_batch.type_names[last_batch.types[-1]] == recs[-1].type
+        assert last_batch.quals(len(last_batch) - 1) == recs[-1].quals
+
     def t_extra_comma(self):
         """Correctly handle GFF3 files with extra trailing commas.
         """
@@ -468,6 +579,232 @@ class GFF2Tester(unittest.TestCase):
         assert recs[0].features[1].type == 'SAGE_tag'
         assert len(recs[0].features[2].sub_features) == 29
 
+class IndexedAccessTest(unittest.TestCase):
+    """Random access to nested features through a sidecar index.
+    """
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self._test_gff_file = os.path.join(self._work_dir,
+                "c_elegans_WS199_shortened_gff.txt")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "GFF",
+            "c_elegans_WS199_shortened_gff.txt"), self._test_gff_file)
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def t_region_and_id_queries(self):
+        """Retrieve whole feature trees by region and by ID.
+        """
+        try:
+            from bx import interval_index_file
+        except ImportError:
+            print "Skipping -- bx-python not found"
+            return
+        reader = GFF.GFFIndexedReader(self._test_gff_file)
+        try:
+            gene = reader.feature_by_id("Gene:WBGene00000138")
+            assert len(gene.sub_features) == 1
+            assert len(gene.sub_features[0].sub_features) == 46
+            transcript = reader.feature_by_id("Transcript:B0019.1")
+            assert len(transcript.sub_features) == 46
+            features = reader.features_in_region("I", 12759600, 12759700)
+            gene_ids = [f.id for f in features if f.type == "gene"]
+            assert gene_ids == ["Gene:WBGene00000138"], gene_ids
+            assert reader.features_in_region("I", 1, 2) == []
+        finally:
+            reader.close()
+
+    def t_index_limited_parse(self):
+        """Parsing limited to a sequence ID reads lines through the index.
+        """
+        try:
+            from bx import interval_index_file
+        except ImportError:
+            print "Skipping -- bx-python not found"
+            return
+        GFF.index_gff(self._test_gff_file)
+        limit_info = dict(gff_id=["I"],
+                gff_type=["gene", "mRNA", "CDS"])
+        full_recs = list(GFFParser().parse(self._test_gff_file,
+            limit_info=limit_info))
+        index_recs = list(GFFParser(use_index=True).parse(
+            self._test_gff_file, limit_info=limit_info))
+        assert [r.id for r in index_recs] == ["I"]
+        assert len(index_recs[0].features) == len(full_recs[0].features)
+
+# Subset of the BioSQL SQLite schema used by the bulk loader
+_biosql_sqlite_schema = """
+CREATE TABLE biodatabase (biodatabase_id INTEGER PRIMARY KEY,
+    name VARCHAR(128) NOT NULL UNIQUE, authority VARCHAR(128), description TEXT);
+CREATE TABLE ontology (ontology_id INTEGER PRIMARY KEY,
+    name VARCHAR(32) NOT NULL UNIQUE, definition TEXT);
+CREATE TABLE term (term_id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL,
+    definition TEXT, identifier VARCHAR(40), is_obsolete CHAR(1),
+    ontology_id INTEGER NOT NULL, UNIQUE (name, ontology_id, is_obsolete));
+CREATE TABLE bioentry (bioentry_id INTEGER PRIMARY KEY,
+    biodatabase_id INTEGER NOT NULL, taxon_id INTEGER,
+    name VARCHAR(40) NOT NULL, accession VARCHAR(128) NOT NULL,
+    identifier VARCHAR(40), division VARCHAR(6), description TEXT,
+    version INTEGER NOT NULL, UNIQUE (accession, biodatabase_id, version));
+CREATE TABLE biosequence (bioentry_id INTEGER PRIMARY KEY, version INTEGER,
+    length INTEGER, alphabet VARCHAR(10), seq TEXT);
+CREATE TABLE bioentry_qualifier_value (bioentry_id INTEGER NOT NULL,
+    term_id INTEGER NOT NULL, value TEXT, rank INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (bioentry_id, term_id, rank));
+CREATE TABLE seqfeature (seqfeature_id INTEGER PRIMARY KEY,
+    bioentry_id INTEGER NOT NULL, type_term_id INTEGER NOT NULL,
+    source_term_id INTEGER NOT NULL, display_name VARCHAR(64),
+    rank INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (bioentry_id, type_term_id, source_term_id, rank));
+CREATE INDEX seqfeature_trm ON seqfeature (type_term_id);
+CREATE TABLE seqfeature_relationship (
+    seqfeature_relationship_id INTEGER PRIMARY KEY,
+    object_seqfeature_id INTEGER NOT NULL,
+    subject_seqfeature_id INTEGER NOT NULL, term_id INTEGER NOT NULL,
+    rank INTEGER,
+    UNIQUE (object_seqfeature_id, subject_seqfeature_id, term_id));
+CREATE TABLE seqfeature_qualifier_value (seqfeature_id INTEGER NOT NULL,
+    term_id INTEGER NOT NULL, rank INTEGER NOT NULL DEFAULT 0,
+    value TEXT NOT NULL, PRIMARY KEY (seqfeature_id, term_id, rank));
+CREATE INDEX seqfeaturequal_trm ON seqfeature_qualifier_value (term_id);
+CREATE TABLE location (location_id INTEGER PRIMARY KEY,
+    seqfeature_id INTEGER NOT NULL, dbxref_id INTEGER, term_id INTEGER,
+    start_pos INTEGER, end_pos INTEGER, strand INTEGER NOT NULL DEFAULT 0,
+    rank INTEGER NOT NULL DEFAULT 0, UNIQUE (seqfeature_id, rank));
+CREATE INDEX seqfeatureloc_start ON location (start_pos, end_pos);
+CREATE TABLE location_qualifier_value (location_id INTEGER NOT NULL,
+    term_id INTEGER NOT NULL, value VARCHAR(255) NOT NULL, int_value INTEGER,
+    PRIMARY KEY (location_id, term_id));
+CREATE TABLE dbxref (dbxref_id INTEGER PRIMARY KEY,
+    dbname VARCHAR(40) NOT NULL, accession VARCHAR(128) NOT NULL,
+    version INTEGER NOT NULL, UNIQUE (accession, dbname, version));
+CREATE TABLE bioentry_dbxref (bioentry_id INTEGER NOT NULL,
+    dbxref_id INTEGER NOT NULL, rank INTEGER,
+    PRIMARY KEY (bioentry_id, dbxref_id));
+CREATE TABLE seqfeature_dbxref (seqfeature_id INTEGER NOT NULL,
+    dbxref_id INTEGER NOT NULL, rank INTEGER,
+    PRIMARY KEY (seqfeature_id, dbxref_id));
+"""
+
+class BioSQLBulkTest(unittest.TestCase):
+    """Bulk loading of GFF parsed records into a SQLite BioSQL database.
+    """
+    def setUp(self):
+        self._test_gff_file = os.path.join(os.path.dirname(__file__), "GFF",
+                "c_elegans_WS199_shortened_gff.txt")
+
+    def t_bulk_load(self):
+        """Load nested features, qualifiers and locations in one transaction.
+        """
+        import sqlite3
+        from BCBio.GFF.GFFBioSQL import BioSQLBulkLoader
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(_biosql_sqlite_schema)
+        cds_limit_info = dict(
+                gff_source_type = [('Coding_transcript', 'gene'),
+                             ('Coding_transcript', 'mRNA'),
+                             ('Coding_transcript', 'CDS')],
+                gff_id = ['I']
+                )
+        loader = BioSQLBulkLoader(conn, batch_size=10)
+        num_recs = loader.load("gff_test", GFF.parse(self._test_gff_file,
+            limit_info=cds_limit_info))
+        assert num_recs == 1
+        num_features = conn.execute("SELECT COUNT(*) FROM seqfeature"
+                ).fetchone()[0]
+        num_locations = conn.execute("SELECT COUNT(*) FROM location"
+                ).fetchone()[0]
+        assert num_features == 2 # two top level genes
+        # the second gene has three transcripts stored as its locations
+        assert num_locations == 4
+        assert loader.row_counts["seqfeature"] == num_features
+        indexes = [r[0] for r in conn.execute("SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND sql IS NOT NULL")]
+        assert "seqfeatureloc_start" in indexes
+        conn.close()
+
+    def t_bulk_load_matches_loader(self):
+        """Read back the same nested features as the standard BioSQL loader.
+        """
+        from BioSQL import BioSeqDatabase
+        from BCBio.GFF.GFFBioSQL import BioSQLBulkLoader
+        server = BioSeqDatabase.open_database(driver="sqlite3",
+                db=":memory:")
+        server.adaptor.conn.executescript(_biosql_sqlite_schema)
+        cds_limit_info = dict(
+                gff_source_type = [('Coding_transcript', 'gene'),
+                             ('Coding_transcript', 'mRNA'),
+                             ('Coding_transcript', 'CDS')],
+                gff_id = ['I']
+                )
+        server.new_database("standard")
+        server["standard"].load(GFF.parse(self._test_gff_file,
+            limit_info=cds_limit_info))
+        server.adaptor.commit()
+        loader = BioSQLBulkLoader(server.adaptor.conn)
+        loader.load("bulk", GFF.parse(self._test_gff_file,
+            limit_info=cds_limit_info))
+        def _feature_info(feature):
+            return (feature.type, str(feature.location), feature.strand,
+                    [(str(sub.location), sub.strand)
+                        for sub in feature.sub_features],
+                    sorted(feature.qualifiers.items()))
+        standard = server["standard"].lookup(accession="I")
+        bulk = server["bulk"].lookup(accession="I")
+        assert len(bulk.features) == 2
+        assert len(bulk.features[1].sub_features) == 3
+        assert [_feature_info(f) for f in bulk.features] == \
+               [_feature_info(f) for f in standard.features]
+        server.close()
+
+    def t_bulk_load_rollback(self):
+        """Roll back rows and dropped indexes when a load fails part way.
+        """
+        import sqlite3
+        from BCBio.GFF.GFFBioSQL import BioSQLBulkLoader
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(_biosql_sqlite_schema)
+        index_sql = "SELECT name FROM sqlite_master WHERE type = 'index' " \
+                "AND sql IS NOT NULL"
+        orig_indexes = sorted(r[0] for r in conn.execute(index_sql))
+        def failing_recs():
+            for i, rec in enumerate(GFF.parse(self._test_gff_file)):
+                if i == 2:
+                    raise ValueError("Bad record")
+                yield rec
+        loader = BioSQLBulkLoader(conn, batch_size=10)
+        self.assertRaises(ValueError, loader.load, "gff_test", failing_recs())
+        assert sorted(r[0] for r in conn.execute(index_sql)) == orig_indexes
+        for table in ["biodatabase", "bioentry", "seqfeature", "location"]:
+            num_rows = conn.execute("SELECT COUNT(*) FROM %s" % table
+                    ).fetchone()[0]
+            assert num_rows == 0, (table, num_rows)
+        conn.close()
+
+class AttributeSplitTest(unittest.TestCase):
+    """Check the fast attribute tokenizer against the tolerant splitter.
+    """
+    def setUp(self):
+        self._test_dir = os.path.join(os.path.dirname(__file__), "GFF")
+
+    def t_fast_matches_tolerant(self):
+        """Fast attribute splitting gives identical results on test files.
+        """
+        from BCBio.GFF.GFFParser import (_fast_split_keyvals,
+                _tolerant_split_keyvals)
+        for fname in os.listdir(self._test_dir):
+            in_handle = open(os.path.join(self._test_dir, fname))
+            for line in in_handle:
+                if line.startswith("#"):
+                    continue
+                parts = line.strip().split("\t")
+                if len(parts) > 8 and parts[8] != ".":
+                    fast_out = _fast_split_keyvals(parts[8])
+                    if fast_out is not None:
+                        quals, is_gff2 = _tolerant_split_keyvals(parts[8])
+                        assert fast_out == (quals, is_gff2), parts[8]
+            in_handle.close()
+
 class DirectivesTest(unittest.TestCase):
     """Tests for parsing directives and other meta-data.
     """
@@ -599,6 +936,26 @@ class OutputTest(unittest.TestCase):
         assert fasta_parts[1] == ">ID1 <unknown description>"
         assert fasta_parts[2] == str(seq)
 
+    def t_write_fasta_iterator(self):
+        """Stream records from an iterator, with FASTA sequences at the end.
+        """
+        def rec_generator():
+            for i in range(3):
+                rec = SeqRecord(Seq("GATCGATCGATCGATCGATC"), "ID%s" % i)
+                rec.features = [SeqFeature(FeatureLocation(0, 20),
+                    type="gene", strand=1, qualifiers={"ID": "gene%s" % i})]
+                yield rec
+        out_handle = StringIO.StringIO()
+        GFF.write(rec_generator(), out_handle, include_fasta=True)
+        wrote_info = out_handle.getvalue().split("##FASTA\n")
+        assert len(wrote_info) == 2
+        gff_lines = [l for l in wrote_info[0].split("\n")
+                if l and not l.startswith("#")]
+        assert len(gff_lines) == 3
+        fasta_headers = [l for l in wrote_info[1].split("\n")
+                if l.startswith(">")]
+        assert len(fasta_headers) == 3
+
     def t_write_seqrecord(self):
         """Write single SeqRecords.
         """
@@ -626,6 +983,7 @@ def testing_suite():
     test_loader = unittest.TestLoader()
     test_loader.testMethodPrefix = 't_'
     tests = [GFF3Test, MapReduceGFFTest, SolidGFFTester, GFF2Tester,
+             AttributeSplitTest, IndexedAccessTest, BioSQLBulkTest,
              DirectivesTest, OutputTest]
     #tests = [GFF3Test]
     for test in tests:
@@ -1,2 +1,61 @@
 """Functionality to query and extract information from aligned BAM files.
 """
+import os
+import struct
+
+
+def bam_index(in_file):
+    """Retrieve the BAI index for a BAM file, or None if not indexed.
+    """
+    for index_file in ["%s.bai" % in_file,
+                       "%s.bai" % os.path.splitext(in_file)[0]]:
+        if os.path.exists(index_file):
+            return index_file
+    return None
+
+
+def index_stats(index_file):
+    """Retrieve per reference statistics from a BAI index.
+
+    Returns a dictionary for each reference with mapped and unmapped read
+    counts and the linear index of read offsets in 16kb windows, along with
+    the virtual file offset of the end of the last placed read.
+    """
+    def _read(fmt):
+        return struct.unpack(fmt, in_handle.read(struct.calcsize(fmt)))
+    ref_stats = []
+    last_offset = 0
+    with open(index_file, "rb") as in_handle:
+        assert in_handle.read(4) == "BAI\1", "Unexpected index %s" % index_file
+        (n_ref,) = _read("<i")
+        for _ in xrange(n_ref):
+            stats = {"mapped": 0, "unmapped": 0}
+            (n_bin,) = _read("<i")
+            for _ in xrange(n_bin):
+                bin_id, n_chunk = _read("<Ii")
+                chunks = _read("<%sQ" % (2 * n_chunk))
+                # pseudo-bin with read counts instead of offsets
+                if bin_id == 37450:
+                    stats["mapped"], stats["unmapped"] = chunks[2:4]
+                else:
+                    last_offset = max([last_offset] + list(chunks[1::2]))
+            (n_intv,) = _read("<i")
+            stats["intervals"] = _read("<%sQ" % n_intv)
+            ref_stats.append(stats)
+    return ref_stats, last_offset
+
+
+def mapped_total(bam_file, work_bam):
+    """Total mapped reads in a BAM file, from the index where available.
+
+    work_bam is an open pysam Samfile, used to count reads directly when
+    there is no index or the index has no read count statistics.
+    """
+    total = 0
+    index_file = bam_index(bam_file)
+    if index_file:
+        ref_stats, _ = index_stats(index_file)
+        total = sum(x["mapped"] for x in ref_stats)
+    if total == 0:
+        total = sum(1 for r in work_bam.fetch() if not r.is_unmapped)
+    return total
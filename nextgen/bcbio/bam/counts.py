@@ -4,25 +4,30 @@ These are useful for plotting comparisons between BAM files to look at
 differences in defined or random regions.
 """
 
+import os
 import random
 import collections
 
 import pysam
 
+from bcbio.bam import mapped_total
 from bcbio.log import logger2 as log
 
 
 class NormalizedBam:
     """Prepare and query an alignment BAM file for normalized read counts.
+
+    The total of mapped reads comes from the BAM index and is cached next to
+    the BAM file, so reopening a BAM does not need a pass through the reads.
     """
     def __init__(self, name, fname, picard, quick=False):
         self.name = name
-        self._bam = pysam.Samfile(fname, "rb")
         picard.run_fn("picard_index", fname)
+        self._bam = pysam.Samfile(fname, "rb")
         if quick:
             self._total = 1e6
         else:
-            self._total = sum(1 for r in self._bam.fetch() if not r.is_unmapped)
+            self._total = _cached_mapped_total(fname, self._bam)
             log.info("{}{}".format(name, self._total))
 
     def all_regions(self):
@@ -37,11 +42,23 @@ class NormalizedBam:
     def read_count(self, space, start, end):
         """Retrieve the normalized read count in the provided region.
         """
-        read_counts = 0
-        for read in self._bam.fetch(space, start, end):
-            read_counts += 1
+        return self._normalize(self._bam.count(space, start, end), self._total)
+
+    def read_counts(self, regions):
+        """Retrieve normalized read counts for many (space, start, end) regions.
 
-        return self._normalize(read_counts, self._total)
+        Regions are queried in file order to avoid seeking back and forth
+        through the BAM; counts are returned in the order of the input.
+        """
+        tids = dict((ref, i) for i, ref in enumerate(self._bam.references))
+        order = sorted(range(len(regions)),
+                       key=lambda i: (tids.get(regions[i][0], len(tids)),
+                                      regions[i][1], regions[i][2]))
+        counts = [None] * len(regions)
+        for i in order:
+            space, start, end = regions[i]
+            counts[i] = self.read_count(space, start, end)
+        return counts
 
     def coverage_pileup(self, space, start, end):
         """Retrieve pileup coverage across a specified region.
@@ -55,6 +72,23 @@ class NormalizedBam:
         return float(count) / float(total) * 1e6
 
 
+def _cached_mapped_total(fname, bam):
+    """Total mapped reads in a BAM file, cached on disk next to the file.
+    """
+    cache_file = "%s.mapped" % fname
+    if (os.path.exists(cache_file) and
+          os.path.getmtime(cache_file) >= os.path.getmtime(fname)):
+        with open(cache_file) as in_handle:
+            return int(in_handle.read().strip())
+    total = mapped_total(fname, bam)
+    try:
+        with open(cache_file, "w") as out_handle:
+            out_handle.write("%s\n" % total)
+    except IOError:
+        log.info("Could not cache mapped read total in %s" % cache_file)
+    return total
+
+
 def random_regions(base, n, size):
     """Generate n random regions of 'size' in the provided base spread.
     """
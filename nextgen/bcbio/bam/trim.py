@@ -1,23 +1,84 @@
 """Provide trimming of input reads from Fastq or BAM files.
 """
 import os
+import gzip
+import zlib
+import itertools
+import collections
 import contextlib
 
-from bcbio.utils import file_exists, save_diskspace, safe_makedir
+from bcbio.utils import file_exists, save_diskspace, safe_makedir, process_cores
 
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+def _trim_batch(args):
+    """Trim a batch of fastq lines from each input file.
 
-def _trim_quality(seq, qual, to_trim, min_length):
-    """Trim bases of the given quality from 3' read ends.
+    Trailing quality characters are removed with rstrip on the raw lines,
+    and records are kept only if the reads from every file are long enough
+    after trimming. Returns the fastq text for each file, as a gzip member
+    if compressed.
     """
-    removed = 0
-    while qual.endswith(to_trim):
-        removed += 1
-        qual = qual[:-1]
-    if len(qual) >= min_length:
-        return seq[:len(seq) - removed], qual
+    file_lines, to_trim, min_length, compress = args
+    strip_chars = to_trim + "\r\n"
+    all_sizes = []
+    keep = None
+    for lines in file_lines:
+        sizes = [len(q.rstrip(strip_chars)) for q in lines[3::4]]
+        ok = [size >= min_length for size in sizes]
+        keep = ok if keep is None else [a and b for a, b in zip(keep, ok)]
+        all_sizes.append(sizes)
+    out = []
+    for lines, sizes, do_compress in zip(file_lines, all_sizes, compress):
+        buf = []
+        for i, size in enumerate(sizes):
+            if keep[i]:
+                start = 4 * i
+                buf.extend((lines[start], lines[start + 1][:size], "\n+\n",
+                            lines[start + 3][:size], "\n"))
+        text = "".join(buf)
+        if do_compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            text = compressor.compress(text) + compressor.flush()
+        out.append(text)
+    return out
+
+def _line_batches(in_handles, batch_size):
+    """Read batches of fastq lines from multiple files in lockstep.
+
+    Expects standard four line fastq records.
+    """
+    while True:
+        batch = [list(itertools.islice(h, 4 * batch_size)) for h in in_handles]
+        if not batch[0]:
+            break
+        assert len(set(len(x) for x in batch)) == 1, \
+            "Fastq files have different numbers of records"
+        yield batch
+
+def _trim_batches(in_handles, to_trim, min_length, compress, cores=1,
+                  batch_size=20000):
+    """Trim fastq files in batches, returning output text in input order.
+
+    With multiple cores, batches are trimmed in a pool of processes with a
+    limited number of batches in flight.
+    """
+    args = ((batch, to_trim, min_length, compress)
+            for batch in _line_batches(in_handles, batch_size))
+    if cores <= 1:
+        for x in itertools.imap(_trim_batch, args):
+            yield x
     else:
-        return None, None
+        import multiprocessing
+        pool = multiprocessing.Pool(cores)
+        pending = collections.deque()
+        try:
+            for cur_args in args:
+                pending.append(pool.apply_async(_trim_batch, (cur_args,)))
+                while len(pending) >= 2 * cores:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
 
 @contextlib.contextmanager
 def _work_handles(in_files, dirs, ext):
@@ -28,12 +89,16 @@ def _work_handles(in_files, dirs, ext):
     in_handles = {}
     name_map = {}
     for in_file in in_files:
-        out_file = os.path.join(out_dir, "{base}{ext}".format(
-            base=os.path.splitext(os.path.basename(in_file))[0], ext=ext))
+        base, gz_ext = os.path.basename(in_file), ""
+        if base.endswith(".gz"):
+            base, gz_ext = base[:-3], ".gz"
+        out_file = os.path.join(out_dir, "{base}{ext}{gz_ext}".format(
+            base=os.path.splitext(base)[0], ext=ext, gz_ext=gz_ext))
         name_map[in_file] = out_file
         if not file_exists(out_file):
-            in_handles[in_file] = open(in_file)
-            out_handles[in_file] = open(out_file, "w")
+            in_handles[in_file] = (gzip.open(in_file) if gz_ext
+                                   else open(in_file))
+            out_handles[in_file] = open(out_file, "wb")
     try:
         yield in_handles, out_handles, name_map
     finally:
@@ -42,30 +107,12 @@ def _work_handles(in_files, dirs, ext):
         for h in out_handles.values():
             h.close()
 
-def _trim_by_read(in_handles, to_trim, min_length):
-    """Lazy generator for trimmed reads for all input files.
-    """
-    iterators = [(f, FastqGeneralIterator(h)) for f, h in in_handles.iteritems()]
-    f1, x1 = iterators[0]
-    for name, seq, qual in x1:
-        out = {}
-        tseq, tqual = _trim_quality(seq, qual, to_trim, min_length)
-        if tseq:
-            out[f1] = (name, tseq, tqual)
-        for f2, x2 in iterators[1:]:
-            name, seq, qual = x2.next()
-            tseq, tqual = _trim_quality(seq, qual, to_trim, min_length)
-            if tseq:
-                out[f2] = (name, tseq, tqual)
-        if len(out) == len(iterators):
-            yield out
-
 def _save_diskspace(in_file, out_file, config):
     """Potentially remove input file to save space if configured and in work directory.
     """
     if (os.path.commonprefix([in_file, out_file]) ==
         os.path.split(os.path.dirname(out_file))[0]):
-        utils.save_diskspace(in_file, "Trimmed to {}".format(out_file), config)
+        save_diskspace(in_file, "Trimmed to {}".format(out_file), config)
 
 def brun_trim_fastq(fastq_files, dirs, config):
     """Trim FASTQ files, removing low quality B-runs.
@@ -77,16 +124,21 @@ def brun_trim_fastq(fastq_files, dirs, config):
     http://genomebiology.com/2011/12/11/R112
 
     Does simple trimming of problem ends and removes read pairs where
-    any of the trimmed read sizes falls below the allowable size.
+    any of the trimmed read sizes falls below the allowable size. Paired
+    files are trimmed in batches across the configured cores; gzipped
+    inputs produce gzipped outputs.
     """
     qual_format = config["algorithm"].get("quality_format", "").lower()
     min_length = int(config["algorithm"].get("min_read_length", 20))
     to_trim = "B" if qual_format == "illumina" else "#"
     with _work_handles(fastq_files, dirs, "-qtrim.txt") as (in_handles, out_handles, out_fnames):
         if len(out_handles) == len(fastq_files):
-            for next_reads in _trim_by_read(in_handles, to_trim, min_length):
-                for fname, (name, seq, qual) in next_reads.iteritems():
-                    out_handles[fname].write("@%s\n%s\n+\n%s\n" % (name, seq, qual))
+            compress = [out_fnames[x].endswith(".gz") for x in fastq_files]
+            for out_texts in _trim_batches([in_handles[x] for x in fastq_files],
+                                           to_trim, min_length, compress,
+                                           process_cores(config)):
+                for fname, text in zip(fastq_files, out_texts):
+                    out_handles[fname].write(text)
         out_files = [out_fnames[x] for x in fastq_files]
         for inf, outf in zip(fastq_files, out_files):
             _save_diskspace(inf, outf, config)
@@ -0,0 +1,576 @@
+"""Identify barcodes in fastq reads, trimming and sorting them into files.
+
+This is the engine behind barcode_sort_trim.py, also used directly by the
+pipeline to demultiplex lanes. Barcodes are matched allowing mismatches and,
+optionally, insertions and deletions, with the barcode position in the reads
+configurable.
+"""
+from __future__ import with_statement
+import gzip
+import os
+import struct
+import zlib
+import itertools
+import collections
+import csv
+
+from Bio import pairwise2
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+
+def sort_by_barcode(barcodes, out_format, in1, in2=None, in3=None, mismatch=1,
+                    bc_offset=0, bc_read_i=1, three_end=True,
+                    allow_indels=True, metrics_file=None, tag_title=False,
+                    precompute=False, cores=1, trim_sizes=None,
+                    verbose=False):
+    """Identify, trim and sort reads into separate files by barcode.
+
+    barcodes is a dictionary of barcode sequence to barcode name, and
+    out_format an output file name with --b-- and --r-- placeholders for the
+    barcode name and read number. trim_sizes is an optional dictionary of
+    barcode name to a number of bases to chop off the barcode read for reads
+    sorted to that barcode, commonly unmatched reads. Returns a dictionary
+    of read counts by barcode name.
+    """
+    stats = collections.defaultdict(int)
+    out_writer = output_to_fastq(out_format, cores)
+    matcher = _get_matcher(barcodes, mismatch, allow_indels, precompute)
+    if verbose and matcher.collisions:
+        print "Warning: %s sequences are within %s mismatches of " \
+              "multiple barcodes" % (len(matcher.collisions), mismatch)
+    reads = itertools.izip(read_fastq(in1), read_fastq(in2), read_fastq(in3))
+    if cores > 1:
+        batches = _parallel_demultiplex(reads, cores,
+                (barcodes, mismatch, allow_indels, precompute),
+                (bc_read_i, three_end, bc_offset, tag_title, trim_sizes))
+        for bc_counts, bc_texts in batches:
+            for bc_name, texts in bc_texts:
+                for read_num, text in enumerate(texts):
+                    if text:
+                        out_writer.write_text(bc_name, read_num + 1, text)
+            for bc_name, count in bc_counts.iteritems():
+                stats[bc_name] += count
+    else:
+        for bc_name, (name1, seq1, qual1), (name2, seq2, qual2), \
+                (name3, seq3, qual3) in _classify_reads(reads, matcher,
+                        bc_read_i, three_end, bc_offset, tag_title,
+                        trim_sizes):
+            out_writer(bc_name, name1, seq1, qual1, name2, seq2, qual2,
+                       name3, seq3, qual3)
+            stats[bc_name] += 1
+    out_writer.close()
+    if metrics_file:
+        with open(metrics_file, "w") as out_handle:
+            writer = csv.writer(out_handle, dialect="excel-tab")
+            for bc in sorted_barcodes(stats):
+                writer.writerow([bc, stats[bc]])
+    return dict(stats)
+
+
+def sorted_barcodes(stats):
+    """Order barcode names numerically where possible.
+    """
+    sort_bcs = []
+    for bc in stats.keys():
+        try:
+            sort_bc = float(bc)
+        except ValueError:
+            sort_bc = str(bc)
+        sort_bcs.append((sort_bc, bc))
+    sort_bcs.sort()
+    return [s[1] for s in sort_bcs]
+
+
+def _get_matcher(barcodes, mismatch, allow_indels, precompute):
+    if precompute:
+        return barcode_matcher(barcodes, mismatch, allow_indels)
+    matcher = lambda end_gen: best_match(end_gen, barcodes, mismatch,
+                                         allow_indels)
+    matcher.collisions = set()
+    return matcher
+
+
+def _classify_reads(reads, matcher, bc_read_i, three_end, bc_offset,
+                    tag_title, trim_sizes=None):
+    """Identify and trim barcodes from tuples of read 1, 2 and 3 records.
+
+    Yields the barcode name and trimmed (name, seq, qual) for each read.
+    """
+    for (name1, seq1, qual1), (name2, seq2, qual2), (name3, seq3, qual3) in reads:
+        end_gen = end_generator(seq1, seq2, seq3, bc_read_i, three_end, bc_offset)
+        bc_name, bc_seq, match_seq = matcher(end_gen)
+        seq1, qual1, seq2, qual2, seq3, qual3 = remove_barcode(
+                seq1, qual1, seq2, qual2, seq3, qual3,
+                match_seq, bc_read_i, three_end, bc_offset)
+        if trim_sizes and bc_name in trim_sizes:
+            seq1, qual1, seq2, qual2, seq3, qual3 = trim_barcode_read(
+                    seq1, qual1, seq2, qual2, seq3, qual3,
+                    trim_sizes[bc_name], bc_read_i, three_end)
+        if tag_title:
+            name1 += " %s" % match_seq
+            name2 += " %s" % match_seq
+            name3 += " %s" % match_seq
+        yield (bc_name, (name1, seq1, qual1), (name2, seq2, qual2),
+               (name3, seq3, qual3))
+
+
+def _parallel_demultiplex(reads, cores, match_args, read_args,
+                          batch_size=10000):
+    """Classify batches of reads in a pool of worker processes.
+
+    Yields the output of _demultiplex_batch for each batch in input order,
+    keeping a limited number of batches in flight so memory stays bounded.
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(cores, _init_worker, match_args)
+    pending = collections.deque()
+    try:
+        while True:
+            batch = list(itertools.islice(reads, batch_size))
+            if not batch:
+                break
+            pending.append(pool.apply_async(_demultiplex_batch,
+                                            (batch,) + read_args))
+            while len(pending) >= 2 * cores:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+
+
+_worker_matcher = None
+
+
+def _init_worker(barcodes, mismatch, allow_indels, precompute):
+    global _worker_matcher
+    _worker_matcher = _get_matcher(barcodes, mismatch, allow_indels, precompute)
+
+
+def _demultiplex_batch(reads, bc_read_i, three_end, bc_offset, tag_title,
+                       trim_sizes):
+    """Classify and trim a batch of reads in a worker process.
+
+    Returns read counts by barcode, and the fastq text for reads 1, 2 and 3
+    of each barcode in the order barcodes were first seen.
+    """
+    counts = collections.defaultdict(int)
+    bc_texts = {}
+    bc_order = []
+    for bc_name, r1, r2, r3 in _classify_reads(reads, _worker_matcher,
+            bc_read_i, three_end, bc_offset, tag_title, trim_sizes):
+        try:
+            texts = bc_texts[bc_name]
+        except KeyError:
+            texts = ([], [], [])
+            bc_texts[bc_name] = texts
+            bc_order.append(bc_name)
+        for i, (name, seq, qual) in enumerate([r1, r2, r3]):
+            if i == 0 or seq:
+                texts[i].append("@{0}\n{1}\n+\n{2}\n".format(name, seq, qual))
+        counts[bc_name] += 1
+    return (dict(counts), [(bc_name, ["".join(t) for t in bc_texts[bc_name]])
+                           for bc_name in bc_order])
+
+
+def best_match(end_gen, barcodes, mismatch, allow_indels=True):
+    """Identify barcode best matching to the test sequence, with mismatch.
+
+    Returns the barcode id, barcode sequence and match sequence.
+    unmatched is returned for items which can't be matched to a barcode within
+    the provided parameters.
+    """
+    if len(barcodes) == 1 and barcodes.values() == ["trim"]:
+        size = len(barcodes.keys()[0])
+        test_seq = end_gen(size)
+        return barcodes.values()[0], test_seq, test_seq
+
+    # easiest, fastest case -- exact match
+    sizes = list(set(len(b) for b in barcodes.keys()))
+    for s in sizes:
+        test_seq = end_gen(s)
+        try:
+            bc_id = barcodes[test_seq]
+            return bc_id, test_seq, test_seq
+        except KeyError:
+            pass
+
+    # check for best approximate match within mismatch values
+    match_info = []
+    if barcodes and (mismatch > 0 or _barcode_has_ambiguous(barcodes)):
+        if _barcode_very_ambiguous(barcodes):
+            gapopen_penalty = -18.0
+        else:
+            gapopen_penalty = -9.0
+        for bc_seq, bc_id in barcodes.iteritems():
+            test_seq = end_gen(len(bc_seq))
+            aligns = pairwise2.align.globalms(bc_seq, test_seq,
+                    5.0, -4.0, gapopen_penalty, -0.5, one_alignment_only=True)
+            (abc_seq, atest_seq) = aligns[0][:2] if len(aligns) == 1 else ("", "")
+            matches = sum(1 for i, base in enumerate(abc_seq)
+                          if (base == atest_seq[i] or base == "N"))
+            gaps = abc_seq.count("-")
+            cur_mismatch = len(test_seq) - matches + gaps
+            if cur_mismatch <= mismatch and (allow_indels or gaps == 0):
+                match_info.append((cur_mismatch, bc_id, abc_seq, atest_seq))
+    if len(match_info) > 0:
+        match_info.sort()
+        name, bc_seq, test_seq = match_info[0][1:]
+        return name, bc_seq.replace("-", ""), test_seq.replace("-", "")
+    else:
+        return "unmatched", "", ""
+
+
+def barcode_matcher(barcodes, mismatch, allow_indels=True, cache_size=100000):
+    """Prepare a barcode matching function using precomputed mismatches.
+
+    Every sequence within the allowed number of substitutions of a barcode is
+    precomputed into a lookup table, so only reads needing insertions or
+    deletions reach the pairwise alignment in best_match. Results for
+    previously seen barcode sequences are cached.
+
+    Returns a function taking an end generator and returning the same
+    barcode id, barcode sequence and match sequence as best_match. The
+    function has a collisions attribute listing sequences equally close to
+    more than one barcode; these go to the barcode sorting first, as in
+    best_match.
+    """
+    if len(barcodes) == 1 and barcodes.values() == ["trim"]:
+        match = lambda end_gen: best_match(end_gen, barcodes, mismatch,
+                                           allow_indels)
+        match.collisions = set()
+        return match
+    sizes = sorted(set(len(b) for b in barcodes.keys()))
+    lookup, collisions = mismatch_neighborhood(barcodes, mismatch)
+    cache = _LRUCache(cache_size)
+
+    def match(end_gen):
+        ends = tuple(end_gen(s) for s in sizes)
+        try:
+            return cache[ends]
+        except KeyError:
+            pass
+        result = None
+        if lookup is not None:
+            best = None
+            for test_seq in ends:
+                hit = lookup.get(test_seq)
+                if hit is not None and (best is None or hit[:2] < best[0][:2]):
+                    best = (hit, test_seq)
+            if best is not None:
+                (_, bc_id, bc_seq), test_seq = best
+                result = (bc_id, bc_seq, test_seq)
+            elif not allow_indels:
+                result = ("unmatched", "", "")
+        if result is None:
+            result = best_match(end_gen, barcodes, mismatch, allow_indels)
+        cache[ends] = result
+        return result
+    match.collisions = collisions
+    return match
+
+
+def mismatch_neighborhood(barcodes, mismatch, max_size=2000000):
+    """Precompute all sequences within mismatch substitutions of barcodes.
+
+    N bases in barcodes match any read base, while N bases in reads count
+    as mismatches, following best_match. Returns a dictionary of sequence to
+    (mismatches, barcode id, barcode sequence) with the closest barcode, and
+    the set of sequences at the same distance from multiple barcodes. If the
+    table would grow larger than max_size, as with highly ambiguous
+    barcodes, (None, set()) is returned.
+    """
+    lookup = {}
+    collisions = set()
+    for bc_seq, bc_id in barcodes.iteritems():
+        for test_seq, dist in _mismatch_neighbors(bc_seq, mismatch):
+            cur = lookup.get(test_seq)
+            if cur is not None and cur[0] == dist and cur[1] != bc_id:
+                collisions.add(test_seq)
+            if cur is None or (dist, bc_id) < cur[:2]:
+                lookup[test_seq] = (dist, bc_id, bc_seq)
+                if len(lookup) > max_size:
+                    return None, set()
+    return lookup, collisions
+
+
+def _mismatch_neighbors(bc_seq, mismatch):
+    """Generate (sequence, mismatches) for sequences close to a barcode.
+    """
+    bases = "ACGTN"
+    choices = []
+    for base in bc_seq:
+        if base == "N":
+            choices.append([(b, 0) for b in bases])
+        else:
+            choices.append([(base, 0)] + [(b, 1) for b in bases if b != base])
+    stack = [(0, "", 0)]
+    while stack:
+        i, prefix, dist = stack.pop()
+        if i == len(choices):
+            yield prefix, dist
+        else:
+            for base, cost in choices[i]:
+                if dist + cost <= mismatch:
+                    stack.append((i + 1, prefix + base, dist + cost))
+
+
+class _LRUCache:
+    """Bounded cache dropping the least recently used half when full.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._data = {}
+        self._tick = 0
+
+    def __getitem__(self, key):
+        val, _ = self._data[key]
+        self._tick += 1
+        self._data[key] = (val, self._tick)
+        return val
+
+    def __setitem__(self, key, val):
+        if len(self._data) >= self._max_size:
+            by_use = sorted(self._data.iteritems(), key=lambda x: x[1][1])
+            for old_key, _ in by_use[:len(by_use) // 2 + 1]:
+                del self._data[old_key]
+        self._tick += 1
+        self._data[key] = (val, self._tick)
+
+
+def _barcode_very_ambiguous(barcodes):
+    max_size = max(len(x) for x in barcodes.keys())
+    max_ns = max(x.count("N") for x in barcodes.keys())
+    return float(max_ns) / float(max_size) > 0.5
+
+
+def _barcode_has_ambiguous(barcodes):
+    for seq in barcodes.keys():
+        if "N" in seq:
+            return True
+    return False
+
+
+def end_generator(seq1, seq2=None, seq3=None, bc_read_i=1, three_end=True, bc_offset=0):
+    """Function which pulls a barcode of a provided size from paired seqs.
+
+    This respects the provided details about location of the barcode, returning
+    items of the specified size to check against the read.
+    """
+    seq_choice = {1: seq1, 2: seq2, 3: seq3}
+    seq = seq_choice[bc_read_i]
+    assert seq is not None
+
+    def _get_end(size):
+        assert size > 0
+        if three_end:
+            return seq[-size - bc_offset:len(seq) - bc_offset]
+        else:
+            return seq[bc_offset:size + bc_offset]
+    return _get_end
+
+
+def _remove_from_end(seq, qual, match_seq, three_end, bc_offset):
+    if match_seq:
+        if three_end:
+            assert seq[-len(match_seq) - bc_offset:len(seq) - bc_offset] == match_seq
+            seq = seq[:-len(match_seq) - bc_offset]
+            qual = qual[:-len(match_seq) - bc_offset]
+        else:
+            assert seq[bc_offset:len(match_seq) + bc_offset] == match_seq
+            seq = seq[len(match_seq) + bc_offset:]
+            qual = qual[len(match_seq) + bc_offset:]
+    return seq, qual
+
+
+def trim_barcode_read(seq1, qual1, seq2, qual2, seq3, qual3, size, bc_read_i,
+                      three_end):
+    """Chop a fixed number of bases from the barcode end of the barcode read.
+    """
+    if three_end:
+        trimmer = lambda x: x[:-size]
+    else:
+        trimmer = lambda x: x[size:]
+    if bc_read_i == 1:
+        seq1, qual1 = trimmer(seq1), trimmer(qual1)
+    elif bc_read_i == 2:
+        seq2, qual2 = trimmer(seq2), trimmer(qual2)
+    else:
+        seq3, qual3 = trimmer(seq3), trimmer(qual3)
+    return seq1, qual1, seq2, qual2, seq3, qual3
+
+
+def remove_barcode(seq1, qual1, seq2, qual2, seq3, qual3,
+                   match_seq, bc_read_i, three_end, bc_offset=0):
+    """Trim found barcode from the appropriate sequence end.
+    """
+    if bc_read_i == 1:
+        seq1, qual1 = _remove_from_end(seq1, qual1, match_seq, three_end, bc_offset)
+    elif bc_read_i == 2:
+        assert seq2 and qual2
+        seq2, qual2 = _remove_from_end(seq2, qual2, match_seq, three_end, bc_offset)
+    else:
+        assert bc_read_i == 3
+        assert seq3 and qual3
+        seq3, qual3 = _remove_from_end(seq3, qual3, match_seq, three_end, bc_offset)
+    return seq1, qual1, seq2, qual2, seq3, qual3
+
+
+# BGZF limits blocks to 64kb compressed, which this input size guarantees
+_BGZF_BLOCK_SIZE = 65280
+_BGZF_EOF = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+             "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def _bgzf_block(data):
+    """Compress data into a single BGZF gzip member.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6,
+                         66, 67, 2, len(cdata) + 25)
+    footer = struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                         len(data) & 0xffffffff)
+    return header + cdata + footer
+
+
+class BlockGzipWriter:
+    """Write gzip output as independently compressed BGZF blocks.
+
+    Blocks are compressed in an optional thread pool, and written in order
+    as they finish. The output is a valid multi-member gzip file.
+    """
+    def __init__(self, fname, pool=None, max_pending=8):
+        self._handle = open(fname, "wb")
+        self._pool = pool
+        self._max_pending = max_pending
+        self._buffer = []
+        self._buffer_size = 0
+        self._pending = collections.deque()
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffer_size += len(text)
+        if self._buffer_size >= _BGZF_BLOCK_SIZE:
+            data = "".join(self._buffer)
+            end = len(data) - len(data) % _BGZF_BLOCK_SIZE
+            for start in xrange(0, end, _BGZF_BLOCK_SIZE):
+                self._add_block(data[start:start + _BGZF_BLOCK_SIZE])
+            self._buffer = [data[end:]]
+            self._buffer_size = len(data) - end
+
+    def _add_block(self, data):
+        if self._pool is None:
+            self._handle.write(_bgzf_block(data))
+        else:
+            self._pending.append(self._pool.apply_async(_bgzf_block, (data,)))
+            while len(self._pending) > self._max_pending:
+                self._handle.write(self._pending.popleft().get())
+
+    def close(self):
+        if self._buffer_size > 0:
+            self._add_block("".join(self._buffer))
+        self._buffer = []
+        self._buffer_size = 0
+        while self._pending:
+            self._handle.write(self._pending.popleft().get())
+        self._handle.write(_BGZF_EOF)
+        self._handle.close()
+
+
+def _get_handle(fname, out_handles, pool=None):
+    try:
+        out_handle = out_handles[fname]
+    except KeyError:
+        if os.path.splitext(fname)[1] == ".gz":
+            out_handle = BlockGzipWriter(fname, pool)
+        else:
+            out_handle = open(fname, "w")
+        out_handles[fname] = out_handle
+    return out_handle
+
+
+def _write_to_handles(name, seq, qual, fname, out_handles, pool=None):
+    out_handle = _get_handle(fname, out_handles, pool)
+    out_handle.write("@{0}\n{1}\n+\n{2}\n".format(name, seq, qual))
+
+
+def output_to_fastq(output_base, compress_threads=1):
+    """Write a set of paired end reads as fastq, managing output handles.
+
+    The returned function also has a write_text attribute for writing
+    preformatted fastq text for a barcode and read number, and a close
+    attribute to close all output handles. gzip output is compressed with
+    compress_threads threads.
+    """
+    work_dir = os.path.dirname(output_base)
+    if not os.path.exists(work_dir) and work_dir:
+        try:
+            os.makedirs(work_dir)
+        except OSError:
+            assert os.path.isdir(work_dir)
+
+    out_handles = dict()
+    if compress_threads > 1 and os.path.splitext(output_base)[1] == ".gz":
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(compress_threads)
+    else:
+        pool = None
+
+    def write_reads(barcode, name1, seq1, qual1, name2, seq2, qual2,
+                    name3, seq3, qual3):
+        read1name = output_base.replace("--r--", "1").replace("--b--", barcode)
+        _write_to_handles(name1, seq1, qual1, read1name, out_handles, pool)
+        if seq2:
+            read2name = output_base.replace("--r--", "2").replace("--b--", barcode)
+            _write_to_handles(name2, seq2, qual2, read2name, out_handles, pool)
+
+        if seq3:
+            read3name = output_base.replace("--r--", "3").replace("--b--", barcode)
+            _write_to_handles(name3, seq3, qual3, read3name, out_handles, pool)
+
+    def write_text(barcode, read_num, text):
+        fname = output_base.replace("--r--", str(read_num)).replace("--b--", barcode)
+        _get_handle(fname, out_handles, pool).write(text)
+
+    def close():
+        for out_handle in out_handles.values():
+            out_handle.close()
+        out_handles.clear()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    write_reads.write_text = write_text
+    write_reads.close = close
+    return write_reads
+
+
+def read_barcodes(fname):
+    barcodes = {}
+    with open(fname) as in_handle:
+        for line in (l for l in in_handle if not l.startswith("#")):
+            name, seq = line.rstrip("\r\n").split()
+            barcodes[seq] = name
+
+    return barcodes
+
+
+def read_fastq(fname):
+    """Provide read info from fastq file, potentially not existing.
+    """
+    if not fname:
+        for info in itertools.repeat(("", None, None)):
+            yield info
+
+    if os.path.splitext(fname)[1] == ".gz":
+        open_file = gzip.open
+    else:
+        open_file = open
+
+    with open_file(fname) as in_handle:
+        for info in FastqGeneralIterator(in_handle):
+            yield info
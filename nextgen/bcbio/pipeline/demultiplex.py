@@ -2,15 +2,15 @@
 """
 import os
 import copy
-import subprocess
 import glob
+import xml.etree.ElementTree as ET
 
 from collections import defaultdict
 
-from Bio import SeqIO
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 from bcbio import utils
+from bcbio.pipeline import barcode
 from bcbio.pipeline.fastq import get_fastq_files
 from bcbio.distributed.transaction import file_transaction
 from bcbio.log import logger2
@@ -50,35 +50,30 @@ def split_by_barcode(fastq1, fastq2, multiplex, base_name, dirs, config):
         bc_file2 = fq_fname("2") if fastq2 else None
         out_files.append((info["barcode_id"], bc_file1, bc_file2))
 
-    if not utils.file_exists(bc_dir) and not demultiplexed:
-        with file_transaction(bc_dir) as tx_bc_dir:
-            with utils.chdir(tx_bc_dir):
-                tag_file, need_trim = _make_tag_file(multiplex, unmatched_str, config)
-                cl = [config["program"]["barcode"], tag_file,
-                      "%s_--b--_--r--_fastq.txt" % base_name, fastq1]
-                if fastq2:
-                    cl.append(fastq2)
-
-                cl.append("--mismatch=%s" % config["algorithm"]["bc_mismatch"])
-                cl.append("--metrics=%s" % metrics_file)
-                if int(config["algorithm"]["bc_read"]) > 1:
-                    cl.append("--read=%s" % config["algorithm"]["bc_read"])
-
-                if int(config["algorithm"]["bc_position"]) == 5:
-                    cl.append("--five")
-
-                if config["algorithm"].get("bc_allow_indels", True) is False:
-                    cl.append("--noindel")
-
-                if "bc_offset" in config["algorithm"]:
-                    cl.append("--bc_offset=%s" % config["algorithm"]["bc_offset"])
-
-                subprocess.check_call(cl)
-
-    else:
-        with utils.curdir_tmpdir() as tmp_dir:
-            with utils.chdir(tmp_dir):
-                _, need_trim = _make_tag_file(multiplex, unmatched_str, config)
+    barcodes, need_trim = _get_barcodes(multiplex, unmatched_str, config)
+    if not demultiplexed:
+        # reads needing trimming are trimmed while sorting; barcode
+        # directories from earlier runs lack the flag and hold untrimmed reads
+        trimmed_flag = os.path.join(bc_dir, "%s_sort_trimmed" % base_name)
+        if not utils.file_exists(bc_dir):
+            with file_transaction(bc_dir) as tx_bc_dir:
+                utils.safe_makedir(tx_bc_dir)
+                barcode.sort_by_barcode(barcodes,
+                        os.path.join(tx_bc_dir, "%s_--b--_--r--_fastq.txt" % base_name),
+                        fastq1, fastq2,
+                        mismatch=int(config["algorithm"]["bc_mismatch"]),
+                        bc_offset=int(config["algorithm"].get("bc_offset", 0)),
+                        bc_read_i=int(config["algorithm"]["bc_read"]),
+                        three_end=int(config["algorithm"]["bc_position"]) != 5,
+                        allow_indels=config["algorithm"].get("bc_allow_indels", True) is not False,
+                        metrics_file=os.path.join(tx_bc_dir, metrics_file),
+                        cores=utils.process_cores(config),
+                        trim_sizes=dict((b, len(seq)) for b, seq in need_trim.items()))
+                with open(os.path.join(tx_bc_dir,
+                                       os.path.basename(trimmed_flag)), "w") as out_handle:
+                    out_handle.write("%s\n" % ",".join(sorted(need_trim.keys())))
+        if os.path.exists(trimmed_flag):
+            need_trim = {}
 
     out = {}
     for b, f1, f2 in out_files:
@@ -201,17 +196,17 @@ def _basic_trim(f1, f2, trim_seq, config):
     return (trim_file, f2) if is_first else (f1, trim_file)
 
 
-def _make_tag_file(barcodes, unmatched_str, config):
+def _get_barcodes(barcodes, unmatched_str, config):
+    """Retrieve barcode sequences to names, and barcodes needing trimming.
+    """
     need_trim = {}
-    tag_file = "%s-barcodes.cfg" % barcodes[0].get("barcode_type", "barcode")
-    barcodes = _adjust_illumina_tags(barcodes, config)
-    with open(tag_file, "w") as out_handle:
-        for bc in barcodes:
-            if bc["barcode_id"] != unmatched_str:
-                out_handle.write("%s %s\n" % (bc["barcode_id"], bc["sequence"]))
-            else:
-                need_trim[bc["barcode_id"]] = bc["sequence"]
-    return tag_file, need_trim
+    bc_seqs = {}
+    for bc in _adjust_illumina_tags(barcodes, config):
+        if bc["barcode_id"] != unmatched_str:
+            bc_seqs[bc["sequence"]] = str(bc["barcode_id"])
+        else:
+            need_trim[bc["barcode_id"]] = bc["sequence"]
+    return bc_seqs, need_trim
 
 
 def _adjust_illumina_tags(barcodes, config):
@@ -307,15 +302,65 @@ def add_multiplex_across_lanes(run_items, fastq_dir, fc_name):
 
 def _get_fastq_size(item, fastq_dir, fc_name):
     """Retrieve the size of reads from the first flowcell sequence.
+
+    Only the first record of the fastq file is read. Lanes without fastq
+    files fall back to the read configuration in the RunInfo.xml of the
+    flowcell.
     """
-    (fastq1, _) = get_fastq_files(fastq_dir, None, item, fc_name, unpack=False)
-    with open(fastq1) as in_handle:
-        try:
-            if fastq1.endswith(".gz"):
-                in_handle = gzip.GzipFile(fileobj=in_handle)
-                
-            rec = SeqIO.parse(in_handle, "fastq").next()
-            size = len(rec.seq)
-        except StopIteration:
-            size = 0
+    try:
+        (fastq1, _) = get_fastq_files(fastq_dir, None, item, fc_name, unpack=False)
+    except ValueError:
+        size = _run_info_read_size(fastq_dir)
+        if size is None:
+            raise
+    else:
+        size = _first_read_size(fastq1)
     return size
+
+
+_read_size_cache = {}
+
+def _first_read_size(fastq_file):
+    """Size of the first read in a fastq file, or 0 for empty files.
+
+    Sizes are cached by file path and modification time, so a fastq file
+    which is rewritten is read again.
+    """
+    key = (os.path.abspath(fastq_file), os.path.getmtime(fastq_file))
+    try:
+        return _read_size_cache[key]
+    except KeyError:
+        pass
+    if fastq_file.endswith(".gz"):
+        in_handle = gzip.open(fastq_file)
+    else:
+        in_handle = open(fastq_file)
+    try:
+        in_handle.readline()
+        seq = in_handle.readline()
+    finally:
+        in_handle.close()
+    size = len(seq.rstrip("\r\n"))
+    _read_size_cache[key] = size
+    return size
+
+
+def _run_info_read_size(fastq_dir, max_depth=5):
+    """Size of the first non-index read from RunInfo.xml above a fastq directory.
+    """
+    cur_dir = os.path.abspath(fastq_dir)
+    for _ in range(max_depth):
+        run_info_file = os.path.join(cur_dir, "RunInfo.xml")
+        if os.path.exists(run_info_file):
+            tree = ET.ElementTree()
+            tree.parse(run_info_file)
+            for read in tree.find("Run/Reads"):
+                if read.get("IsIndexedRead", "N") != "Y":
+                    if read.get("NumCycles") is None:
+                        # older RTA versions list the cycle range instead
+                        return (int(read.get("LastCycle")) -
+                                int(read.get("FirstCycle")) + 1)
+                    return int(read.get("NumCycles"))
+            return None
+        cur_dir = os.path.dirname(cur_dir)
+    return None
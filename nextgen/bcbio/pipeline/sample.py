@@ -9,7 +9,7 @@ import subprocess
 
 from bcbio import broad
 from bcbio.broad.picardrun import picard_mark_duplicates
-from bcbio.utils import file_exists, save_diskspace
+from bcbio.utils import file_exists, save_diskspace, process_cores
 from bcbio.distributed.transaction import file_transaction
 from bcbio.pipeline.lane import _update_config_w_custom
 from bcbio.log import logger2 as logger
@@ -122,7 +122,8 @@ def generate_bigwig(data):
     if not file_exists(wig_file):
         with file_transaction(wig_file) as tx_file:
             cl = [data["config"]["analysis"]["towig_script"], bam_file,
-                  data["config_file"], "--outfile=%s" % tx_file]
+                  data["config_file"], "--outfile=%s" % tx_file,
+                  "--cores=%s" % process_cores(data["config"])]
             subprocess.check_call(cl)
 
     data["bigwig_file"] = wig_file
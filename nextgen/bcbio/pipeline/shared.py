@@ -1,12 +1,14 @@
 """Pipeline functionality shared amongst multiple analysis types.
 """
 import os
+import bisect
 import collections
 from contextlib import closing
 
 import pysam
 
 from bcbio import broad
+from bcbio.bam import bam_index, index_stats
 from bcbio.pipeline.alignment import get_genome_ref
 from bcbio.utils import file_exists, safe_makedir, save_diskspace
 from bcbio.distributed.transaction import file_transaction
@@ -25,8 +27,17 @@ def combine_bam(in_files, out_file, config):
     return out_file
 
 
-def split_bam_by_chromosome(output_ext, file_key, default_targets=None):
+def split_bam_by_chromosome(output_ext, file_key, default_targets=None,
+                            presplit=False, balanced=False):
     """Provide targets to process a BAM file by individual chromosome regions.
+
+    With presplit, BAM files without an index are divided into the regions
+    in a single pass, with parts named as subset_bam_by_region and
+    write_nochr_reads expect. Indexed BAM files are subset by each region
+    process.
+
+    With balanced, indexed BAM files are divided into regions with similar
+    numbers of reads using plan_regions.
     """
     if default_targets is None:
         default_targets = []
@@ -40,27 +51,220 @@ def split_bam_by_chromosome(output_ext, file_key, default_targets=None):
             work_dir = safe_makedir(
                 "{base}-split".format(base=os.path.splitext(out_file)[0]))
 
-            with closing(pysam.Samfile(bam_file, "rb")) as work_bam:
-                for chr_ref in list(work_bam.references) + default_targets:
-                    chr_out = os.path.join(work_dir,
-                                           "{base}-{ref}{ext}".format(
-                                               base=os.path.splitext(os.path.basename(bam_file))[0],
-                                               ref=chr_ref, ext=output_ext))
-                    part_info.append((chr_ref, chr_out))
+            regions = None
+            if balanced:
+                regions = plan_regions(bam_file, _num_regions(data["config"]))
+            if regions is None:
+                with closing(pysam.Samfile(bam_file, "rb")) as work_bam:
+                    regions = list(work_bam.references)
+            for chr_ref in regions + default_targets:
+                chr_out = os.path.join(work_dir,
+                                       "{base}-{ref}{ext}".format(
+                                           base=os.path.splitext(os.path.basename(bam_file))[0],
+                                           ref=region_name(chr_ref), ext=output_ext))
+                part_info.append((chr_ref, chr_out))
+            if presplit and bam_index(bam_file) is None:
+                part_files = {}
+                for chr_ref, chr_out in part_info:
+                    if chr_ref == "nochr":
+                        part_files[chr_ref] = chr_out
+                    else:
+                        part_files[chr_ref] = _subset_file(bam_file, chr_ref,
+                                                           chr_out)
+                split_bam_by_region(bam_file, part_files)
 
         return out_file, part_info
 
     return _do_work
 
 
+def _num_regions(config):
+    """Number of regions to plan, a few for each core to even out run times.
+    """
+    num_regions = config["algorithm"].get("num_regions", None)
+    if num_regions is None:
+        num_cores = config["algorithm"].get("num_cores", 1)
+        try:
+            num_regions = 4 * int(num_cores)
+        except ValueError:
+            num_regions = 100
+    return int(num_regions)
+
+
+# ## Genomic regions
+
+_BAI_WINDOW = 16384
+
+
+def plan_regions(bam_file, num_regions, batch_contigs=True):
+    """Divide a BAM file into regions with similar numbers of reads.
+
+    Read counts for each reference come from the BAM index. References with
+    more reads than a region are split, preferring breaks in 16kb windows
+    without reads, and smaller references are batched together as lists of
+    reference names when batch_contigs is set. Regions are GATK style
+    chr:start-end strings. Returns None for BAMs without an index, or with
+    an index that has no read counts.
+    """
+    index_file = bam_index(bam_file)
+    if index_file is None:
+        return None
+    with closing(pysam.Samfile(bam_file, "rb")) as work_bam:
+        refs = zip(work_bam.references, work_bam.lengths)
+    ref_stats, _ = index_stats(index_file)
+    works = [x["mapped"] + x["unmapped"] for x in ref_stats]
+    # older indexes lack the pseudo-bin with read counts
+    if sum(works) == 0:
+        return None
+    target = max(1.0, float(sum(works)) / max(1, num_regions))
+    regions = []
+    batch, batch_work = [], 0
+    for (name, size), stats, work in zip(refs, ref_stats, works):
+        num_parts = int(round(work / target))
+        if num_parts > 1:
+            regions.extend(_split_reference(name, size, stats["intervals"],
+                                            num_parts))
+        elif batch_contigs:
+            if batch and batch_work + work > target:
+                regions.append(batch[0] if len(batch) == 1 else batch)
+                batch, batch_work = [], 0
+            batch.append(name)
+            batch_work += work
+        else:
+            regions.append(name)
+    if batch:
+        regions.append(batch[0] if len(batch) == 1 else batch)
+    return regions
+
+
+def _split_reference(name, size, intervals, num_parts):
+    """Split a reference into parts with similar amounts of reads.
+
+    Uses compressed file offsets from the BAI linear index as a measure of
+    reads in each window, falling back to equal sized parts.
+    """
+    offsets = []
+    for ioffset in intervals:
+        coffset = ioffset >> 16
+        offsets.append(coffset if coffset or not offsets else offsets[-1])
+    first = [x for x in offsets if x]
+    offsets = [x or (first[0] if first else 0) for x in offsets]
+    breaks = []
+    if len(offsets) > 1 and offsets[-1] > offsets[0]:
+        span = offsets[-1] - offsets[0]
+        for i in range(1, num_parts):
+            window = bisect.bisect_left(offsets,
+                                        offsets[0] + span * i // num_parts)
+            breaks.append(_gap_position(offsets, window))
+    else:
+        breaks = [size * i // num_parts for i in range(1, num_parts)]
+    breaks = sorted(set(b for b in breaks if 0 < b < size))
+    edges = [0] + breaks + [size]
+    return ["%s:%s-%s" % (name, start + 1, end)
+            for start, end in zip(edges[:-1], edges[1:])]
+
+
+def _gap_position(offsets, window, search=32):
+    """Find a break position in the window with the fewest reads nearby.
+    """
+    best = None
+    for i in range(max(0, window - search),
+                   min(len(offsets) - 1, window + search + 1)):
+        cur = (offsets[i + 1] - offsets[i], abs(i - window), i)
+        if best is None or cur < best:
+            best = cur
+    if best is None:
+        return window * _BAI_WINDOW
+    return best[2] * _BAI_WINDOW + _BAI_WINDOW // 2
+
+
+def region_name(region):
+    """Name for a region suitable for use in file names.
+    """
+    if isinstance(region, (list, tuple)):
+        region = "%s_%scontigs" % (region[0], len(region))
+    return region.replace(":", "_")
+
+
+def region_list(region):
+    """Retrieve a region, or batch of regions, as a list.
+    """
+    if region is None:
+        return []
+    elif isinstance(region, (list, tuple)):
+        return list(region)
+    else:
+        return [region]
+
+
+def parse_region(region):
+    """Split a chr:start-end region into chromosome and 0-based coordinates.
+    """
+    if ":" in region:
+        chrom, coords = region.rsplit(":", 1)
+        try:
+            start, end = [int(x) for x in coords.split("-")]
+            return chrom, start - 1, end
+        except ValueError:
+            pass
+    return region, None, None
+
+
+def split_bam_by_region(in_file, part_files):
+    """Write reads for multiple chromosome regions in one pass through a BAM.
+
+    part_files maps reference names to output files; reads without a
+    reference chromosome go to the "nochr" output if present.
+    """
+    to_write = dict((r, f) for r, f in part_files.iteritems()
+                    if not file_exists(f))
+    if len(to_write) == 0:
+        return part_files
+    regions = to_write.keys()
+    with closing(pysam.Samfile(in_file, "rb")) as in_bam:
+        tids = [-1 if r == "nochr" else in_bam.gettid(r) for r in regions]
+        with file_transaction(*[to_write[r] for r in regions]) as tx_files:
+            if isinstance(tx_files, basestring):
+                tx_files = [tx_files]
+            out_bams = [pysam.Samfile(f, "wb", template=in_bam)
+                        for f in tx_files]
+            try:
+                by_tid = dict(zip(tids, out_bams))
+                for read in in_bam:
+                    out_bam = by_tid.get(read.tid if read.tid >= 0 else -1)
+                    if out_bam is not None:
+                        out_bam.write(read)
+            finally:
+                for out_bam in out_bams:
+                    out_bam.close()
+    return part_files
+
+
+def _nochr_offset(index_file):
+    """Virtual file offset of reads without a chromosome from a BAI index.
+
+    Coordinate sorted BAMs store these reads at the end of the file, after
+    the last chunk of placed reads recorded in the index. Returns None if
+    the BAM has no placed reads.
+    """
+    _, last_offset = index_stats(index_file)
+    return last_offset or None
+
+
 def write_nochr_reads(in_file, out_file):
     """Write a BAM file of reads that are not on a reference chromosome.
 
     This is useful for maintaining non-mapped reads in parallel processes
-    that split processing by chromosome.
+    that split processing by chromosome. With a BAM index, reading starts
+    at the end of the placed reads.
     """
     if not file_exists(out_file):
+        index_file = bam_index(in_file)
         with closing(pysam.Samfile(in_file, "rb")) as in_bam:
+            if index_file:
+                offset = _nochr_offset(index_file)
+                if offset is not None:
+                    in_bam.seek(offset)
             with file_transaction(out_file) as tx_out_file:
                 with closing(pysam.Samfile(tx_out_file, "wb", template=in_bam)) as out_bam:
                     for read in in_bam:
@@ -70,28 +274,60 @@ def write_nochr_reads(in_file, out_file):
     return out_file
 
 
-def subset_bam_by_region(in_file, region, out_file_base=None):
-    """Subset BAM files based on specified chromosome region.
-    """
+def _subset_file(in_file, region, out_file_base=None):
     if out_file_base is not None:
         base, ext = os.path.splitext(out_file_base)
     else:
         base, ext = os.path.splitext(in_file)
-    out_file = "%s-subset%s%s" % (base, region, ext)
+    return "%s-subset%s%s" % (base, region_name(region), ext)
+
+
+def subset_bam_by_region(in_file, region, out_file_base=None):
+    """Subset BAM files based on specified chromosome region.
+
+    region is a chromosome, a chr:start-end region or a list of these.
+    Reads are assigned to the region containing their start, so reads are
+    not duplicated across adjacent regions. Indexed BAM files only read the
+    region; others are read in full.
+    """
+    out_file = _subset_file(in_file, region, out_file_base)
     if not file_exists(out_file):
         with closing(pysam.Samfile(in_file, "rb")) as in_bam:
-            target_tid = in_bam.gettid(region)
-            assert region is not None, \
-                   "Did not find reference region %s in %s" % \
-                   (region, in_file)
+            has_index = bam_index(in_file) is not None
             with file_transaction(out_file) as tx_out_file:
                 with closing(pysam.Samfile(tx_out_file, "wb", template=in_bam)) as out_bam:
-                    for read in in_bam:
-                        if read.tid == target_tid:
-                            out_bam.write(read)
+                    for read in _region_reads(in_bam, in_file,
+                                              region_list(region), has_index):
+                        out_bam.write(read)
     return out_file
 
 
+def _region_reads(in_bam, in_file, regions, has_index):
+    """Retrieve reads starting in any of a list of regions.
+    """
+    targets = []
+    for region in regions:
+        chrom, start, end = parse_region(region)
+        target_tid = in_bam.gettid(chrom)
+        assert target_tid >= 0, \
+               "Did not find reference region %s in %s" % \
+               (region, in_file)
+        targets.append((chrom, target_tid, start, end))
+    if has_index:
+        for chrom, _, start, end in targets:
+            for read in in_bam.fetch(chrom, start, end):
+                if start is None or (read.pos >= start and read.pos < end):
+                    yield read
+    else:
+        for read in in_bam:
+            for _, target_tid, start, end in targets:
+                if read.tid == target_tid and (start is None or
+                                               (read.pos >= start and
+                                                read.pos < end)):
+                    yield read
+                    break
+
+
 # ## Retrieving file information from configuration variables
 
 def configured_ref_file(name, config, sam_ref):
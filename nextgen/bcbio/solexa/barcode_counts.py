@@ -0,0 +1,190 @@
+"""Streaming counts of the most common barcodes in sequencing reads.
+
+Used to report the top undetermined indexes of each lane in bounded memory.
+Fastq files can be read incrementally while CASAVA is still writing them.
+"""
+import os
+import csv
+import time
+import zlib
+
+from bcbio.solexa import INDEX_LOOKUP
+
+METRICS_FIELDS = ["lane", "sequence", "count", "index_name"]
+
+
+class TopBarcodeCounter:
+    """Approximate top barcode counts using the space-saving algorithm.
+
+    At most twice capacity barcodes are tracked. When the table fills, it is
+    cut back to the capacity most frequent barcodes and the largest dropped
+    count becomes a floor. Barcodes seen after that, including dropped ones
+    seen again, start counting from the floor and record it as their error.
+    A reported count is never below the true count and exceeds it by at most
+    the recorded error, which top() returns; only counts with zero error are
+    exact.
+    """
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        self._floor = 0
+
+    def add(self, barcode, count=1):
+        self.total += count
+        try:
+            self._counts[barcode] += count
+        except KeyError:
+            self._counts[barcode] = self._floor + count
+            if self._floor > 0:
+                self._errors[barcode] = self._floor
+            if len(self._counts) > 2 * self.capacity:
+                self._prune()
+
+    def update(self, barcodes):
+        for barcode in barcodes:
+            self.add(barcode)
+
+    def _prune(self):
+        by_count = sorted(self._counts.iteritems(), key=lambda x: -x[1])
+        for barcode, count in by_count[self.capacity:]:
+            self._floor = max(self._floor, count)
+            del self._counts[barcode]
+            self._errors.pop(barcode, None)
+
+    def top(self, num):
+        """Retrieve the num most common barcodes.
+
+        Returns a list of (barcode, count, maximum overcount) tuples.
+        """
+        by_count = sorted(self._counts.iteritems(),
+                          key=lambda x: (-x[1], x[0]))[:num]
+        return [(bc, count, self._errors.get(bc, 0)) for bc, count in by_count]
+
+
+def index_from_header(name, seq):
+    """Index sequence from a CASAVA 1.8 read name: 1:N:0:ACGTAC
+    """
+    return name.rsplit(":", 1)[-1].strip()
+
+
+def index_from_sequence(name, seq):
+    """Index sequence from the sequence of an index read.
+    """
+    return seq.strip()
+
+
+class FastqBarcodeReader:
+    """Incrementally retrieve barcodes from a fastq file as it is written.
+
+    gzip input is decompressed as data arrives, including multi-member
+    files, and barcodes are returned once a record's sequence is complete.
+    """
+    def __init__(self, fastq, barcode_fn=index_from_sequence):
+        self._handle = open(fastq, "rb")
+        self._barcode_fn = barcode_fn
+        self._decomp = (zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        if fastq.endswith(".gz") else None)
+        self._partial = ""
+        self._line_i = 0
+        self._name = None
+
+    def read(self, chunk_size=1048576):
+        """Retrieve barcodes for records in the next chunk of the file.
+
+        Returns None if no new data has been written.
+        """
+        # clear the end of file state so data written since the last read
+        # is seen
+        self._handle.seek(0, os.SEEK_CUR)
+        data = self._handle.read(chunk_size)
+        if not data:
+            return None
+        if self._decomp is not None:
+            data = self._decompress(data)
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        barcodes = []
+        for line in lines:
+            line_type = self._line_i % 4
+            if line_type == 0:
+                self._name = line
+            elif line_type == 1:
+                barcodes.append(self._barcode_fn(self._name, line))
+            self._line_i += 1
+        return barcodes
+
+    def _decompress(self, data):
+        out = []
+        while data:
+            out.append(self._decomp.decompress(data))
+            data = self._decomp.unused_data
+            # remaining data starts the next gzip member
+            if data:
+                self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return "".join(out)
+
+    def close(self):
+        self._handle.close()
+
+
+def count_lane_barcodes(fastqs, barcode_fn=index_from_sequence,
+                        capacity=10000, is_finished=None, poll_interval=60,
+                        max_reads=None):
+    """Count barcodes in fastq files for a lane.
+
+    Multiple files are read in parallel with their barcodes concatenated,
+    as for the two index reads of dual indexed runs. If is_finished is
+    given, the files are polled as they grow until it returns True.
+    max_reads limits counting to the first reads of the files.
+    """
+    counter = TopBarcodeCounter(capacity)
+    readers = [FastqBarcodeReader(f, barcode_fn) for f in fastqs]
+    pending = [[] for _ in readers]
+    try:
+        while max_reads is None or counter.total < max_reads:
+            finished = is_finished is None or is_finished()
+            has_data = False
+            for i, reader in enumerate(readers):
+                barcodes = reader.read()
+                if barcodes is not None:
+                    has_data = True
+                    pending[i].extend(barcodes)
+            num_ready = min(len(p) for p in pending)
+            if max_reads is not None:
+                num_ready = min(num_ready, max_reads - counter.total)
+            if num_ready > 0:
+                counter.update("".join(bcs) for bcs in
+                               zip(*[p[:num_ready] for p in pending]))
+                pending = [p[num_ready:] for p in pending]
+            if not has_data:
+                if finished:
+                    break
+                time.sleep(poll_interval)
+    finally:
+        for reader in readers:
+            reader.close()
+    return counter
+
+
+def _index_names(sequence):
+    names = sorted(name for name, seq in INDEX_LOOKUP.iteritems()
+                   if seq == sequence and (name.startswith("index") or
+                                           name.startswith("rpi")))
+    return ",".join(names)
+
+
+def write_metrics(out_handle, lane_counters, num_top=10):
+    """Write the top barcodes of each lane as tab delimited metrics.
+
+    lane_counters is a list of (lane, TopBarcodeCounter) pairs.
+    """
+    writer = csv.DictWriter(out_handle, fieldnames=METRICS_FIELDS,
+                            dialect=csv.excel_tab)
+    writer.writeheader()
+    for lane, counter in lane_counters:
+        for sequence, count, _ in counter.top(num_top):
+            writer.writerow({"lane": lane, "sequence": sequence,
+                             "count": count,
+                             "index_name": _index_names(sequence)})
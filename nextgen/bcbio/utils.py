@@ -58,6 +58,22 @@ def cpmap(cores=1):
         pool.terminate()
 
 
+def process_cores(config):
+    """Number of local processes a step can start, from num_cores in the config.
+
+    Distributed 'messaging' runs, and steps already running inside a
+    multiprocessing pool worker which cannot start processes of its own,
+    get a single core.
+    """
+    try:
+        cores = int(config["algorithm"].get("num_cores", 1))
+    except ValueError:
+        return 1
+    if multiprocessing is None or multiprocessing.current_process().daemon:
+        return 1
+    return max(1, cores)
+
+
 def map_wrap(f):
     """Wrap standard function to easily pass into 'map' processing.
     """
@@ -9,6 +9,7 @@ import subprocess
 from bcbio.utils import file_exists
 from bcbio.distributed.transaction import file_transaction
 from bcbio.variation import annotation
+from bcbio.pipeline.shared import region_list, parse_region
 from bcbio.log import logger2 as logger
 
 
@@ -36,17 +37,44 @@ def run_freebayes(align_bam, ref_file, config, dbsnp=None, region=None,
             region=region, fname=os.path.basename(align_bam)))
         with file_transaction(out_file) as tx_out_file:
             cl = [config["program"].get("freebayes", "freebayes"),
-                  "-b", align_bam, "-v", tx_out_file, "-f", ref_file,
+                  "-b", align_bam, "-f", ref_file,
                   "--left-align-indels"]
             cl += _freebayes_options_from_config(config["algorithm"])
-            if region:
-                cl.extend(["-r", region])
-
-            subprocess.check_call(cl)
+            regions = region_list(region)
+            if len(regions) <= 1:
+                if regions:
+                    cl.extend(["-r", _freebayes_region(regions[0])])
+                subprocess.check_call(cl + ["-v", tx_out_file])
+            else:
+                _call_batched_regions(cl, regions, tx_out_file)
 
     return out_file
 
 
+def _freebayes_region(region):
+    """Convert 1-based GATK style regions to FreeBayes 0-based coordinates.
+    """
+    chrom, start, end = parse_region(region)
+    if start is None:
+        return region
+    return "%s:%s-%s" % (chrom, start, end - 1)
+
+
+def _call_batched_regions(cl, regions, out_file):
+    """Call a batch of small regions, concatenating the output VCFs.
+    """
+    part_file = "%s-part.vcf" % os.path.splitext(out_file)[0]
+    with open(out_file, "w") as out_handle:
+        for i, region in enumerate(regions):
+            subprocess.check_call(cl + ["-r", _freebayes_region(region),
+                                        "-v", part_file])
+            with open(part_file) as in_handle:
+                for line in in_handle:
+                    if i == 0 or not line.startswith("#"):
+                        out_handle.write(line)
+            os.remove(part_file)
+
+
 def postcall_annotate(in_file, ref_file, vrn_files, config):
     """Perform post-call annotation of FreeBayes calls in preparation for filtering.
     """
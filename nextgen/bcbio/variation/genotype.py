@@ -16,7 +16,8 @@ from bcbio import broad
 from bcbio.utils import file_exists
 from bcbio.distributed.transaction import file_transaction
 from bcbio.distributed.split import parallel_split_combine
-from bcbio.pipeline.shared import (split_bam_by_chromosome, configured_ref_file)
+from bcbio.pipeline.shared import (split_bam_by_chromosome, configured_ref_file,
+                                   region_list)
 from bcbio.variation.realign import has_aligned_reads
 
 
@@ -57,8 +58,8 @@ def unified_genotyper(align_bam, ref_file, config, dbsnp=None,
                           ]
                 if dbsnp:
                     params += ["--dbsnp", dbsnp]
-                if region:
-                    params += ["-L", region]
+                for cur_region in region_list(region):
+                    params += ["-L", cur_region]
                 broad_runner.run_gatk(params)
         else:
             with open(out_file, "w") as out_handle:
@@ -408,7 +409,7 @@ def _is_bed_file(fname):
 
 
 def parallel_variantcall(sample_info, parallel_fn):
-    """Provide sample genotyping, running in parallel over individual chromosomes.
+    """Provide sample genotyping, running in parallel over balanced genomic regions.
     """
     to_process = []
     finished = []
@@ -419,7 +420,8 @@ def parallel_variantcall(sample_info, parallel_fn):
             finished.append(x)
 
     if len(to_process) > 0:
-        split_fn = split_bam_by_chromosome("-variants.vcf", "work_bam")
+        split_fn = split_bam_by_chromosome("-variants.vcf", "work_bam",
+                                           balanced=True)
         processed = parallel_split_combine(to_process, split_fn, parallel_fn,
                                            "variantcall_sample",
                                            "combine_variant_files",
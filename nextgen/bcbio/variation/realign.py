@@ -12,7 +12,8 @@ from bcbio.utils import curdir_tmpdir, file_exists, save_diskspace
 from bcbio.distributed.transaction import file_transaction
 from bcbio.distributed.split import parallel_split_combine
 from bcbio.pipeline.shared import (split_bam_by_chromosome, configured_ref_file,
-                                   write_nochr_reads, subset_bam_by_region)
+                                   write_nochr_reads, subset_bam_by_region,
+                                   region_list)
 
 
 # ## Realignment runners with GATK specific arguments
@@ -37,8 +38,8 @@ def gatk_realigner_targets(runner, align_bam, ref_file, dbsnp=None,
                       "-o", tx_out_file,
                       "-l", "INFO",
                       ]
-            if region:
-                params += ["-L", region]
+            for cur_region in region_list(region):
+                params += ["-L", cur_region]
 
             if dbsnp:
                 params += ["--known", dbsnp]
@@ -70,8 +71,8 @@ def gatk_indel_realignment(runner, align_bam, ref_file, intervals,
                           "-o", tx_out_file,
                           "-l", "INFO",
                           ]
-                if region:
-                    params += ["-L", region]
+                for cur_region in region_list(region):
+                    params += ["-L", cur_region]
                 if deep_coverage:
                     params += ["--maxReadsInMemory", "300000",
                                "--maxReadsForRealignment", str(int(5e5)),
@@ -120,9 +121,12 @@ def has_aligned_reads(align_bam, region=None):
     has_items = False
     with closing(pysam.Samfile(align_bam, "rb")) as cur_bam:
         if region is not None:
-            for item in cur_bam.fetch(region):
-                has_items = True
-                break
+            for cur_region in region_list(region):
+                for item in cur_bam.fetch(cur_region):
+                    has_items = True
+                    break
+                if has_items:
+                    break
         else:
             for item in cur_bam:
                 if not item.is_unmapped:
@@ -134,7 +138,7 @@ def has_aligned_reads(align_bam, region=None):
 # ## High level functionality to run realignments in parallel
 
 def parallel_realign_sample(sample_info, parallel_fn):
-    """Realign samples, running in parallel over individual chromosomes.
+    """Realign samples, running in parallel over balanced genomic regions.
     """
     to_process = []
     finished = []
@@ -147,7 +151,8 @@ def parallel_realign_sample(sample_info, parallel_fn):
     if len(to_process) > 0:
         file_key = "work_bam"
         split_fn = split_bam_by_chromosome("-realign.bam", file_key,
-                                           default_targets=["nochr"])
+                                           default_targets=["nochr"],
+                                           presplit=True, balanced=True)
         processed = parallel_split_combine(to_process, split_fn, parallel_fn,
                                            "realign_sample", "combine_bam",
                                            file_key, ["config"])
@@ -7,10 +7,19 @@ Usage:
      --chrom=<chrom>
      --start=<start>
      --end=<end>
-     --normalize]
+     --normalize
+     --bin=<bin size>
+     --format=<bedgraph or fixedstep>
+     --cores=<number of processes>]
 
 chrom start and end are optional, in which case they default to everything.
-The normalize flag adjusts counts to reads per million.
+The normalize flag adjusts counts to reads per million, using the mapped read
+totals from the BAM index. bin reports mean coverage in fixed size bins
+instead of for every base. Chromosomes are processed in parallel with cores.
+
+Coverage is calculated from the start and end of aligned blocks in each read
+using numpy, and written as bedGraph runs of equal coverage or fixedStep
+lines for covered stretches.
 
 The config file is in YAML format and specifies the location of the wigToBigWig
 program from UCSC:
@@ -22,22 +31,31 @@ If not specified, these will be assumed to be present in the system path.
 
 The script requires:
     pysam (http://code.google.com/p/pysam/)
+    numpy (http://numpy.scipy.org/)
     wigToBigWig from UCSC (http://hgdownload.cse.ucsc.edu/admin/exe/)
 If a configuration file is used, then PyYAML is also required (http://pyyaml.org/)
 """
 import os
 import sys
+import shutil
 import subprocess
 import tempfile
 from optparse import OptionParser
 from contextlib import contextmanager, closing
 
+import numpy as np
 import pysam
 
+from bcbio.bam import mapped_total
 from bcbio.pipeline.config_loader import load_config
 
+# pileup defaults: skip unmapped, secondary, QC failed and duplicate reads
+_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+_WINDOW_SIZE = 10000000
+
 def main(bam_file, config_file=None, chrom='all', start=0, end=None,
-         outfile=None, normalize=False, use_tempfile=False):
+         outfile=None, normalize=False, use_tempfile=False, bin_size=1,
+         out_format="bedgraph", cores=1):
     if config_file:
         config = load_config(config_file)
     else:
@@ -62,7 +80,8 @@ def main(bam_file, config_file=None, chrom='all', start=0, end=None,
             out_handle = open(wig_file, "w")
         with closing(out_handle):
             chr_sizes, wig_valid = write_bam_track(bam_file, regions, config, out_handle,
-                                                   normalize)
+                                                   normalize, int(bin_size),
+                                                   out_format, int(cores))
         try:
             if wig_valid:
                 convert_to_bigwig(wig_file, chr_sizes, config, outfile)
@@ -77,32 +96,159 @@ def indexed_bam(bam_file, config):
     yield sam_reader
     sam_reader.close()
 
-def write_bam_track(bam_file, regions, config, out_handle, normalize):
-    out_handle.write("track %s\n" % " ".join(["type=wiggle_0",
+def write_bam_track(bam_file, regions, config, out_handle, normalize,
+                    bin_size=1, out_format="bedgraph", cores=1):
+    track_type = "bedGraph" if out_format == "bedgraph" else "wiggle_0"
+    out_handle.write("track %s\n" % " ".join(["type=%s" % track_type,
         "name=%s" % os.path.splitext(os.path.split(bam_file)[-1])[0],
         "visibility=full",
         ]))
-    normal_scale = 1e6
-    is_valid = False
     with indexed_bam(bam_file, config) as work_bam:
-        total = sum(1 for r in work_bam.fetch() if not r.is_unmapped) if normalize else None
+        scale = 1e6 / mapped_total(bam_file, work_bam) if normalize else None
         sizes = zip(work_bam.references, work_bam.lengths)
-        if len(regions) == 1 and regions[0][0] == "all":
-            regions = [(name, 0, length) for name, length in sizes]
-        for chrom, start, end in regions:
-            if end is None and chrom in work_bam.references:
-                end = work_bam.lengths[work_bam.references.index(chrom)]
+    if len(regions) == 1 and regions[0][0] == "all":
+        regions = [(name, 0, length) for name, length in sizes]
+    lengths = dict(sizes)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_handle.name)))
+    try:
+        args = []
+        for i, (chrom, start, end) in enumerate(regions):
+            if end is None:
+                end = lengths.get(chrom)
             assert end is not None, "Could not find %s in header" % chrom
-            out_handle.write("variableStep chrom=%s\n" % chrom)
-            for col in work_bam.pileup(chrom, start, end):
-                if normalize:
-                    n = float(col.n) / total * normal_scale
-                else:
-                    n = col.n
-                out_handle.write("%s %.1f\n" % (col.pos+1, n))
-                is_valid = True
+            args.append((bam_file, chrom, start, end, scale, bin_size,
+                         out_format, os.path.join(tmp_dir, "%s.txt" % i)))
+        if cores > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(cores)
+            try:
+                results = pool.map(_write_region_track, args, chunksize=1)
+            finally:
+                pool.terminate()
+        else:
+            results = [_write_region_track(x) for x in args]
+        is_valid = False
+        for part_file, part_valid in results:
+            with open(part_file) as in_handle:
+                shutil.copyfileobj(in_handle, out_handle)
+            is_valid = is_valid or part_valid
+    finally:
+        shutil.rmtree(tmp_dir)
     return sizes, is_valid
 
+def _write_region_track(args):
+    """Write coverage for a region in windows, returning if any was written.
+    """
+    bam_file, chrom, start, end, scale, bin_size, out_format, out_file = args
+    is_valid = False
+    window_size = max(1, _WINDOW_SIZE // bin_size) * bin_size
+    with closing(pysam.Samfile(bam_file, "rb")) as work_bam:
+        with open(out_file, "w") as out_handle:
+            for wstart in xrange(start, end, window_size):
+                wend = min(wstart + window_size, end)
+                vals = _binned_coverage(_window_coverage(work_bam, chrom,
+                                                         wstart, wend),
+                                        bin_size)
+                if scale is not None:
+                    vals = vals * scale
+                if out_format == "bedgraph":
+                    cur_valid = _write_bedgraph(out_handle, chrom, wstart, wend,
+                                                vals, bin_size)
+                else:
+                    cur_valid = _write_fixedstep(out_handle, chrom, wstart,
+                                                 wend, vals, bin_size)
+                is_valid = is_valid or cur_valid
+    return out_file, is_valid
+
+def _window_coverage(work_bam, chrom, start, end):
+    """Per base coverage in a window from the starts and ends of read blocks.
+
+    Deletions count as covered, like a pileup, and spliced regions do not.
+    """
+    starts = []
+    ends = []
+    for read in work_bam.fetch(chrom, start, end):
+        cigar = read.cigar
+        if read.flag & _SKIP_FLAGS or not cigar:
+            continue
+        if not any(op == 3 for op, _ in cigar):
+            starts.append(read.pos)
+            ends.append(read.aend)
+        else:
+            pos = block = read.pos
+            for op, length in cigar:
+                if op == 3:
+                    if pos > block:
+                        starts.append(block)
+                        ends.append(pos)
+                    pos += length
+                    block = pos
+                elif op in (0, 2, 7, 8):
+                    pos += length
+            if pos > block:
+                starts.append(block)
+                ends.append(pos)
+    size = end - start
+    starts = np.clip(np.array(starts, dtype=np.int64) - start, 0, size)
+    ends = np.clip(np.array(ends, dtype=np.int64) - start, 0, size)
+    events = (np.bincount(starts, minlength=size + 1) -
+              np.bincount(ends, minlength=size + 1))
+    return np.cumsum(events[:size])
+
+def _binned_coverage(cov, bin_size):
+    """Mean coverage in bins, with a partial final bin.
+    """
+    if bin_size <= 1:
+        return cov
+    num_bins = -(-len(cov) // bin_size)
+    sums = np.add.reduceat(cov, np.arange(0, len(cov), bin_size))
+    counts = np.minimum(bin_size, len(cov) - np.arange(num_bins) * bin_size)
+    return sums / counts.astype(float)
+
+def _value_format(vals):
+    return "%d" if vals.dtype.kind in "iu" else "%.2f"
+
+def _write_bedgraph(out_handle, chrom, start, end, vals, bin_size):
+    """Write runs of equal, non-zero, coverage as bedGraph lines.
+    """
+    if len(vals) == 0:
+        return False
+    changes = np.flatnonzero(vals[1:] != vals[:-1]) + 1
+    run_starts = np.concatenate(([0], changes))
+    run_ends = np.concatenate((changes, [len(vals)]))
+    keep = vals[run_starts] != 0
+    fmt = "%s\t%%d\t%%d\t%s\n" % (chrom, _value_format(vals))
+    run_values = vals[run_starts[keep]].tolist()
+    run_starts = (start + run_starts[keep] * bin_size).tolist()
+    run_ends = np.minimum(start + run_ends[keep] * bin_size, end).tolist()
+    out_handle.writelines(fmt % x for x in zip(run_starts, run_ends, run_values))
+    return len(run_values) > 0
+
+def _write_fixedstep(out_handle, chrom, start, end, vals, bin_size):
+    """Write stretches of non-zero coverage as fixedStep sections.
+
+    A partial final bin is written as its own section with a shorter span,
+    so it does not extend past the end of the region.
+    """
+    covered = np.concatenate(([False], vals != 0, [False]))
+    edges = np.flatnonzero(covered[1:] != covered[:-1])
+    last_span = end - (start + (len(vals) - 1) * bin_size)
+    sections = []
+    for sstart, send in zip(edges[::2], edges[1::2]):
+        if send == len(vals) and last_span < bin_size:
+            if send - 1 > sstart:
+                sections.append((sstart, send - 1, bin_size))
+            sections.append((send - 1, send, last_span))
+        else:
+            sections.append((sstart, send, bin_size))
+    fmt = "%s\n" % _value_format(vals)
+    for sstart, send, span in sections:
+        out_handle.write("fixedStep chrom=%s start=%s step=%s span=%s\n" %
+                         (chrom, start + sstart * bin_size + 1, bin_size,
+                          span))
+        out_handle.writelines(fmt % x for x in vals[sstart:send].tolist())
+    return len(edges) > 0
+
 def convert_to_bigwig(wig_file, chr_sizes, config, bw_file=None):
     if not bw_file:
         bw_file = "%s.bigwig" % (os.path.splitext(wig_file)[0])
@@ -127,6 +273,10 @@ if __name__ == "__main__":
                       action="store_true", default=False)
     parser.add_option("-t", "--tempfile", dest="use_tempfile",
                       action="store_true", default=False)
+    parser.add_option("-b", "--bin", dest="bin_size", default=1)
+    parser.add_option("-f", "--format", dest="out_format", default="bedgraph",
+                      choices=["bedgraph", "fixedstep"])
+    parser.add_option("-p", "--cores", dest="cores", default=1)
     (options, args) = parser.parse_args()
     if len(args) not in [1, 2]:
         print "Incorrect arguments"
@@ -138,5 +288,8 @@ if __name__ == "__main__":
         start=options.start or 0,
         end=options.end,
         normalize=options.normalize,
-        use_tempfile=options.use_tempfile)
+        use_tempfile=options.use_tempfile,
+        bin_size=options.bin_size,
+        out_format=options.out_format,
+        cores=options.cores)
     main(*args, **kwargs)
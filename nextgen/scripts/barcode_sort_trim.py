@@ -15,6 +15,9 @@ Usage:
         --noindel (disallow insertion/deletions on barcode matches)
         --quiet (do not print out summary information on tags)
         --tag_title (append matched barcode to sequence header)
+        --precompute (look up mismatched barcodes in a precomputed table,
+                      only aligning reads which need indels)
+        --cores=n (number of processes used to classify reads, default 1)
 
 <barcode file> is a text file of:
     <name> <sequence>
@@ -29,245 +32,42 @@ for all barcodes present in the fastq multiplex.
     /your/output/dir/out_--b--_--r--.txt
   If the format ends with ".gz", for example
     1_100721_FC626DUAAX_--b--_--r--_fastq.txt.gz
-  then the outpul files will be gzip compressed.
+  then the outpul files will be gzip compressed. They are written as BGZF
+  blocks, compressed on multiple threads with --cores, which standard gzip
+  tools read and which can be split or seeked without decompressing from
+  the start.
 
 Requires:
     Python -- versions 2.6 or 2.7
     Biopython -- http://biopython.org
+    bcbio-nextgen -- the matching engine is in bcbio.pipeline.barcode
 """
 from __future__ import with_statement
 import gzip
 import sys
 import os
-import itertools
+import struct
 import unittest
-import collections
-import csv
 from optparse import OptionParser
 
-from Bio import pairwise2
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from bcbio.pipeline.barcode import (sort_by_barcode, sorted_barcodes,
+        read_barcodes, best_match, barcode_matcher, end_generator,
+        remove_barcode, BlockGzipWriter, _BGZF_BLOCK_SIZE, _BGZF_EOF)
 
 
 def main(barcode_file, out_format, in1, in2, in3, mismatch, bc_offset,
          bc_read_i, three_end, allow_indels,
-         metrics_file, verbose, tag_title):
+         metrics_file, verbose, tag_title, precompute=False, cores=1):
     barcodes = read_barcodes(barcode_file)
-    stats = collections.defaultdict(int)
-    out_writer = output_to_fastq(out_format)
-    for (name1, seq1, qual1), (name2, seq2, qual2), (name3, seq3, qual3) in itertools.izip(
-            read_fastq(in1), read_fastq(in2), read_fastq(in3)):
-        end_gen = end_generator(seq1, seq2, seq3, bc_read_i, three_end, bc_offset)
-        bc_name, bc_seq, match_seq = best_match(end_gen, barcodes, mismatch,
-                                                allow_indels)
-        seq1, qual1, seq2, qual2, seq3, qual3 = remove_barcode(
-                seq1, qual1, seq2, qual2, seq3, qual3,
-                match_seq, bc_read_i, three_end, bc_offset)
-        if tag_title:
-            name1 += " %s" % match_seq
-            name2 += " %s" % match_seq
-            name3 += " %s" % match_seq
-        out_writer(bc_name, name1, seq1, qual1, name2, seq2, qual2,
-                   name3, seq3, qual3)
-        stats[bc_name] += 1
-
-    sort_bcs = []
-    for bc in stats.keys():
-        try:
-            sort_bc = float(bc)
-        except ValueError:
-            sort_bc = str(bc)
-        sort_bcs.append((sort_bc, bc))
-    sort_bcs.sort()
-    sort_bcs = [s[1] for s in sort_bcs]
+    stats = sort_by_barcode(barcodes, out_format, in1, in2, in3, mismatch,
+                            bc_offset, bc_read_i, three_end, allow_indels,
+                            metrics_file, tag_title, precompute, cores,
+                            verbose=verbose)
     if verbose:
         print "% -10s %s" % ("barcode", "count")
-        for bc in sort_bcs:
+        for bc in sorted_barcodes(stats):
             print "% -10s %s" % (bc, stats[bc])
         print "% -10s %s" % ("total", sum(stats.values()))
-    if metrics_file:
-        with open(metrics_file, "w") as out_handle:
-            writer = csv.writer(out_handle, dialect="excel-tab")
-            for bc in sort_bcs:
-                writer.writerow([bc, stats[bc]])
-
-
-def best_match(end_gen, barcodes, mismatch, allow_indels=True):
-    """Identify barcode best matching to the test sequence, with mismatch.
-
-    Returns the barcode id, barcode sequence and match sequence.
-    unmatched is returned for items which can't be matched to a barcode within
-    the provided parameters.
-    """
-    if len(barcodes) == 1 and barcodes.values() == ["trim"]:
-        size = len(barcodes.keys()[0])
-        test_seq = end_gen(size)
-        return barcodes.values()[0], test_seq, test_seq
-
-    # easiest, fastest case -- exact match
-    sizes = list(set(len(b) for b in barcodes.keys()))
-    for s in sizes:
-        test_seq = end_gen(s)
-        try:
-            bc_id = barcodes[test_seq]
-            return bc_id, test_seq, test_seq
-        except KeyError:
-            pass
-
-    # check for best approximate match within mismatch values
-    match_info = []
-    if mismatch > 0 or _barcode_has_ambiguous(barcodes):
-        for bc_seq, bc_id in barcodes.iteritems():
-            test_seq = end_gen(len(bc_seq))
-            if _barcode_very_ambiguous(barcodes):
-                gapopen_penalty = -18.0
-            else:
-                gapopen_penalty = -9.0
-            aligns = pairwise2.align.globalms(bc_seq, test_seq,
-                    5.0, -4.0, gapopen_penalty, -0.5, one_alignment_only=True)
-            (abc_seq, atest_seq) = aligns[0][:2] if len(aligns) == 1 else ("", "")
-            matches = sum(1 for i, base in enumerate(abc_seq)
-                          if (base == atest_seq[i] or base == "N"))
-            gaps = abc_seq.count("-")
-            cur_mismatch = len(test_seq) - matches + gaps
-            if cur_mismatch <= mismatch and (allow_indels or gaps == 0):
-                match_info.append((cur_mismatch, bc_id, abc_seq, atest_seq))
-    if len(match_info) > 0:
-        match_info.sort()
-        name, bc_seq, test_seq = match_info[0][1:]
-        return name, bc_seq.replace("-", ""), test_seq.replace("-", "")
-    else:
-        return "unmatched", "", ""
-
-
-def _barcode_very_ambiguous(barcodes):
-    max_size = max(len(x) for x in barcodes.keys())
-    max_ns = max(x.count("N") for x in barcodes.keys())
-    return float(max_ns) / float(max_size) > 0.5
-
-
-def _barcode_has_ambiguous(barcodes):
-    for seq in barcodes.keys():
-        if "N" in seq:
-            return True
-    return False
-
-
-def end_generator(seq1, seq2=None, seq3=None, bc_read_i=1, three_end=True, bc_offset=0):
-    """Function which pulls a barcode of a provided size from paired seqs.
-
-    This respects the provided details about location of the barcode, returning
-    items of the specified size to check against the read.
-    """
-    seq_choice = {1: seq1, 2: seq2, 3: seq3}
-    seq = seq_choice[bc_read_i]
-    assert seq is not None
-
-    def _get_end(size):
-        assert size > 0
-        if three_end:
-            return seq[-size - bc_offset:len(seq) - bc_offset]
-        else:
-            return seq[bc_offset:size + bc_offset]
-    return _get_end
-
-
-def _remove_from_end(seq, qual, match_seq, three_end, bc_offset):
-    if match_seq:
-        if three_end:
-            assert seq[-len(match_seq) - bc_offset:len(seq) - bc_offset] == match_seq
-            seq = seq[:-len(match_seq) - bc_offset]
-            qual = qual[:-len(match_seq) - bc_offset]
-        else:
-            assert seq[bc_offset:len(match_seq) + bc_offset] == match_seq
-            seq = seq[len(match_seq) + bc_offset:]
-            qual = qual[len(match_seq) + bc_offset:]
-    return seq, qual
-
-
-def remove_barcode(seq1, qual1, seq2, qual2, seq3, qual3,
-                   match_seq, bc_read_i, three_end, bc_offset=0):
-    """Trim found barcode from the appropriate sequence end.
-    """
-    if bc_read_i == 1:
-        seq1, qual1 = _remove_from_end(seq1, qual1, match_seq, three_end, bc_offset)
-    elif bc_read_i == 2:
-        assert seq2 and qual2
-        seq2, qual2 = _remove_from_end(seq2, qual2, match_seq, three_end, bc_offset)
-    else:
-        assert bc_read_i == 3
-        assert seq3 and qual3
-        seq3, qual3 = _remove_from_end(seq3, qual3, match_seq, three_end, bc_offset)
-    return seq1, qual1, seq2, qual2, seq3, qual3
-
-
-def _write_to_handles(name, seq, qual, fname, out_handles):
-    try:
-        out_handle = out_handles[fname]
-    except KeyError:
-        if os.path.splitext(fname)[1] == ".gz":
-            open_file = gzip.open
-        else:
-            open_file = open
-
-        out_handle = open_file(fname, "w")
-        out_handles[fname] = out_handle
-
-    out_handle.write("@{0}\n{1}\n+\n{2}\n".format(name, seq, qual))
-
-
-def output_to_fastq(output_base):
-    """Write a set of paired end reads as fastq, managing output handles.
-    """
-    work_dir = os.path.dirname(output_base)
-    if not os.path.exists(work_dir) and work_dir:
-        try:
-            os.makedirs(work_dir)
-        except OSError:
-            assert os.path.isdir(work_dir)
-
-    out_handles = dict()
-
-    def write_reads(barcode, name1, seq1, qual1, name2, seq2, qual2,
-                    name3, seq3, qual3):
-        read1name = output_base.replace("--r--", "1").replace("--b--", barcode)
-        _write_to_handles(name1, seq1, qual1, read1name, out_handles)
-        if seq2:
-            read2name = output_base.replace("--r--", "2").replace("--b--", barcode)
-            _write_to_handles(name2, seq2, qual2, read2name, out_handles)
-
-        if seq3:
-            read3name = output_base.replace("--r--", "3").replace("--b--", barcode)
-            _write_to_handles(name3, seq3, qual3, read3name, out_handles)
-
-    return write_reads
-
-
-def read_barcodes(fname):
-    barcodes = {}
-    with open(fname) as in_handle:
-        for line in (l for l in in_handle if not l.startswith("#")):
-            name, seq = line.rstrip("\r\n").split()
-            barcodes[seq] = name
-
-    return barcodes
-
-
-def read_fastq(fname):
-    """Provide read info from fastq file, potentially not existing.
-    """
-    if not fname:
-        for info in itertools.repeat(("", None, None)):
-            yield info
-
-    if os.path.splitext(fname)[1] == ".gz":
-        open_file = gzip.open
-    else:
-        open_file = open
-
-    with open_file(fname) as in_handle:
-        for info in FastqGeneralIterator(in_handle):
-            yield info
 
 
 # --- Testing code: run with 'nosetests -v -s barcode_sort_trim.py'
@@ -387,6 +187,125 @@ class BarcodeTest(unittest.TestCase):
         assert bc_id == "C", bc_id
         (bc_id, _, _) = best_match(end_generator("GCGGGAG", bc_offset=0), bcs, 0, False)
         assert bc_id == "G", bc_id
+        (bc_id, _, _) = best_match(end_generator("GCGGGAG"), {}, 1)
+        assert bc_id == "unmatched", bc_id
+        (bc_id, _, _) = barcode_matcher({}, 1)(end_generator("GCGGGAG"))
+        assert bc_id == "unmatched", bc_id
+
+    def test_8_precomputed_matches(self):
+        """Precomputed mismatch lookups agree with alignment based matching.
+        """
+        reads = ["CGATGT", "CGTTGT", "CGAAGT", "GCATGT", "GCTTGT",
+                 "GATTACA" * 5 + "TTAGGCATC", "CAGATN", "NNNNNN"]
+        for allow_indels in [True, False]:
+            for mismatch in [0, 1, 2]:
+                matcher = barcode_matcher(self.barcodes, mismatch, allow_indels)
+                for read in reads:
+                    expected = best_match(end_generator(read), self.barcodes,
+                                          mismatch, allow_indels)
+                    # repeat to also check the cached result
+                    for _ in range(2):
+                        assert matcher(end_generator(read)) == expected, \
+                            (read, mismatch, allow_indels)
+        bcs = {"CGATGN": "2", "CAGATC": "7"}
+        matcher = barcode_matcher(bcs, 1, False)
+        assert matcher(end_generator("CGATNT"))[0] == "2"
+        assert matcher(end_generator("CGATGA"))[0] == "2"
+
+    def test_9_multicore_output(self):
+        """Multiple cores write the same files and counts as a single core.
+        """
+        import tempfile
+        import shutil
+        work_dir = tempfile.mkdtemp()
+        try:
+            bc_file = os.path.join(work_dir, "barcodes.cfg")
+            with open(bc_file, "w") as out_handle:
+                for bc_seq, bc_id in self.barcodes.iteritems():
+                    out_handle.write("%s %s\n" % (bc_id, bc_seq))
+            in_files = []
+            for read_num in ["1", "2"]:
+                in_file = os.path.join(work_dir, "in_%s.txt" % read_num)
+                with open(in_file, "w") as out_handle:
+                    ends = ["CGATGT", "CAGATC", "TTAGGCATC", "CGTTGT", "GGGGGG"]
+                    for i in range(2500):
+                        seq = "GATTACA" * 4 + ends[i % len(ends)]
+                        out_handle.write("@r%s/%s\n%s\n+\n%s\n" %
+                                         (i, read_num, seq, "I" * len(seq)))
+                in_files.append(in_file)
+            outputs = []
+            for cores in [1, 3]:
+                out_dir = os.path.join(work_dir, "out%s" % cores)
+                metrics_file = os.path.join(out_dir, "metrics.txt")
+                main(bc_file, os.path.join(out_dir, "--b--_--r--_fastq.txt"),
+                     in_files[0], in_files[1], None, 1, 0, 1, True, True,
+                     metrics_file, False, False, cores=cores)
+                out = {}
+                for fname in sorted(os.listdir(out_dir)):
+                    with open(os.path.join(out_dir, fname)) as in_handle:
+                        out[fname] = in_handle.read()
+                outputs.append(out)
+            assert outputs[0] == outputs[1]
+            assert len(outputs[0]) == 9, sorted(outputs[0].keys())
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_10_block_gzip(self):
+        """Block compressed output reads back as gzip with BGZF members.
+        """
+        import tempfile
+        from multiprocessing.pool import ThreadPool
+        text = "".join("@r%s\n%s\n+\n%s\n" % (i, "ACGT" * 25, "I" * 100)
+                       for i in range(3000))
+        pool = ThreadPool(2)
+        for cur_pool in [None, pool]:
+            out_handle, out_file = tempfile.mkstemp(suffix=".gz")
+            os.close(out_handle)
+            try:
+                writer = BlockGzipWriter(out_file, cur_pool)
+                for i in range(0, len(text), 1000):
+                    writer.write(text[i:i + 1000])
+                writer.close()
+                in_handle = gzip.open(out_file)
+                assert in_handle.read() == text
+                in_handle.close()
+                with open(out_file, "rb") as in_handle:
+                    raw = in_handle.read()
+                assert raw.endswith(_BGZF_EOF)
+                offset = 0
+                num_blocks = 0
+                while offset < len(raw):
+                    assert raw[offset:offset + 4] == "\x1f\x8b\x08\x04"
+                    assert raw[offset + 12:offset + 14] == "BC"
+                    offset += struct.unpack("<H", raw[offset + 16:offset + 18])[0] + 1
+                    num_blocks += 1
+                assert offset == len(raw)
+                assert num_blocks == len(text) // _BGZF_BLOCK_SIZE + 2
+            finally:
+                os.remove(out_file)
+        pool.close()
+        pool.join()
+
+    def test_11_trim_while_sorting(self):
+        """Reads sorted to a barcode can be trimmed in the same pass.
+        """
+        import tempfile
+        import shutil
+        work_dir = tempfile.mkdtemp()
+        try:
+            in_file = os.path.join(work_dir, "in.txt")
+            with open(in_file, "w") as out_handle:
+                out_handle.write("@r1\nGATTACACGATGT\n+\nIIIIIIIBBBBBB\n")
+                out_handle.write("@r2\nGATTACAGGGGGG\n+\nIIIIIIIBBBBBB\n")
+            out_format = os.path.join(work_dir, "--b--_--r--_fastq.txt")
+            stats = sort_by_barcode(self.barcodes, out_format, in_file,
+                                    mismatch=0, trim_sizes={"unmatched": 6})
+            assert stats == {"2": 1, "unmatched": 1}, stats
+            for bc in ["2", "unmatched"]:
+                with open(out_format.replace("--b--", bc).replace("--r--", "1")) as in_handle:
+                    assert in_handle.read().split("\n")[1:4] == ["GATTACA", "+", "IIIIIII"]
+        finally:
+            shutil.rmtree(work_dir)
 
 if __name__ == "__main__":
     parser = OptionParser()
@@ -405,6 +324,9 @@ if __name__ == "__main__":
     parser.add_option("-o", "--metrics", dest="metrics_file", default=None)
     parser.add_option("-t", "--tag_title", dest="tag_title",
                       action="store_true", default=False)
+    parser.add_option("-p", "--precompute", dest="precompute",
+                      action="store_true", default=False)
+    parser.add_option("-c", "--cores", dest="cores", default=1)
     options, args = parser.parse_args()
     in2, in3 = (None, None)
     if len(args) == 3:
@@ -421,4 +343,5 @@ if __name__ == "__main__":
         options.bc_read_i = 2
     main(barcode_file, out_format, in1, in2, in3, int(options.mismatch), int(options.bc_offset),
          int(options.bc_read_i), options.three_end, options.indels,
-         options.metrics_file, options.verbose, options.tag_title)
+         options.metrics_file, options.verbose, options.tag_title,
+         options.precompute, int(options.cores))
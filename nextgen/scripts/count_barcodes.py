@@ -5,10 +5,11 @@ samplesheet file or with bar codes given in Illumina documentation.
 # the barcode is located at the 3' end of read 1 for each paired-end read.
 
 Usage:
-    count_barcodes.py <fastq file> [<run info yaml file>]
+    count_barcodes.py <fastq file> [<fastq file> ...] [<run info yaml file>]
         -o, --out_file <name of yaml file to be written (if not given, the out
                         file will be named as the fastq file, though with
-                        .txt replaced by _barcodes.yaml)>
+                        .txt replaced by _barcodes.yaml). Only used with a
+                        single fastq file>
         -l, --length <number of characters in the bar code (default is 6)>
         -b, --back <number of steps back from the end of each line where the
                     bar code ends, 1 for Illumina (defualt is 0).>
@@ -16,6 +17,14 @@ Usage:
                         matching bar codes (default is 1).>
         -v, --verbose (sets the script to print out what is written to
                         the file)
+        -n, --reads <only count the first n million reads of each file>
+        -p, --cores <number of fastq files (lanes) to count in parallel>
+        -s, --split (also write the reads of matched bar codes to out/,
+                     aligning every read rather than each distinct bar code)
+        --metrics <file to write the most common bar codes of each fastq
+                   file to, in the undetermined index metrics format. Counts
+                   are streamed in bounded memory and no yaml is written>
+        -t, --top <number of bar codes to report with --metrics (default 10)>
 
     If called only with the fastq file, the bar codes will be matched to and
     grouped with bar codes from the Illumina documentation.
@@ -23,6 +32,11 @@ Usage:
     will be matched to the bar codes in the run info file. Index names will
     still be extracted from the Illumina documentation table.
 
+    Only the sequence lines of the fastq are read. Bar codes are packed as
+    2-bit integers and counted with numpy, then grouped by aligning each
+    distinct bar code rather than each read. Multiple fastq files, for
+    instance one per lane, each get their own yaml file.
+
 Example:
     count_barcodes.py 1_110106_FC70BUKAAXX_1_fastq.txt -v -b 1 -m 0
     will create a file named "1_110106_FC70BUKAAXX_1_fastq_barcodes.yaml"
@@ -54,44 +68,217 @@ Example:
 """
 import os
 import sys
+import gzip
+import itertools
 from Bio import pairwise2
 from optparse import OptionParser
 import yaml
 import collections
+import numpy as np
 
-from bcbio.solexa import INDEX_LOOKUP
+from bcbio.solexa import INDEX_LOOKUP, barcode_counts
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 
-def main(fastq, run_info_file, lane, out_file,
-    length, offset, mismatch, verbose, cutoff):
+def main(fastqs, run_info_file, lane, out_file,
+    length, offset, mismatch, verbose, cutoff, max_reads=None, cores=1,
+    split=False, metrics_file=None, num_top=10):
     if run_info_file:
         compare_run_info_and_index_lookup(run_info_file)
+    if metrics_file:
+        return top_barcode_metrics(fastqs, lane, length, offset, max_reads,
+                                   metrics_file, num_top)
+    if out_file and len(fastqs) > 1:
+        raise ValueError("Output file can only be specified for one fastq file")
 
     # Collect counts for all observed barcodes
-    bcodes = collections.defaultdict(int)
-    in_handle = open(fastq)
-    for _, sequence, _ in FastqGeneralIterator(in_handle):
-        bcode = sequence[-(offset + 1 + length):-(offset + 1)].strip()
-        bcodes[bcode] += 1
+    if cores > 1 and len(fastqs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(cores, len(fastqs)))
+        all_bcodes = pool.map(_census_worker, [(f, length, offset, max_reads)
+                                               for f in fastqs])
+        pool.close()
+        pool.join()
+    else:
+        all_bcodes = [barcode_census(f, length, offset, max_reads)
+                      for f in fastqs]
+
+    for fastq, bcodes in zip(fastqs, all_bcodes):
+        # Seperate out the most common barcodes
+        total = float(sum(bcodes.itervalues()))
+        bc_matched = []
+        for bc, num in bcodes.iteritems():
+            if float(num) / total >= cutoff:
+                bc_matched.append(bc)
+
+        # Check with mismatch against most common
+        if split:
+            matched_bc_grouping = approximate_matching(fastq, bcodes,
+                                        bc_matched, mismatch, offset, length)
+        else:
+            matched_bc_grouping = group_barcodes(bcodes, bc_matched, mismatch)
+
+        cur_out_file = out_file or fastq.split(".txt")[0] + "_barcodes.yaml"
+        with open(cur_out_file, "w+") as out_handle:
+            yaml.dump(matched_bc_grouping, out_handle, width=70)
+        if verbose:
+            print yaml.dump(matched_bc_grouping, width=70)
+
+
+def top_barcode_metrics(fastqs, lane, length, offset, max_reads,
+                        metrics_file, num_top):
+    """Write the most common bar codes of each fastq with a streaming counter.
+
+    Lanes are numbered from the first, unless a lane is given for a single
+    fastq file.
+    """
+    start, end = -(offset + 1 + length), -(offset + 1)
+    barcode_fn = lambda name, seq: seq.rstrip("\r")[start:end].strip()
+    lane_counters = []
+    for i, fastq in enumerate(fastqs):
+        counter = barcode_counts.count_lane_barcodes([fastq], barcode_fn,
+                                                     max_reads=max_reads)
+        cur_lane = lane if lane and len(fastqs) == 1 else i + 1
+        lane_counters.append((cur_lane, counter))
+    with open(metrics_file, "w") as out_handle:
+        barcode_counts.write_metrics(out_handle, lane_counters, num_top)
+
+
+_base_codes = np.empty(256, dtype=np.uint8)
+_base_codes.fill(4)
+for _i, _base in enumerate("ACGT"):
+    _base_codes[ord(_base)] = _i
+    _base_codes[ord(_base.lower())] = _i
+
+
+def _census_worker(args):
+    return barcode_census(*args)
+
+
+def barcode_census(fastq, length, offset, max_reads=None, chunk_size=1000000):
+    """Count bar codes at the 3' end of reads in a fastq file.
+
+    Only sequence lines are read. Bar codes made up of ACGT are packed into
+    2-bit integer codes and counted with numpy in chunks of reads; the rare
+    bar codes with other characters, or reads too short to contain a full
+    bar code, are counted directly. max_reads limits counting to the first
+    reads in the file.
 
-    # Seperate out the most common barcodes
-    total = float(sum(bcodes.itervalues()))
-    bc_matched = []
-    for bc, num in bcodes.iteritems():
-        if float(num) / total >= cutoff:
-            bc_matched.append(bc)
+    Returns a dictionary of bar code sequence to count.
+    """
+    assert length <= 31, "Bar codes longer than 31 bases cannot be packed"
+    open_fn = gzip.open if fastq.endswith(".gz") else open
+    in_handle = open_fn(fastq)
+    seq_lines = itertools.islice(in_handle, 1, None, 4)
+    if max_reads:
+        seq_lines = itertools.islice(seq_lines, max_reads)
+    start, end = -(offset + 1 + length), -(offset + 1)
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+    code_counts = collections.defaultdict(int)
+    other_counts = collections.defaultdict(int)
+    try:
+        while True:
+            bcs = [line.rstrip("\r\n")[start:end] for line in
+                   itertools.islice(seq_lines, chunk_size)]
+            if not bcs:
+                break
+            full = [bc for bc in bcs if len(bc) == length]
+            if len(full) < len(bcs):
+                for bc in bcs:
+                    if len(bc) != length:
+                        other_counts[bc.strip()] += 1
+            if not full:
+                continue
+            bases = _base_codes[np.frombuffer("".join(full),
+                                              dtype=np.uint8)].reshape(-1, length)
+            valid = (bases < 4).all(axis=1)
+            if not valid.all():
+                for i in np.flatnonzero(~valid):
+                    other_counts[full[i].strip()] += 1
+                bases = bases[valid]
+            if len(bases) == 0:
+                continue
+            codes = (bases.astype(np.uint64) << shifts).sum(axis=1,
+                                                            dtype=np.uint64)
+            for code, count in zip(*_count_codes(codes, length)):
+                code_counts[code] += count
+    finally:
+        in_handle.close()
+    bcodes = dict(other_counts)
+    for code, count in code_counts.iteritems():
+        bc = _decode_barcode(code, length)
+        bcodes[bc] = bcodes.get(bc, 0) + count
+    return bcodes
+
+
+def _count_codes(codes, length):
+    """Retrieve distinct codes and their counts from an array of codes.
+    """
+    if length <= 10:
+        counts = np.bincount(codes.astype(np.intp), minlength=1)
+        distinct = np.flatnonzero(counts)
+        return [int(c) for c in distinct], [int(c) for c in counts[distinct]]
+    codes = np.sort(codes)
+    starts = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))
+    counts = np.diff(np.concatenate((starts, [len(codes)])))
+    return [int(c) for c in codes[starts]], [int(c) for c in counts]
+
+
+def _decode_barcode(code, length):
+    bases = []
+    for _ in range(length):
+        bases.append("ACGT"[code & 3])
+        code >>= 2
+    return "".join(reversed(bases))
+
+
+def group_barcodes(bcodes, given_bcodes, mismatch):
+    """Group counted bar codes with the given bar codes they match.
+
+    Equivalent to approximate_matching, but aligning each distinct bar code
+    once instead of every read. Returns a dictionary with matched barcodes
+    along with info.
+    """
+    assert mismatch >= 0, "Amount of mismatch cannot be negative."
+    matched_bc_grouping = {}
+    found_bcodes = set()
+    number = dict(matched=0., unmatched=0.)
+    for bc, count in bcodes.iteritems():
+        for bc_given in given_bcodes:
+            if bc != bc_given and _barcode_mismatches(bc, bc_given) > mismatch:
+                continue
+            if bc_given not in matched_bc_grouping:
+                matched_bc_grouping[bc_given] = {"variants": [], "count": 0}
+            matched_bc_grouping[bc_given]["variants"].append(bc)
+            matched_bc_grouping[bc_given]["count"] += count
+            found_bcodes.add(bc)
+            number["matched"] += count
+    _add_index_names(matched_bc_grouping)
+    matched_bc_grouping["unmatched"] = \
+    dict((code, bcodes[code]) for code in set(bcodes) - found_bcodes)
+    number["unmatched"] = float(sum(matched_bc_grouping["unmatched"].values()))
+    percentage = 100. * number["matched"] / sum(number.values())
+    print("Percentage matched: %.3f%%" % percentage)
+    return matched_bc_grouping
 
-    # Check with mismatch against most common
 
-    matched_bc_grouping = approximate_matching(fastq, dict(bcodes), \
-                                                bc_matched, mismatch, offset, length)
+def _barcode_mismatches(bc, bc_given):
+    aligns = pairwise2.align.globalms(bc, bc_given,
+                5.0, -4.0, -9.0, -0.5, one_alignment_only=True)
+    bc_aligned, bc_g_aligned = aligns[0][:2]
+    matches = sum(1 for i, base in enumerate(bc_aligned) \
+                                        if base == bc_g_aligned[i])
+    gaps = bc_aligned.count("-")
+    return len(bc) - matches + gaps
 
-    if not out_file:
-        out_file = fastq.split(".txt")[0] + "_barcodes.yaml"
 
-    with open(out_file, "w+") as out_handle:
-        yaml.dump(matched_bc_grouping, out_handle, width=70)
+def _add_index_names(matched_bc_grouping):
+    for bc, matches in matched_bc_grouping.items():
+        for illumina_index, illumina_bc in INDEX_LOOKUP.items():
+            if illumina_bc == bc:
+                if "indexes" not in matches:
+                    matches["indexes"] = []
+                matches["indexes"].append(illumina_index)
 
 
 def match_against_run_info(bcodes, run_info_file, mismatch, lane):
@@ -130,13 +317,7 @@ def approximate_matching(fastq, bcodes, given_bcodes, mismatch, offset, length):
     #for bc, count in bcodes.items():
         bc = sequence[-(offset + 1 + length):-(offset + 1)].strip()
         for bc_given in given_bcodes:
-            aligns = pairwise2.align.globalms(bc, bc_given,
-                        5.0, -4.0, -9.0, -0.5, one_alignment_only=True)
-            bc_aligned, bc_g_aligned = aligns[0][:2]
-            matches = sum(1 for i, base in enumerate(bc_aligned) \
-                                                if base == bc_g_aligned[i])
-            gaps = bc_aligned.count("-")
-            cur_mismatch = len(bc) - matches + gaps
+            cur_mismatch = _barcode_mismatches(bc, bc_given)
 
             if cur_mismatch <= mismatch:
                 if bc_given not in matched_bc_grouping:
@@ -152,12 +333,7 @@ def approximate_matching(fastq, bcodes, given_bcodes, mismatch, offset, length):
 
                 out_writer(bc, title, sequence, quality, None, None, None)
 
-    for bc, matches in matched_bc_grouping.items():
-        for illumina_index, illumina_bc in INDEX_LOOKUP.items():
-            if illumina_bc == bc:
-                if "indexes" not in matches:
-                    matches["indexes"] = []
-                matches["indexes"].append(illumina_index)
+    _add_index_names(matched_bc_grouping)
 
     matched_bc_grouping["unmatched"] = \
     dict((code, bcodes[code]) for code in set(bcodes) - found_bcodes)
@@ -210,16 +386,24 @@ if __name__ == "__main__":
     parser.add_option("-v", "--verbose", dest="verbose", default=False, \
                                                         action="store_true")
     parser.add_option("-c", "--cutoff", dest="cutoff", default=0.02)
+    parser.add_option("-n", "--reads", dest="reads", default=None)
+    parser.add_option("-p", "--cores", dest="cores", default=1)
+    parser.add_option("-s", "--split", dest="split", default=False, \
+                                                        action="store_true")
+    parser.add_option("--metrics", dest="metrics_file", default=None)
+    parser.add_option("-t", "--top", dest="top", default=10)
     options, args = parser.parse_args()
-    if len(args) == 1:
-        fastq, = args
-        run_info = None
-    elif len(args) == 2:
-        fastq, run_info = args
+    if len(args) > 1 and os.path.splitext(args[-1])[1] in [".yaml", ".yml"]:
+        fastqs, run_info = args[:-1], args[-1]
     else:
+        fastqs, run_info = args, None
+    if len(fastqs) == 0:
         print __doc__
         sys.exit()
+    max_reads = int(float(options.reads) * 1e6) if options.reads else None
 
-    main(fastq, run_info, int(options.lane), options.out_file, \
+    main(fastqs, run_info, int(options.lane), options.out_file, \
             int(options.length), int(options.offset), int(options.mismatch), \
-            options.verbose, float(options.cutoff))
+            options.verbose, float(options.cutoff), max_reads, \
+            int(options.cores), options.split, options.metrics_file, \
+            int(options.top))
@@ -38,7 +38,7 @@ from itertools import izip
 from copy import deepcopy
 import logbook
 
-from bcbio.solexa import samplesheet
+from bcbio.solexa import samplesheet, barcode_counts
 from bcbio.log import create_log_handler, logger2
 from bcbio import utils
 from bcbio.distributed import messaging
@@ -265,101 +265,64 @@ def process_all(*args, **kwargs):
     process_second_read(*args, **kwargs)
 
 
-def extract_top_undetermined_indexes(fc_dir, unaligned_dir, config):
-    """Extract the top N=25 barcodes from the undetermined indices output
-    """
+def extract_top_undetermined_indexes(fc_dir, unaligned_dir, config, num_top=10):
+    """Extract the top N barcodes from the undetermined indices output
 
+    Barcodes of each lane are counted in bounded memory with a streaming
+    counter, running lanes in parallel on the configured number of cores.
+    """
     #If this is a single sample on a single lane
     if re.search("0bp$", unaligned_dir):
         infile_glob = os.path.join(unaligned_dir, "Undetermined_indices", "Sample_lane*","*_I1_*.fastq.gz")
     else:
         infile_glob = os.path.join(unaligned_dir, "Undetermined_indices", "Sample_lane*", "*_R1_*.fastq.gz")
-    infiles = glob.glob(infile_glob)
+    infiles = sorted(glob.glob(infile_glob))
+
+    lane_args = []
+    for infile in infiles:
+        fname = os.path.basename(infile)
+
+        # Parse the lane number from the filename
+        m = re.search(r'_L0*(\d+)_', fname)
+        if m is None:
+            raise ValueError("Could not determine lane from filename {:s}".format(fname))
+        lane = m.group(1)
+
+        #If needed, get indices from fastq raw sequences, otherwise from the read names
+        if re.search('I1_\S*.fastq.gz$', infile):
+            fastqs = [infile]
+            # If dual-indexed
+            infile2 = infile.replace('_I1_', '_I2_')
+            if os.path.isfile(infile2):
+                fastqs.append(infile2)
+            lane_args.append((lane, fastqs, True))
+        else:
+            lane_args.append((lane, [infile], False))
 
     # Only run as many simultaneous processes as number of cores specified in config
-    procs = []
-    num_cores = config["algorithm"].get("num_cores", 1)
-
-    # Iterate over the infiles and process each one
-    while len(infiles) > 0:
-        # Wait one minute if we are already using the maximum amount of cores
-        if len([p for p in procs if p[0].poll() is None]) == num_cores:
-            time.sleep(60)
-
-        else:
-            infile = infiles.pop()
-            fname = os.path.basename(infile)
-
-            # Parse the lane number from the filename
-            m = re.search(r'_L0*(\d+)_', fname)
-            if len(m.groups()) == 0:
-                raise ValueError("Could not determine lane from filename {:s}".format(fname))
-
-            lane = m.group(1)
-
-            # Open a subprocess for the extraction, writing output and errors to a metric file
-            logger2.info("Extracting top indexes from lane {:s}".format(lane))
-            metricfile = os.path.join(fc_dir, fname.replace("fastq.gz",
-                                                            "undetermined_indices_metrics"))
-            fh = open(metricfile, "w")
-            cl = [config["program"]["extract_barcodes"], infile, lane,
-                  '-n', 10]
-
-            #If needed, get indices from fastq raw sequeces starting at offset=0
-            if re.search('I1_\S*.fastq.gz$', infile):
-                cl = [config["program"]["extract_barcodes"], infile]
-                
-                # If dual-indexed
-                infile2 = infile.replace('_I1_','_I2_')
-                if os.path.isfile(infile2):
-                    cl.append(infile2)
-
-                run_info = _get_read_configuration(fc_dir)
-                n_cycles = run_info[1]["NumCycles"]
-                cl.append(lane)
-                cl.append("-n 10")
-                cl.append("--1.7")
-                cl.append("--db")
-                cl.append("-o 0")
-                cl.append("-b {}".format(n_cycles))
-
-            logger2.info(" ".join([str(c) for c in cl]))
-            p = subprocess.Popen([str(c) for c in cl], stdout=fh, stderr=fh)
-            procs.append([p, fh, metricfile])
-
-    # Wait until all running processes have finished
-    while len([p for p in procs if p[0].poll() is None]) > 0:
-        time.sleep(60)
-
-    # Parse all metricfiles into one list of dicts
-    logger2.info("Merging lane metrics into one flowcell metric")
-    metrics = []
-    header = []
-    for p in procs:
-        # Close the filehandle
-        p[1].close()
-
-        # Parse the output into a dict using a DictReader
-        with open(p[2]) as fh:
-            c = csv.DictReader(fh, dialect=csv.excel_tab)
-            header = c.fieldnames
-            for row in c:
-                metrics.append(row)
-        # Remove the metricfile
-        os.unlink(p[2])
+    num_cores = utils.process_cores(config)
+    logger2.info("Extracting top indexes from lanes {:s}".format(
+                 ", ".join(lane for lane, _, _ in lane_args)))
+    with utils.cpmap(min(num_cores, max(1, len(lane_args)))) as cpmap:
+        lane_counters = list(cpmap(_count_undetermined_lane, lane_args))
 
     # Write the metrics to one output file
     fcid = _get_flowcell_id(fc_dir)
     metricfile = os.path.join(unaligned_dir, "Basecall_Stats_{}".format(fcid), "Undemultiplexed_stats.metrics")
     with open(metricfile, "w") as fh:
-        w = csv.DictWriter(fh, fieldnames=header, dialect=csv.excel_tab)
-        w.writeheader()
-        w.writerows(metrics)
+        barcode_counts.write_metrics(fh, lane_counters, num_top)
 
     logger2.info("Undemultiplexed metrics written to {:s}".format(metricfile))
     return metricfile
 
 
+def _count_undetermined_lane(args):
+    lane, fastqs, is_index_read = args
+    barcode_fn = (barcode_counts.index_from_sequence if is_index_read
+                  else barcode_counts.index_from_header)
+    return lane, barcode_counts.count_lane_barcodes(fastqs, barcode_fn)
+
+
 def _post_process_run(dname, config, config_file, fastq_dir, **kwargs):
     """With a finished directory, send out message or process directly.
     """
@@ -698,6 +661,9 @@ def _generate_fastq(fc_dir, config, compress_fastq):
                 cl += ["-o", fastq_dir]
             if compress_fastq:
                 cl += ["--gzip"]
+            num_cores = utils.process_cores(config)
+            if num_cores > 1:
+                cl += ["--cores=%s" % num_cores]
 
             logger2.debug("Converting qseq to fastq on all lanes.")
             subprocess.check_call(cl)
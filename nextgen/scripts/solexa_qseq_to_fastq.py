@@ -28,15 +28,23 @@ Optional arguments:
     --outdir (-o): Write out fastq files to different output directory; defaults
                    to a directory named fastq in the current directory.
     --gzip (-z):   Write compressed output files
+    --cores (-c):  Number of processes used to convert tiles, across all lanes
+
+Tiles are converted in parallel, each compressed by its own process when
+writing gzip, and joined in tile order into the lane fastq files. gzip output
+is a standard multi-member gzip file.
 """
 from __future__ import with_statement
 import os
 import sys
 import glob
 import gzip
+import shutil
+import tempfile
 from optparse import OptionParser
 
-def main(run_name, lane_nums, do_fail=False, outdir=None, gzip=False):
+def main(run_name, lane_nums, do_fail=False, outdir=None, gzip=False,
+         cores=1):
     if outdir is None:
         outdir = os.path.join(os.getcwd(), "fastq")
     if not os.path.exists(outdir):
@@ -53,27 +61,111 @@ def main(run_name, lane_nums, do_fail=False, outdir=None, gzip=False):
                 assert os.path.isdir(fail_dir)
     else:
         fail_dir = None
+    lanes = []
     for lane_num in lane_nums:
         lane_prefix = "s_%s" % lane_num
         out_prefix = "%s_%s" % (lane_num, run_name)
         # Skip conversion if outfiles already exists
         if len(glob.glob(os.path.join(outdir,"%s*" % out_prefix))) > 0: continue
-        write_lane(lane_prefix, out_prefix, outdir, fail_dir, gzip)
+        lanes.append((lane_prefix, out_prefix))
+    write_lanes(lanes, fail_dir or outdir, fail_dir is not None, gzip, cores)
 
 
-def write_lane(lane_prefix, out_prefix, outdir, fail_dir, gzip):
+def write_lanes(lanes, outdir, do_fail, gzip, cores=1):
+    """Convert tiles of all lanes in a pool, merging outputs in tile order.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=outdir, prefix="tmp_qseq")
+    try:
+        tasks = []
+        lane_outputs = []
+        for lane_prefix, out_prefix in lanes:
+            out_tiles = {}
+            for num, tiles in _lane_tiles(lane_prefix):
+                out_tiles[num] = []
+                for fname, bc_file in tiles:
+                    part_file = os.path.join(tmp_dir, "%s_%s_%s" % (
+                        out_prefix, num, len(tasks)))
+                    tasks.append((fname, num, bc_file, part_file,
+                                  not do_fail, gzip))
+                    out_tiles[num].append(part_file)
+            lane_outputs.append((out_prefix, out_tiles))
+        if cores > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(cores)
+            try:
+                pool.map(_convert_tile, tasks, chunksize=1)
+            finally:
+                pool.terminate()
+        else:
+            map(_convert_tile, tasks)
+        for out_prefix, out_tiles in lane_outputs:
+            out_files = _get_outfile_names(out_prefix, outdir,
+                                           out_tiles.has_key("2"), gzip)
+            for num in out_files.keys():
+                part_files = out_tiles.get(num, [])
+                tmp_out = os.path.join(tmp_dir, os.path.basename(out_files[num]))
+                with open(tmp_out, "wb") as out_handle:
+                    for part_file in part_files:
+                        with open(part_file, "rb") as in_handle:
+                            shutil.copyfileobj(in_handle, out_handle)
+                        os.remove(part_file)
+                os.rename(tmp_out, out_files[num])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _lane_tiles(lane_prefix):
+    """Retrieve qseq tiles and associated barcode files for each read.
+    """
     qseq_files = glob.glob("%s_*qseq.txt" % lane_prefix)
     #_check_filesizes(qseq_files)
     one_files, two_files, bc_files = _split_paired(qseq_files)
-    is_paired = len(two_files) > 0
-    out_files = (_get_outfiles(out_prefix, outdir, is_paired)
-                 if not fail_dir else None)
-    fail_files = (_get_outfiles(out_prefix, fail_dir, is_paired)
-                  if fail_dir else None)
+    out = []
     for (num, files) in [("1", one_files), ("2", two_files)]:
-        for i, fname in enumerate(files):
-            bc_file = _get_associated_barcode(num, i, fname, bc_files)
-            convert_qseq_to_fastq(fname, num, bc_file, out_files, fail_files)
+        if files:
+            out.append((num, [(os.path.abspath(fname),
+                               _abspath(_get_associated_barcode(num, i, fname,
+                                                                bc_files)))
+                              for i, fname in enumerate(files)]))
+    return out
+
+
+def _abspath(fname):
+    return os.path.abspath(fname) if fname else None
+
+
+def _convert_tile(args):
+    """Convert a single qseq tile into a fastq part file.
+    """
+    fname, num, bc_file, part_file, pass_wanted, do_gzip = args
+    if do_gzip:
+        out_handle = gzip.open(part_file, "wb")
+    else:
+        out_handle = open(part_file, "wb")
+    try:
+        write_tile(fname, num, bc_file, out_handle, pass_wanted)
+    finally:
+        out_handle.close()
+
+
+def write_tile(fname, num, bc_file, out_handle, pass_wanted=True,
+               buffer_size=10000):
+    """Write reads from a qseq tile as fastq, buffering records.
+    """
+    bc_iterator = _qseq_iterator(bc_file, pass_wanted) if bc_file else None
+    buf = []
+    for basename, seq, qual, _ in _qseq_iterator(fname, pass_wanted):
+        # if we have barcodes, add them to the 3' end of the sequence
+        if bc_iterator:
+            (_, bc_seq, bc_qual, _) = bc_iterator.next()
+            seq += bc_seq
+            qual += bc_qual
+        buf.append("@%s/%s\n%s\n+\n%s\n" % (basename, num, seq, qual))
+        if len(buf) >= buffer_size:
+            out_handle.write("".join(buf))
+            buf = []
+    if buf:
+        out_handle.write("".join(buf))
 
 
 def _get_associated_barcode(read_num, file_num, fname, bc_files):
@@ -88,23 +180,6 @@ def _get_associated_barcode(read_num, file_num, fname, bc_files):
         return bc_file
     return None
 
-def convert_qseq_to_fastq(fname, num, bc_file, out_files, fail_files=None):
-    """Convert a qseq file into the appropriate fastq output.
-    """
-    bc_iterator = _qseq_iterator(bc_file, fail_files is None) if bc_file else None
-    for basename, seq, qual, passed in _qseq_iterator(fname, fail_files is None):
-        # if we have barcodes, add them to the 3' end of the sequence
-        if bc_iterator:
-            (_, bc_seq, bc_qual, _) = bc_iterator.next()
-            seq = "%s%s" % (seq, bc_seq)
-            qual = "%s%s" % (qual, bc_qual)
-        name = "%s/%s" % (basename, num)
-        out = "@%s\n%s\n+\n%s\n" % (name, seq, qual)
-        if passed:
-            out_files[num].write(out)
-        elif fail_files:
-            fail_files[num].write(out)
-
 def _qseq_iterator(fname, pass_wanted):
     """Return the name, sequence, quality, and pass info of qseq reads.
 
@@ -112,18 +187,19 @@ def _qseq_iterator(fname, pass_wanted):
 
     HWI-EAS264:4:1:1111:3114#0/1
     """
+    pass_char = "1" if pass_wanted else "0"
     with open(fname) as qseq_handle:
         for line in qseq_handle:
-            parts = line.strip().split("\t")
-            passed = int(parts[-1]) == 1
-            if passed is pass_wanted:
-                name = ":".join([parts[0]] +  parts[2:6]) + "#" + parts[6]
+            parts = line.rstrip("\r\n").split("\t")
+            if parts[-1] == pass_char:
+                name = "%s:%s:%s:%s:%s#%s" % (parts[0], parts[2], parts[3],
+                                             parts[4], parts[5], parts[6])
                 seq = parts[8].replace(".", "N")
                 qual = parts[9]
                 assert len(seq) == len(qual)
-                yield name, seq, qual, passed
+                yield name, seq, qual, pass_wanted
 
-def _get_outfiles(out_prefix, outdir, has_paired_files, gzip):
+def _get_outfile_names(out_prefix, outdir, has_paired_files, gzip):
     out_files = {}
     if has_paired_files:
         for num in ("1", "2"):
@@ -131,13 +207,9 @@ def _get_outfiles(out_prefix, outdir, has_paired_files, gzip):
                 out_prefix, num))
     else:
         out_files["1"] = os.path.join(outdir, "%s_fastq.txt" % out_prefix)
-    for index, fname in out_files.items():
-        if gzip:
-            fname = "{:s}.gz".format(fname)
-            fh = gzip.open(fname,"wb")
-        else:
-            fh = open(fname, "w")
-        out_files[index] = fh
+    if gzip:
+        for num, fname in out_files.items():
+            out_files[num] = "%s.gz" % fname
     return out_files
 
 def _split_paired(files):
@@ -202,8 +274,10 @@ if __name__ == "__main__":
                       default=None)
     parser.add_option("-z", "--gzip", dest="gzip", action="store_true",
                       default=False)
+    parser.add_option("-c", "--cores", dest="cores", default=1)
     (options, args) = parser.parse_args()
     if len(args) < 2:
         print __doc__
         sys.exit()
-    main(args[0], args[1].split(","), options.do_fail, options.outdir, options.gzip)
+    main(args[0], args[1].split(","), options.do_fail, options.outdir, options.gzip,
+         int(options.cores))
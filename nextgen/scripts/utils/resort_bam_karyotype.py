@@ -10,7 +10,10 @@ instead of the simple alphabetic sort:
     chr1, chr10, chr2 ...
 
 This takes a sorted BAM files with an alternative ordering of chromosomes
-and re-sorts it the karyotypic way.
+and re-sorts it the karyotypic way. Coordinate sorted BAM files are copied a
+chromosome at a time in the new order using the BAM index, with reads
+remapped to the reordered header. Unsorted BAM files are remapped and then
+sorted with samtools' external merge sort.
 
 Usage:
     resort_bam_karyotype.py <reference dict> [<one or more> <BAM files>]
@@ -25,44 +28,75 @@ Requires:
 """
 import os
 import sys
+from contextlib import closing
 
 import pysam
 
+from bcbio.bam import index_stats
+
 def main(ref_file, *in_bams):
     ref = pysam.Samfile(ref_file, "r")
     sorter = SortByHeader(ref.header)
     for bam in in_bams:
-        sort_bam(bam, sorter.header_cmp, sorter.to_include)
+        sort_bam(bam, sorter.header_key, sorter.to_include)
 
 def sort_bam(in_bam, sort_fn, to_include=None):
-    out_file = "%s-ksort%s" % os.path.splitext(in_bam)
-    index_file = "%s.bai" % in_bam
-    if not os.path.exists(index_file):
-        pysam.index(in_bam)
+    """Resort a BAM file with chromosomes ordered by the sort_fn key.
 
+    sort_fn provides a key for each (chromosome name, header item) pair.
+    """
+    out_file = "%s-ksort%s" % os.path.splitext(in_bam)
     orig = pysam.Samfile(in_bam, "rb")
     chroms = [(c["SN"], c) for c in orig.header["SQ"]]
     new_chroms = chroms[:]
     if to_include:
         new_chroms = [(c, x) for (c, x) in new_chroms if c in to_include]
-    new_chroms.sort(sort_fn)
+    new_chroms.sort(key=sort_fn)
     remapper = _id_remapper(chroms, new_chroms)
     new_header = orig.header
     new_header["SQ"] = [h for (_, h) in new_chroms]
-
-    new = pysam.Samfile(out_file, "wb", header=new_header)
-    for (chrom, _) in new_chroms:
-        for read in orig.fetch(chrom):
-            write = True
+    is_sorted = orig.header.get("HD", {}).get("SO") == "coordinate"
+    orig.close()
+
+    if is_sorted:
+        _copy_by_chromosome(in_bam, out_file, new_header, new_chroms, remapper)
+    else:
+        unsorted_file = "%s-unsorted%s" % os.path.splitext(out_file)
+        with closing(pysam.Samfile(in_bam, "rb")) as orig:
+            with closing(pysam.Samfile(unsorted_file, "wb",
+                                       header=new_header)) as new:
+                _write_remapped(orig, new, remapper)
+        pysam.sort(unsorted_file, os.path.splitext(out_file)[0])
+        os.remove(unsorted_file)
+    return out_file
+
+def _copy_by_chromosome(in_bam, out_file, new_header, new_chroms, remapper):
+    """Copy reads for each chromosome in the new order, then unplaced reads.
+    """
+    index_file = "%s.bai" % in_bam
+    if not os.path.exists(index_file):
+        pysam.index(in_bam)
+    with closing(pysam.Samfile(in_bam, "rb")) as orig:
+        with closing(pysam.Samfile(out_file, "wb", header=new_header)) as new:
+            for (chrom, _) in new_chroms:
+                _write_remapped(orig.fetch(chrom), new, remapper)
+            # reads without a chromosome follow the last placed read
+            _, last_offset = index_stats(index_file)
+            if last_offset:
+                orig.seek(last_offset)
+            else:
+                orig.reset()
+            _write_remapped((r for r in orig if r.rname < 0), new, remapper)
+
+def _write_remapped(reads, new, remapper):
+    for read in reads:
+        try:
             read.rname = remapper[read.rname]
-            try:
-                read.mrnm = remapper[read.mrnm]
-            # read pair is on a chromosome we are not using
-            except KeyError:
-                assert to_include is not None
-                write = False
-            if write:
-                new.write(read)
+            read.mrnm = remapper[read.mrnm]
+        # read or its pair is on a chromosome we are not using
+        except KeyError:
+            continue
+        new.write(read)
 
 def _id_remapper(orig, new):
     """Provide a dictionary remapping original read indexes to new indexes.
@@ -78,6 +112,7 @@ def _id_remapper(orig, new):
         if chr_o in new_chrom_to_index.keys():
             remap_indexes[i_o] = new_chrom_to_index[chr_o]
     remap_indexes[None] = None
+    remap_indexes[-1] = -1
     return remap_indexes
 
 class SortByHeader:
@@ -90,15 +125,13 @@ class SortByHeader:
             self._chrom_indexes[item["SN"]] = i
             self.to_include.append(item["SN"])
 
-    def header_cmp(self, one, two):
-        return cmp(self._chrom_indexes[one[0]],
-                   self._chrom_indexes[two[0]])
+    def header_key(self, item):
+        return self._chrom_indexes[item[0]]
 
-def sort_by_karyotype(one, two):
-    """Sort function to order reads by karyotype.
+def sort_by_karyotype(item):
+    """Sort key to order chromosomes by karyotype.
     """
-    return cmp(_split_to_karyotype(one[0]),
-               _split_to_karyotype(two[0]))
+    return _split_to_karyotype(item[0])
 
 def _split_to_karyotype(name):
     parts = name.replace("chr", "").split("_")
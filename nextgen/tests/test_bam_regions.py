@@ -0,0 +1,227 @@
+"""Tests dividing BAM files into regions in bcbio.pipeline.shared.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+from contextlib import closing
+
+import pysam
+
+from bcbio.pipeline import shared
+
+from nose.plugins.attrib import attr
+
+_REFS = [("chr1", 2000000), ("chr2", 300000)] + \
+        [("contig%s" % i, 5000) for i in range(5)]
+
+
+def _read_starts():
+    """Read start positions for each reference, with a gap in chr1.
+    """
+    starts = {"chr1": [pos for pos in range(0, 2000000, 400)
+                       if not 900000 <= pos < 1100000],
+              "chr2": range(0, 300000, 1000)}
+    for name, _ in _REFS[2:]:
+        starts[name] = range(0, 5000, 500)
+    return starts
+
+
+def _write_bam(bam_file, starts, num_unmapped=0):
+    """Write a coordinate sorted BAM of 50bp reads at the given starts.
+    """
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": name, "LN": size} for name, size in _REFS]}
+    with closing(pysam.Samfile(bam_file, "wb", header=header)) as out_bam:
+        for tid, (name, _) in enumerate(_REFS):
+            for i, pos in enumerate(starts.get(name, [])):
+                read = pysam.AlignedRead()
+                read.qname = "%s_%s_%s" % (name, pos, i)
+                read.seq = "A" * 50
+                read.qual = "I" * 50
+                read.tid = tid
+                read.pos = pos
+                read.mapq = 60
+                read.cigar = [(0, 50)]
+                out_bam.write(read)
+        for i in range(num_unmapped):
+            read = pysam.AlignedRead()
+            read.qname = "unmapped_%s" % i
+            read.seq = "A" * 50
+            read.qual = "I" * 50
+            read.tid = -1
+            read.pos = -1
+            read.flag = 4
+            out_bam.write(read)
+    return bam_file
+
+
+def _strip_read_counts(index_file):
+    """Rewrite a BAI index without the pseudo-bin holding read counts.
+    """
+    with open(index_file, "rb") as in_handle:
+        data = in_handle.read()
+    out = [data[:8]]
+    pos = 4
+    def _read(fmt):
+        vals = struct.unpack_from(fmt, data, pos)
+        return vals, pos + struct.calcsize(fmt)
+    (n_ref,), pos = _read("<i")
+    for _ in range(n_ref):
+        (n_bin,), pos = _read("<i")
+        bins = []
+        for _ in range(n_bin):
+            (bin_id, n_chunk), bin_pos = _read("<Ii")
+            end = bin_pos + 16 * n_chunk
+            if bin_id != 37450:
+                bins.append(data[pos:end])
+            pos = end
+        (n_intv,), end = _read("<i")
+        end += 8 * n_intv
+        out.append(struct.pack("<i", len(bins)) + "".join(bins) +
+                   data[pos:end])
+        pos = end
+    out.append(data[pos:])
+    with open(index_file, "wb") as out_handle:
+        out_handle.write("".join(out))
+
+
+class TestPlanRegions:
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bam_file = _write_bam(os.path.join(self.work_dir, "test.bam"),
+                                   _read_starts())
+        pysam.index(self.bam_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @attr("standard")
+    def test_split_and_batch(self):
+        """Split large references, batch small contigs and tile references.
+        """
+        regions = shared.plan_regions(self.bam_file, 8)
+        chr1 = [r for r in regions if not isinstance(r, list) and
+                r.startswith("chr1:")]
+        assert len(chr1) > 1, regions
+        batches = [r for r in regions if isinstance(r, list)]
+        assert len(batches) == 1, regions
+        assert set(batches[0]) >= set(name for name, _ in _REFS[2:]), regions
+        # every reference is covered once, and split references without gaps
+        covered = {}
+        for region in [x for r in regions for x in shared.region_list(r)]:
+            chrom, start, end = shared.parse_region(region)
+            covered.setdefault(chrom, []).append((start, end))
+        assert sorted(covered.keys()) == sorted(name for name, _ in _REFS)
+        for name, size in _REFS:
+            parts = sorted(covered[name])
+            if parts == [(None, None)]:
+                continue
+            assert parts[0][0] == 0, (name, parts)
+            assert parts[-1][1] == size, (name, parts)
+            for (_, prev_end), (start, _) in zip(parts[:-1], parts[1:]):
+                assert start == prev_end, (name, parts)
+
+    @attr("standard")
+    def test_gap_position(self):
+        """Prefer breaking a reference in windows without reads.
+        """
+        offsets = [0, 100, 200, 300, 300, 300, 400, 500, 600]
+        assert shared._gap_position(offsets, 2) == 3 * shared._BAI_WINDOW + \
+               shared._BAI_WINDOW // 2
+        assert shared._gap_position(offsets, 7, search=1) == \
+               7 * shared._BAI_WINDOW + shared._BAI_WINDOW // 2
+
+    @attr("standard")
+    def test_index_without_counts(self):
+        """Fall back to per-reference regions without index read counts.
+        """
+        _strip_read_counts(self.bam_file + ".bai")
+        ref_stats, _ = shared.index_stats(self.bam_file + ".bai")
+        assert sum(x["mapped"] for x in ref_stats) == 0
+        assert shared.plan_regions(self.bam_file, 8) is None
+
+
+def _read_names(bam_file):
+    with closing(pysam.Samfile(bam_file, "rb")) as in_bam:
+        return [read.qname for read in in_bam]
+
+
+class TestSplitBam:
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.starts = _read_starts()
+        self.num_unmapped = 25
+        self.bam_file = _write_bam(os.path.join(self.work_dir, "test.bam"),
+                                   self.starts, self.num_unmapped)
+        self.num_reads = sum(len(x) for x in self.starts.values()) + \
+                         self.num_unmapped
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @attr("standard")
+    def test_split_by_region(self):
+        """Write every reference and unplaced reads in one pass.
+        """
+        part_files = dict((name, os.path.join(self.work_dir, "%s.bam" % name))
+                          for name, _ in _REFS)
+        part_files["nochr"] = os.path.join(self.work_dir, "nochr.bam")
+        shared.split_bam_by_region(self.bam_file, part_files)
+        total = 0
+        for name, part_file in part_files.iteritems():
+            names = _read_names(part_file)
+            expected = self.num_unmapped if name == "nochr" else \
+                       len(self.starts[name])
+            assert len(names) == expected, (name, len(names), expected)
+            total += len(names)
+        assert total == self.num_reads
+
+    @attr("standard")
+    def test_nochr_reads(self):
+        """Seek to unplaced reads using the end of placed reads in the index.
+        """
+        pysam.index(self.bam_file)
+        offset = shared._nochr_offset(self.bam_file + ".bai")
+        with closing(pysam.Samfile(self.bam_file, "rb")) as in_bam:
+            in_bam.seek(offset)
+            tids = [read.tid for read in in_bam]
+        assert tids == [-1] * self.num_unmapped, tids
+        out_file = shared.write_nochr_reads(self.bam_file,
+                          os.path.join(self.work_dir, "nochr.bam"))
+        assert len(_read_names(out_file)) == self.num_unmapped
+
+    @attr("standard")
+    def test_nochr_reads_all_unplaced(self):
+        """Read the whole file when no reads are placed.
+        """
+        bam_file = _write_bam(os.path.join(self.work_dir, "unplaced.bam"),
+                              {}, self.num_unmapped)
+        pysam.index(bam_file)
+        assert shared._nochr_offset(bam_file + ".bai") is None
+        out_file = shared.write_nochr_reads(bam_file,
+                          os.path.join(self.work_dir, "nochr.bam"))
+        assert len(_read_names(out_file)) == self.num_unmapped
+
+    @attr("standard")
+    def test_region_reads(self):
+        """Assign reads spanning region boundaries to the region they start in.
+        """
+        regions = ["chr2:1-150020", "chr2:150021-300000",
+                   ["contig0", "contig1"]]
+        for indexed in [False, True]:
+            if indexed:
+                pysam.index(self.bam_file)
+            subsets = []
+            for region in regions:
+                base = os.path.join(self.work_dir, "indexed%s.bam" % indexed)
+                subsets.append(_read_names(shared.subset_bam_by_region(
+                    self.bam_file, region, base)))
+            first, second, contigs = subsets
+            # the read at 150000 overlaps both chr2 regions
+            assert "chr2_150000_150" in first
+            assert "chr2_150000_150" not in second
+            assert len(first) == 151 and len(second) == 149, \
+                   (len(first), len(second))
+            assert len(contigs) == 2 * len(self.starts["contig0"])
@@ -0,0 +1,123 @@
+"""Tests coverage calculation in the bam_to_wiggle script.
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import closing
+
+import numpy as np
+import pysam
+
+import bam_to_wiggle
+
+from nose.plugins.attrib import attr
+
+_CHROM_SIZE = 1005
+
+# (start, cigar, flag) for each read, with the bases each one covers
+_READS = [(10, [(0, 50)], 0),
+          # spliced read across the 100bp window boundary
+          (90, [(0, 20), (3, 30), (0, 20)], 0),
+          # deletion counted as covered, soft clips and insertions are not
+          (95, [(4, 3), (0, 10), (2, 5), (0, 10), (1, 2), (0, 2)], 0),
+          (195, [(0, 10)], 0),
+          # duplicates are skipped
+          (300, [(0, 50)], 0x400),
+          (990, [(0, 15)], 0)]
+_COVERED = [(10, 60), (90, 110), (140, 160), (95, 122), (195, 205),
+            (990, 1005)]
+
+
+def _expected_coverage():
+    cov = np.zeros(_CHROM_SIZE, dtype=np.int64)
+    for start, end in _COVERED:
+        cov[start:end] += 1
+    return cov
+
+
+def _write_bam(bam_file):
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": "chr1", "LN": _CHROM_SIZE}]}
+    with closing(pysam.Samfile(bam_file, "wb", header=header)) as out_bam:
+        for i, (start, cigar, flag) in enumerate(_READS):
+            size = sum(length for op, length in cigar if op in (0, 1, 4))
+            read = pysam.AlignedRead()
+            read.qname = "read%s" % i
+            read.seq = "A" * size
+            read.qual = "I" * size
+            read.tid = 0
+            read.pos = start
+            read.mapq = 60
+            read.flag = flag
+            read.cigar = cigar
+            out_bam.write(read)
+    pysam.index(bam_file)
+    return bam_file
+
+
+class TestBamCoverage:
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bam_file = _write_bam(os.path.join(self.work_dir, "test.bam"))
+        self._window_size = bam_to_wiggle._WINDOW_SIZE
+        bam_to_wiggle._WINDOW_SIZE = 100
+
+    def tearDown(self):
+        bam_to_wiggle._WINDOW_SIZE = self._window_size
+        shutil.rmtree(self.work_dir)
+
+    def _track(self, bin_size, out_format):
+        out_file = os.path.join(self.work_dir, "test.wig")
+        with open(out_file, "w") as out_handle:
+            _, is_valid = bam_to_wiggle.write_bam_track(self.bam_file,
+                                [("all", 0, None)], {}, out_handle, False,
+                                bin_size, out_format)
+        assert is_valid
+        with open(out_file) as in_handle:
+            return in_handle.read().splitlines()[1:]
+
+    @attr("standard")
+    def test_window_coverage(self):
+        """Per base coverage of spliced, deleted and window-spanning reads.
+        """
+        with closing(pysam.Samfile(self.bam_file, "rb")) as work_bam:
+            cov = np.concatenate([bam_to_wiggle._window_coverage(work_bam,
+                                      "chr1", start, min(start + 100, _CHROM_SIZE))
+                                  for start in range(0, _CHROM_SIZE, 100)])
+        assert cov.tolist() == _expected_coverage().tolist()
+
+    @attr("standard")
+    def test_bedgraph(self):
+        """bedGraph runs match per base coverage across window boundaries.
+        """
+        cov = np.zeros(_CHROM_SIZE, dtype=np.int64)
+        for line in self._track(1, "bedgraph"):
+            chrom, start, end, val = line.split("\t")
+            assert chrom == "chr1"
+            cov[int(start):int(end)] += int(val)
+        assert cov.tolist() == _expected_coverage().tolist()
+
+    @attr("standard")
+    def test_binned_coverage(self):
+        """Bins report mean coverage, with a shorter final bin.
+        """
+        vals = bam_to_wiggle._binned_coverage(np.arange(10), 4)
+        assert vals.tolist() == [1.5, 5.5, 8.5], vals
+        lines = self._track(10, "bedgraph")
+        assert lines[0] == "chr1\t10\t60\t1.00", lines
+        assert "chr1\t90\t100\t1.50" in lines, lines
+        assert lines[-2:] == ["chr1\t990\t1000\t1.00",
+                              "chr1\t1000\t1005\t1.00"], lines
+
+    @attr("standard")
+    def test_fixedstep_last_bin(self):
+        """The partial final bin does not run past the chromosome end.
+        """
+        # the final bin in its own window, and sharing a window
+        for window_size in [100, self._window_size]:
+            bam_to_wiggle._WINDOW_SIZE = window_size
+            lines = self._track(10, "fixedstep")
+            assert lines[-4:] == [
+                "fixedStep chrom=chr1 start=991 step=10 span=10", "1.00",
+                "fixedStep chrom=chr1 start=1001 step=10 span=5", "1.00"], lines
@@ -0,0 +1,69 @@
+"""Tests the bcbio.solexa.barcode_counts module.
+"""
+
+import os
+import gzip
+import random
+import tempfile
+import collections
+from StringIO import StringIO
+
+from bcbio.solexa import barcode_counts
+
+from nose.plugins.attrib import attr
+
+
+@attr("standard")
+def test_top_counts():
+    """Heavy hitters keep exact counts after the table is pruned.
+    """
+    random.seed(42)
+    barcodes = ["ATCACG"] * 5000 + ["CGATGT"] * 3000 + \
+               ["".join(random.choice("ACGT") for _ in range(8))
+                for _ in range(4000)]
+    random.shuffle(barcodes)
+    counter = barcode_counts.TopBarcodeCounter(capacity=100)
+    counter.update(barcodes)
+    assert counter.total == len(barcodes)
+    top = counter.top(2)
+    assert top == [("ATCACG", 5000, 0), ("CGATGT", 3000, 0)], top
+
+
+@attr("standard")
+def test_incremental_gzip_lane():
+    """Count a growing multi-member gzip file and write lane metrics.
+    """
+    out_handle, fastq = tempfile.mkstemp(suffix=".fastq.gz")
+    os.close(out_handle)
+    expected = collections.defaultdict(int)
+    try:
+        reader = barcode_counts.FastqBarcodeReader(fastq,
+                                barcode_counts.index_from_header)
+        barcodes = []
+        for member in range(3):
+            raw_handle = open(fastq, "ab")
+            handle = gzip.GzipFile(fileobj=raw_handle, mode="ab")
+            for i in range(500):
+                bc = "ATCACG" if i % 3 else "TTAGGC"
+                expected[bc] += 1
+                handle.write("@read%s 1:N:0:%s\nACGT\n+\nIIII\n" % (i, bc))
+            handle.close()
+            raw_handle.close()
+            while True:
+                cur = reader.read(chunk_size=1000)
+                if cur is None:
+                    break
+                barcodes.extend(cur)
+        reader.close()
+        assert collections.Counter(barcodes) == expected
+        counter = barcode_counts.count_lane_barcodes([fastq],
+                                barcode_counts.index_from_header)
+        out = StringIO()
+        barcode_counts.write_metrics(out, [("1", counter)])
+        lines = out.getvalue().splitlines()
+        assert lines[0].split("\t") == barcode_counts.METRICS_FIELDS
+        assert lines[1].split("\t") == ["1", "ATCACG", "999",
+                                        "index1,rpi1"], lines[1]
+        assert lines[2].split("\t")[:3] == ["1", "TTAGGC", "501"]
+    finally:
+        os.remove(fastq)